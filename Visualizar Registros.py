@@ -1,20 +1,10 @@
 import streamlit as st
 import pandas as pd
 import database
-import io
+import operations
+import functools
 from datetime import datetime
 
-def to_excel(df: pd.DataFrame) -> bytes:
-    """
-    Converte um DataFrame do Pandas para um arquivo Excel em memória.
-    """
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Registros')
-    # O método .close() é chamado automaticamente pelo 'with'
-    processed_data = output.getvalue()
-    return processed_data
-
 # --- Configuração da Página ---
 # st.set_page_config é chamado no app.py principal
 
@@ -66,11 +56,11 @@ st.markdown("---")
 
 # --- Botão de Exportação ---
 if not df_filtered.empty:
-    excel_data = to_excel(df_filtered)
-    
+    # A planilha só é gerada quando o usuário clica no botão.
     st.download_button(
         label="📥 Exportar Dados Filtrados para Excel",
-        data=excel_data,
+        data=functools.partial(operations.to_excel, df_filtered, sheet_name='Registros'),
+        on_click="ignore",
         file_name=f"registros_residuos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         use_container_width=True,
@@ -17,15 +17,16 @@ def get_cached_logo():
     """Carrega a imagem do logo, cacheando o resultado."""
     return Image.open("logo.png")
 
-@st.cache_data
-def get_cached_setting_options(_conn, setting_name):
-    """Busca opções de configuração do DB, cacheando o resultado."""
+# As leituras abaixo são cacheadas entre sessões. A versão de dados da tabela de origem
+# (mantida por triggers em table_stats) faz parte da chave: após uma escrita, a próxima
+# leitura usa uma chave nova e as entradas antigas saem do cache por max_entries.
+@st.cache_data(max_entries=50, show_spinner=False)
+def _cached_setting_options(_conn, setting_name, data_version):
     return operations.get_setting_options(_conn, setting_name)
 
-@st.cache_data
-def get_cached_distinct_options(_conn, field_name):
-    """Busca opções distintas da tabela de registros, cacheando o resultado."""
-    return operations.get_distinct_field_options(_conn, field_name)
+def get_cached_setting_options(conn, setting_name):
+    """Busca opções de configuração do DB, cacheando o resultado até a próxima alteração da tabela."""
+    return _cached_setting_options(conn, setting_name, operations.get_data_version(conn, setting_name))
 
 # --- Configurações da Página ---
 logo_icon = get_cached_logo()
@@ -153,17 +154,18 @@ def get_image_as_base64(path):
     return base64.b64encode(data).decode()
 
 # --- Conexão com o Banco de Dados e Inicialização ---
-conn = database.connect_db()
-if conn:
-    database.create_table(conn)
-    database.create_settings_tables(conn)
-    database.create_users_table(conn)
-    database.run_migrations(conn)
-    operations.run_user_role_migration(conn)
-    database.create_log_table(conn)
-else:
+# A conexão de leitura vem do pool do processo e é reaproveitada entre os reruns da sessão.
+# As migrações de esquema são aplicadas uma única vez, quando o pool é criado.
+conn = st.session_state.get("db_conn")
+if conn is None:
+    conn = database.connect_db()
+    st.session_state.db_conn = conn
+if not conn:
     st.error("Falha crítica na conexão com o banco de dados. O aplicativo não pode continuar.")
     st.stop()
+# Inicia a fila de importações em segundo plano (uma vez por processo), retomando
+# as importações que um reinício do servidor tenha interrompido.
+operations.start_import_worker(conn)
 
 # --- Lógica de Autenticação e UI de Login ---
 def show_login_page():
@@ -412,19 +414,23 @@ else:
                     st.rerun()
 
             if submitted:
-                if not all([tipo_operacao, regional, remetente, destino, produto, unidade]):
-                    st.error("❌ Por favor, preencha todos os campos obrigatórios.")
+                try:
+                    preco_unitario = parse_brl_to_float(preco_unitario_str)
+                    valor_total = parse_brl_to_float(valor_total_str)
+                except ValueError:
+                    st.error("❌ Por favor, insira valores numéricos válidos para Preço Unitário e Valor Total.")
                 else:
-                    try:
-                        preco_unitario = parse_brl_to_float(preco_unitario_str)
-                        valor_total = parse_brl_to_float(valor_total_str)
-                    except ValueError:
-                        st.error("❌ Por favor, insira valores numéricos válidos para Preço Unitário e Valor Total.")
+                    # Mesmas regras da importação de planilhas, mais filial e destino obrigatórios.
+                    form_errors = operations.validate_record({
+                        "data": data, "tipo_operacao": tipo_operacao, "regional": regional,
+                        "filial_remetente": remetente, "destino": destino, "produto": produto,
+                        "quantidade": quantidade, "unidade": unidade, "preco_unitario": preco_unitario,
+                    })
+                    if form_errors:
+                        st.error("❌ Por favor, corrija os campos: " + "; ".join(form_errors) + ".")
                     else:
                         success = operations.add_record(conn, user_name, data.strftime('%Y-%m-%d'), tipo_operacao, regional, remetente, destino, produto, quantidade, unidade, preco_unitario, valor_total, nfe, observacoes)
                         if success:
-                            # Limpa o cache de opções para que o novo valor apareça na próxima vez
-                            get_cached_distinct_options.clear()
                             st.session_state.show_add_success_animation = True
                             if on_close_callback: on_close_callback()
                             st.rerun()
@@ -434,11 +440,13 @@ else:
     st.session_state['previous_page_key'] = selected_page_key
 
     # Busca as opções das listas a partir dos dados já existentes nos registros.
-    regionais_options = get_cached_distinct_options(conn, "regional")
-    remetentes_options = get_cached_distinct_options(conn, "filial_remetente")
-    destinos_options = get_cached_distinct_options(conn, "destino")
-    produtos_options = get_cached_distinct_options(conn, "produto")
-    unidades_options = get_cached_distinct_options(conn, "unidade")
+    # Uma única consulta (cacheada por versão de dados) traz as listas de todos os campos.
+    distinct_options = operations.get_filter_options(conn)
+    regionais_options = distinct_options["regional"]
+    remetentes_options = distinct_options["filial_remetente"]
+    destinos_options = distinct_options["destino"]
+    produtos_options = distinct_options["produto"]
+    unidades_options = distinct_options["unidade"]
 
     if selected_page_key == "Dashboard":
         operations.display_dashboard(conn)
@@ -453,15 +461,35 @@ else:
         def close_inline_form():
             st.session_state.show_add_form_inline = False
 
-        def go_to_next_page(total_pages):
-            """Callback para ir para a próxima página."""
-            if st.session_state.page_number < total_pages - 1:
-                st.session_state.page_number += 1
+        def go_to_next_page(last_cursor):
+            """Callback para ir para a próxima página (registros que vêm depois do último exibido)."""
+            st.session_state.page_after = last_cursor
+            st.session_state.page_number += 1
 
-        def go_to_previous_page():
-            """Callback para ir para a página anterior."""
-            if st.session_state.page_number > 0:
-                st.session_state.page_number -= 1
+        def go_to_previous_page(first_cursor):
+            """Callback para ir para a página anterior (registros que vêm antes do primeiro exibido)."""
+            st.session_state.page_before = first_cursor
+            st.session_state.page_number = max(0, st.session_state.page_number - 1)
+
+        def reset_pagination():
+            """Volta para a primeira página da listagem."""
+            st.session_state.page_after = None
+            st.session_state.page_before = None
+            st.session_state.page_number = 0
+            st.session_state.count_all_results = False
+
+        def jump_to_date():
+            """Callback para posicionar a listagem no registro mais recente até a data escolhida."""
+            search = st.session_state.get("records_search_query", "")
+            target_date = st.session_state.jump_to_date_input.strftime('%Y-%m-%d')
+            cursor = operations.find_page_cursor_for_date(conn, target_date, search)
+            if cursor is None:
+                st.session_state.jump_to_date_message = "Nenhum registro encontrado até a data escolhida."
+                return
+            reset_pagination()
+            st.session_state.page_after = cursor
+            newer_records = operations.get_records_count(conn, search, min_key=cursor)
+            st.session_state.page_number = newer_records // RECORDS_PER_PAGE
 
         def handle_selection_change():
             """Callback para lidar com a seleção de linha no dataframe."""
@@ -514,7 +542,7 @@ else:
             del st.session_state.records_to_delete_bulk
 
         if 'page_number' not in st.session_state:
-            st.session_state.page_number = 0
+            reset_pagination()
         
         # --- Botão para Adicionar Registro Inline ---
         if 'show_add_form_inline' not in st.session_state:
@@ -533,32 +561,71 @@ else:
                 )
 
         RECORDS_PER_PAGE = 25
-        search_query = st.text_input("Pesquisar em todos os campos de texto", placeholder="Digite para pesquisar...")
-        total_records = operations.get_records_count(conn, search_query)
+        # Acima deste número de resultados, a busca exibe "1000+" em vez de contar tudo.
+        MAX_COUNTED_RESULTS = 1000
+        search_col, date_col = st.columns([4, 1])
+        with search_col:
+            search_query = st.text_input("Pesquisar em todos os campos de texto", placeholder="Digite para pesquisar...",
+                                         key="records_search_query", on_change=reset_pagination)
+        with date_col:
+            with st.popover("📅 Ir para data", use_container_width=True):
+                st.date_input("Registros até a data", key="jump_to_date_input", format="DD/MM/YYYY")
+                st.button("Ir", on_click=jump_to_date, use_container_width=True)
+        if st.session_state.get("jump_to_date_message"):
+            st.info(st.session_state.pop("jump_to_date_message"))
+
+        # Sem pesquisa, o total vem pronto de 'table_stats' e não precisa de limite.
+        if search_query.strip() and not st.session_state.get("count_all_results"):
+            count_limit = MAX_COUNTED_RESULTS
+        else:
+            count_limit = None
+        total_records = operations.get_records_count(conn, search_query, limit=count_limit)
+        is_count_capped = count_limit is not None and total_records > count_limit
         total_pages = (total_records + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE if total_records > 0 else 1
-        st.session_state.page_number = max(0, min(st.session_state.page_number, total_pages - 1))
-        offset = st.session_state.page_number * RECORDS_PER_PAGE
-        df_to_display = operations.get_paginated_records(
-            conn, 
-            limit=RECORDS_PER_PAGE, 
-            offset=offset, 
-            search_query=search_query
-        )
+
+        # Paginação por keyset: cada página é buscada a partir da data e do ID do primeiro ou
+        # último registro da página atual, sem OFFSET, com custo constante em qualquer profundidade.
+        if st.session_state.get("page_before") is not None:
+            df_to_display, has_previous = operations.get_records_page(
+                conn, limit=RECORDS_PER_PAGE, before=st.session_state.page_before, search_query=search_query
+            )
+            st.session_state.page_before = None
+            if not has_previous or df_to_display.empty:
+                # Chegou ao início da listagem: volta a ser a primeira página.
+                reset_pagination()
+                df_to_display, has_next = operations.get_records_page(conn, limit=RECORDS_PER_PAGE, search_query=search_query)
+            else:
+                st.session_state.page_after = operations.page_cursor(df_to_display, 0, include=True)
+                has_next = True
+        else:
+            df_to_display, has_next = operations.get_records_page(
+                conn, limit=RECORDS_PER_PAGE, after=st.session_state.page_after, search_query=search_query
+            )
+        if not is_count_capped:
+            st.session_state.page_number = max(0, min(st.session_state.page_number, total_pages - 1))
+        is_first_page = st.session_state.page_after is None
 
         nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
         with nav_col1:
             st.button("⬅️ Anterior", 
                       use_container_width=True, 
-                      disabled=(st.session_state.page_number <= 0),
-                      on_click=go_to_previous_page)
+                      disabled=is_first_page or df_to_display.empty,
+                      on_click=go_to_previous_page,
+                      args=(operations.page_cursor(df_to_display, 0) if not df_to_display.empty else None,))
         with nav_col2:
-            st.markdown(f"<p style='text-align: center; color: white; margin-top: 0.5rem;'>Página {st.session_state.page_number + 1} de {total_pages}</p>", unsafe_allow_html=True)
+            total_pages_label = f"{total_pages - 1}+" if is_count_capped else f"{total_pages}"
+            st.markdown(f"<p style='text-align: center; color: white; margin-top: 0.5rem;'>Página {st.session_state.page_number + 1} de {total_pages_label}</p>", unsafe_allow_html=True)
+            if is_count_capped:
+                st.caption(f"Mais de {MAX_COUNTED_RESULTS:,} resultados encontrados.".replace(",", "."))
+                if st.button("Contar todos os resultados", type="tertiary", use_container_width=True):
+                    st.session_state.count_all_results = True
+                    st.rerun()
         with nav_col3:
             st.button("Próximo ➡️", 
                       use_container_width=True, 
-                      disabled=(st.session_state.page_number >= total_pages - 1),
+                      disabled=not has_next,
                       on_click=go_to_next_page,
-                      args=(total_pages,))
+                      args=(operations.page_cursor(df_to_display, -1) if not df_to_display.empty else None,))
         
         # Placeholder para o diálogo de confirmação, para que ele possa ser renderizado no topo se necessário
         confirmation_placeholder = st.empty()
@@ -784,25 +851,40 @@ else:
                     st.rerun()
 
     elif selected_page_key == "Upload de Planilha" and st.session_state.get('role') == "Admin":
-        st.header("Importar Registros de Planilha Excel")
-        st.info("Para garantir a importação correta, use o modelo de planilha abaixo.")
-        template_excel = operations.get_template_excel()
-        st.download_button(
-            label="📥 Baixar Modelo da Planilha",
-            data=template_excel,
-            file_name="modelo_importacao_residuos.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        st.header("Importar Registros de Planilhas")
+        st.info("Para garantir a importação correta, use um dos modelos abaixo. Também são aceitos arquivos Parquet com as mesmas colunas.")
+        col_xlsx, col_csv = st.columns(2)
+        with col_xlsx:
+            st.download_button(
+                label="📥 Baixar Modelo da Planilha",
+                data=operations.get_template_excel(),
+                file_name="modelo_importacao_residuos.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        with col_csv:
+            st.download_button(
+                label="📥 Baixar Modelo CSV",
+                data=operations.get_template_csv(),
+                file_name="modelo_importacao_residuos.csv",
+                mime="text/csv"
+            )
         st.divider()
-        uploaded_file = st.file_uploader("Escolha um arquivo Excel (.xlsx)", type="xlsx")
-        if uploaded_file is not None:
+        uploaded_files = st.file_uploader(
+            "Escolha um ou mais arquivos (.xlsx, .csv ou .parquet)", type=operations.IMPORT_FILE_TYPES, accept_multiple_files=True
+        )
+        if uploaded_files:
             if st.button("Importar Dados da Planilha", type="primary"):
-                operations.process_excel_upload(conn, user_name, uploaded_file)
-                st.rerun()
+                # A importação roda em segundo plano; a lista abaixo acompanha o progresso.
+                # As listas e o dashboard se atualizam sozinhos pela versão de dados.
+                submitted = [f for f in uploaded_files if operations.submit_import_job(conn, user_name, f) is not None]
+                if submitted:
+                    st.success(f"📤 {len(submitted)} arquivo(s) enviado(s) para a fila de importação.")
+        st.subheader("Importações Recentes")
+        operations.display_import_jobs(conn)
 
     elif selected_page_key == "Configurações":
         st.header("Gerenciar Opções das Listas de Seleção")
-        st.info("Adicione ou remova opções que aparecerão nos formulários de adição e edição de registros.")
+        st.info("Adicione, renomeie ou remova opções que aparecerão nos formulários de adição e edição de registros. Renomear uma opção atualiza todos os registros que a utilizam.")
 
         setting_configs = {
             "Regionais": "regionais",
@@ -825,8 +907,6 @@ else:
                         new_option = st.text_input("Nova Opção", placeholder="Digite a nova opção aqui...", label_visibility="collapsed")
                         if st.form_submit_button("➕ Adicionar"):
                             if new_option:
-                                # Limpa o cache para esta opção para que a lista seja recarregada com o novo item.
-                                get_cached_setting_options.clear()
                                 operations.add_setting_option(conn, table_name, new_option)
                                 st.rerun()
 
@@ -835,21 +915,24 @@ else:
                     if not options:
                         st.caption("Nenhuma opção cadastrada.")
                     else:
-                        with st.container(height=250):
-                            for option in options:
-                                item_col1, item_col2 = st.columns([0.85, 0.15])
-                                item_col1.text_input("item", value=option, disabled=True, label_visibility="collapsed", key=f"item_{table_name}_{option}")
-                                if item_col2.button("🗑️", key=f"del_{table_name}_{option}", help=f"Remover '{option}'", use_container_width=True):
-                                    # Limpa o cache para que a lista seja recarregada sem o item removido.
-                                    get_cached_setting_options.clear()
-                                    operations.delete_setting_option(conn, table_name, option)
-                                    st.rerun()
+                        # Uma tabela rolável em vez de um widget por opção: as listas incluem
+                        # todas as opções usadas nos registros e podem ter centenas de itens.
+                        st.dataframe(pd.DataFrame({"Opção": options}), height=250, hide_index=True, use_container_width=True)
+                        selected_option = st.selectbox("Opção selecionada", options, key=f"selected_{table_name}")
+                        new_name = st.text_input("Novo nome", placeholder="Novo nome para a opção selecionada", key=f"rename_{table_name}")
+                        action_col1, action_col2 = st.columns(2)
+                        if action_col1.button("✏️ Renomear", key=f"rename_btn_{table_name}", use_container_width=True):
+                            if new_name and operations.rename_setting_option(conn, table_name, selected_option, new_name):
+                                st.rerun()
+                        if action_col2.button("🗑️ Remover", key=f"del_{table_name}", help=f"Remover '{selected_option}'", use_container_width=True):
+                            if operations.delete_setting_option(conn, table_name, selected_option):
+                                st.rerun()
         
         st.divider()
         with st.expander("🧰 Manutenção de Dados"):
             st.warning(
-                "A ação abaixo irá percorrer todos os registros existentes e aplicar as regras de "
-                "padronização (ex: 'kg' se tornará 'KG', 'nome produto' se tornará 'Nome Produto'). "
+                "A ação abaixo irá aplicar as regras de padronização às opções usadas nos registros "
+                "(ex: 'kg' se tornará 'KG', 'nome produto' se tornará 'Nome Produto'). "
                 "É seguro executar esta operação múltiplas vezes."
             )
             
@@ -858,6 +941,15 @@ else:
                     operations.migrate_old_records(conn)
                     st.rerun()
 
+            st.divider()
+            st.caption("Recria os índices do banco de dados e atualiza as estatísticas usadas nas consultas. Recomendado após grandes importações.")
+            if st.button("Otimizar Banco de Dados"):
+                with st.spinner("Otimizando o banco de dados..."):
+                    database.ensure_indexes(conn)
+                    database.analyze_database(conn)
+                    database.refresh_table_stats(conn)
+                st.success("✅ Banco de dados otimizado com sucesso!")
+
     elif selected_page_key == "Log de Atividades":
         st.header("Log de Atividades Recentes")
         log_df = operations.get_activity_log(conn)
@@ -914,7 +1006,7 @@ else:
         with st.expander("📋 Visualizar Registros"):
             st.markdown("""
             Aqui você pode ver, pesquisar, editar e excluir todos os registros.
-            - **Pesquisa:** Use a barra de busca no topo para encontrar registros específicos. A busca funciona para todos os campos de texto.
+            - **Pesquisa:** Use a barra de busca no topo para encontrar registros específicos. A busca funciona para todos os campos de texto e encontra palavras pelo início (ex: `arag` encontra 'Araguaína'). Ao digitar vários termos, são exibidos apenas os registros que contêm todos eles.
             - **Editar:** Clique em uma linha da tabela para selecioná-la. Um formulário de edição aparecerá abaixo com os dados do registro. Altere o que for necessário e clique em "Salvar Alterações".
             - **Excluir:** Após selecionar um registro, clique no botão "Excluir Registro" no formulário de edição. Uma confirmação será solicitada.
             - **⚠️ Zona de Perigo:** Tenha muito cuidado com esta seção. A opção "Excluir Todos os Registros" apaga **permanentemente** todos os dados do sistema. Use apenas se tiver certeza absoluta.
@@ -922,18 +1014,20 @@ else:
 
         with st.expander("⬆️ Upload de Planilha"):
             st.markdown("""
-            Permite importar múltiplos registros de uma vez a partir de um arquivo Excel.
-            1.  **Baixar Modelo:** É **essencial** usar o modelo padrão. Clique em "📥 Baixar Modelo da Planilha" para obter o arquivo `.xlsx` com as colunas corretas.
+            Permite importar múltiplos registros de uma vez a partir de arquivos Excel (`.xlsx`), CSV ou Parquet.
+            1.  **Baixar Modelo:** É **essencial** usar o modelo padrão. Clique em "📥 Baixar Modelo da Planilha" (ou "📥 Baixar Modelo CSV") para obter o arquivo com as colunas corretas. Arquivos CSV usam `;` como separador e vírgula como separador decimal.
             2.  **Preencher a Planilha:** Abra o modelo e preencha com seus dados, seguindo o formato das colunas. A coluna 'Data' deve estar no formato `DD/MM/AAAA`.
-            3.  **Fazer Upload:** Selecione o arquivo preenchido no campo "Escolha um arquivo Excel".
-            4.  **Importar:** Clique em "Importar Dados da Planilha". O sistema validará os dados e informará quantos registros foram adicionados e quantos foram ignorados por erros.
+            3.  **Fazer Upload:** Selecione um ou mais arquivos preenchidos no campo "Escolha um ou mais arquivos".
+            4.  **Importar:** Clique em "Importar Dados da Planilha". As planilhas entram na fila e são importadas em segundo plano, com todas as suas abas, e você pode continuar usando o sistema. Abas que não seguem o modelo são ignoradas e listadas no resumo. Em "Importações Recentes" é possível acompanhar o progresso e, ao final, ver quantos registros foram adicionados e quantos foram ignorados por erros.
+            5.  **Reenvios:** Linhas que já constam no banco (mesma data, filial, produto, destino, quantidade, preço e NFe) são ignoradas. Enviar a mesma planilha de novo não duplica registros, e linhas iguais repetidas dentro de uma mesma planilha são todas importadas.
             """)
 
         with st.expander("⚙️ Configurações"):
             st.markdown("""
             Nesta página, você pode gerenciar as opções que aparecem nas listas suspensas do aplicativo (como Regionais, Produtos, etc.).
             - **Adicionar Opção:** Em cada categoria, digite a nova opção no campo de texto e clique em "➕ Adicionar".
-            - **Remover Opção:** Na lista de "Opções Atuais", clique no ícone de lixeira (🗑️) ao lado do item que deseja remover.
+            - **Renomear Opção:** Escolha a opção em "Opção selecionada", digite o novo nome e clique em "✏️ Renomear". Todos os registros que usam a opção passam a exibir o novo nome.
+            - **Remover Opção:** Escolha a opção em "Opção selecionada" e clique em "🗑️ Remover". Opções ainda usadas em registros não podem ser removidas.
             - **🧰 Manutenção de Dados:** A função "Padronizar Dados Antigos" serve para corrigir e padronizar registros antigos que possam ter sido inseridos com formatação diferente (ex: 'kg' em vez de 'KG'). É seguro executar esta ação.
             """)
 
@@ -0,0 +1,91 @@
+"""
+Benchmark das agregações do dashboard.
+
+Grava registros sintéticos em um banco temporário novo e compara o que uma reexecução do
+dashboard com filtros novos fazia antes (uma consulta GROUP BY por widget: KPIs, receita por
+regional, Top 10 filiais, Top 10 destinos, resumo de produtos e evolução mensal) com o motor
+de get_dashboard_aggregates (uma leitura do resumo diário e um groupby por dimensão).
+Mede sem filtros e filtrando uma regional.
+
+Uso: python benchmark_agregacao.py [linhas] [repetições]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import database
+import operations
+from benchmark_insercao import gerar_registros
+
+SEM_FILTROS = dict(
+    start_date='2000-01-01', end_date='2100-01-01', regional='Todos', branch='Todos', product='Todos',
+    destination='Todos', operation_type='Todos', unit='Todos', user='Todos',
+)
+CENARIOS = {
+    "sem filtros": SEM_FILTROS,
+    "uma regional": dict(SEM_FILTROS, regional='Regional 0'),
+}
+
+# Consultas feitas antes por widget: (agrupamento, medidas, limite).
+MEDIDAS = {
+    'Valor Total': 'SUM(valor_total)',
+    'Quantidade': 'SUM(quantidade)',
+    'Registros': 'SUM(num_registros)',
+    'Preço Médio': 'SUM(soma_preco_unitario) / SUM(num_registros)',
+}
+CONSULTAS_POR_WIDGET = [
+    (None, ['Valor Total', 'Quantidade', 'Registros'], None),
+    ('regional', ['Valor Total'], None),
+    ('filial_remetente', ['Valor Total'], 10),
+    ('destino', ['Valor Total'], 10),
+    ('produto', ['Valor Total', 'Quantidade', 'Preço Médio'], None),
+    ('substr(data, 1, 7)', ['Valor Total', 'Quantidade'], None),
+]
+
+
+def consultas_por_widget(conn, filtros):
+    """As consultas do dashboard antes do motor de agregação, uma por widget."""
+    condicoes, parametros = operations._build_dashboard_filters(**filtros)
+    for grupo, medidas, limite in CONSULTAS_POR_WIDGET:
+        colunas = ", ".join(f'{MEDIDAS[medida]} AS "{medida}"' for medida in medidas)
+        consulta = f"SELECT {grupo + ', ' if grupo else ''}{colunas} FROM registros_daily WHERE {' AND '.join(condicoes)}"
+        if grupo:
+            consulta += f' GROUP BY {grupo} ORDER BY "{medidas[0]}" DESC'
+        if limite:
+            consulta += f" LIMIT {limite}"
+        pd.read_sql_query(consulta, conn, params=parametros)
+
+
+def motor_de_agregacao(conn, filtros):
+    """Uma leitura do resumo diário e um groupby por dimensão, que servem todos os widgets."""
+    operations.get_dashboard_aggregates(conn, filtros)
+
+
+def medir(conn, consultas, filtros, repeticoes):
+    """Tempo médio, em milissegundos, de uma rodada de `consultas`."""
+    consultas(conn, filtros)  # aquece o cache de páginas do SQLite
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        consultas(conn, filtros)
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+if __name__ == "__main__":
+    linhas = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as pasta:
+        conn = database.connect_db(os.path.join(pasta, "benchmark.db"))
+        print(f"Gravando {linhas:,} registros sintéticos...")
+        with database.deferred_indexes(conn):
+            operations.bulk_insert_records(conn, gerar_registros(linhas))
+        resumo = conn.execute("SELECT COUNT(*) FROM registros_daily").fetchone()[0]
+        print(f"'registros_daily': {resumo:,} linhas\n")
+
+        for nome, filtros in CENARIOS.items():
+            antes = medir(conn, consultas_por_widget, filtros, repeticoes)
+            depois = medir(conn, motor_de_agregacao, filtros, repeticoes)
+            print(f"{nome:<14} por widget {antes:8.1f} ms   motor {depois:8.1f} ms   ganho {antes / depois:.2f}x")
+        conn.close()
@@ -0,0 +1,84 @@
+"""
+Benchmark da importação por formato de arquivo.
+
+Gera um mesmo conjunto de registros sintéticos nas colunas da planilha modelo, grava-o em
+Excel (.xlsx, com uma aba e dividido em ABAS abas), CSV (padrão brasileiro) e Parquet e
+importa cada arquivo com operations.import_file em um banco temporário novo, mostrando
+linhas por segundo. As abas do Excel são lidas pelo pool de processos, em paralelo com a
+gravação: o ganho depende do número de núcleos (operations.IMPORT_PARSE_WORKERS).
+
+Uso: python benchmark_importacao.py [linhas]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import database
+import operations
+from benchmark_insercao import gerar_registros
+
+# Coluna de 'registros' -> cabeçalho da planilha modelo.
+CABECALHOS = {
+    'tipo_operacao': 'Tipo de Operação', 'regional': 'Regional', 'filial_remetente': 'Filial Remetente',
+    'data': 'Data', 'produto': 'Produto', 'destino': 'Destino', 'quantidade': 'Quantidade',
+    'unidade': 'Unidade', 'preco_unitario': 'Preço Unitário', 'nfe': 'NFe', 'observacoes': 'Observacoes',
+}
+# Abas da planilha dividida.
+ABAS = 4
+
+
+def gerar_planilha(linhas):
+    """Registros sintéticos com os cabeçalhos e tipos de uma planilha preenchida pelo usuário."""
+    df = gerar_registros(linhas)[list(CABECALHOS)].rename(columns=CABECALHOS)
+    df['Data'] = pd.to_datetime(df['Data'])
+    df['Observacoes'] = ''
+    return df
+
+
+def gravar_arquivos(df, pasta):
+    """Grava `df` em cada formato aceito e retorna {descrição: caminho}."""
+    caminhos = {formato: os.path.join(pasta, f"importacao.{formato}") for formato in operations.IMPORT_FILE_TYPES}
+    df.to_excel(caminhos['xlsx'], index=False, engine='xlsxwriter')
+    caminhos[f'xlsx ({ABAS} abas)'] = os.path.join(pasta, "importacao_abas.xlsx")
+    with pd.ExcelWriter(caminhos[f'xlsx ({ABAS} abas)'], engine='xlsxwriter') as planilha:
+        linhas_por_aba = -(-len(df) // ABAS)
+        for aba in range(ABAS):
+            df.iloc[aba * linhas_por_aba:(aba + 1) * linhas_por_aba].to_excel(planilha, sheet_name=f"Aba {aba + 1}", index=False)
+    df.assign(Data=df['Data'].dt.strftime('%d/%m/%Y')).to_csv(
+        caminhos['csv'], sep=operations.IMPORT_CSV_SEPARATOR, decimal=',', index=False, encoding='utf-8-sig'
+    )
+    df.to_parquet(caminhos['parquet'], index=False)
+    return caminhos
+
+
+def medir(formato, caminho):
+    """Importa o arquivo em um banco temporário novo e devolve o resultado e o tempo gasto."""
+    with open(caminho, 'rb') as arquivo:
+        dados = arquivo.read()
+    with tempfile.TemporaryDirectory() as pasta:
+        conn = database.connect_db(os.path.join(pasta, "benchmark.db"))
+        inicio = time.perf_counter()
+        resultado = operations.import_file(conn, "benchmark", caminho, dados)
+        tempo = time.perf_counter() - inicio
+        conn.close()
+    return resultado, tempo
+
+
+if __name__ == "__main__":
+    linhas = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    df = gerar_planilha(linhas)
+    print(f"Importando {linhas:,} registros sintéticos ({operations.IMPORT_PARSE_WORKERS} processos de leitura)\n")
+    # O pool de leitura do Excel é criado uma vez por processo; não entra na medição.
+    operations._get_parse_pool()[0].submit(int).result()
+    with tempfile.TemporaryDirectory() as pasta:
+        for formato, caminho in gravar_arquivos(df, pasta).items():
+            resultado, tempo = medir(formato, caminho)
+            tamanho = os.path.getsize(caminho) / 1e6
+            print(
+                f"{formato:<14} {tamanho:7.1f} MB {tempo:8.2f} s {resultado['rows_read'] / tempo:10,.0f} linhas/s "
+                f"({resultado['inserted']:,} importados, {resultado['invalid']:,} inválidos)"
+            )
+    operations._get_parse_pool()[0].shutdown()
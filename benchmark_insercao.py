@@ -0,0 +1,80 @@
+"""
+Benchmark da gravação em massa de registros.
+
+Compara o caminho antigo da importação (DataFrame.to_sql na view 'registros', uma linha
+por vez pelos gatilhos INSTEAD OF) com operations.bulk_insert_records (executemany direto
+em 'registros_base'), cada um em um banco temporário novo, e mostra linhas por segundo.
+
+Uso: python benchmark_insercao.py [linhas] [--adiar-indices]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import database
+import operations
+
+
+def gerar_registros(linhas, seed=42):
+    """Gera um DataFrame sintético no formato que _prepare_import_chunk entrega para gravação."""
+    rng = np.random.default_rng(seed)
+    quantidade = rng.integers(1, 5000, linhas).astype(float)
+    preco = rng.integers(10, 2000, linhas) / 100
+    return pd.DataFrame({
+        'data': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 730, linhas), unit='D')).strftime('%Y-%m-%d'),
+        'regional': rng.choice([f"Regional {i}" for i in range(12)], linhas),
+        'filial_remetente': rng.choice([f"Filial {i}" for i in range(40)], linhas),
+        'destino': rng.choice([f"Destino {i}" for i in range(60)], linhas),
+        'produto': rng.choice([f"Produto {i}" for i in range(25)], linhas),
+        'quantidade': quantidade,
+        'unidade': rng.choice(["Kg", "Ton", "Unid"], linhas),
+        'preco_unitario': preco,
+        'valor_total': quantidade * preco,
+        'nfe': rng.integers(100000, 999999, linhas).astype(str),
+        'observacoes': None,
+        'tipo_operacao': rng.choice(["Venda", "Doação"], linhas),
+        'usuario_lancamento': "benchmark",
+    })
+
+
+def medir(nome, df, gravar):
+    """Grava `df` em um banco temporário novo com `gravar(conn, df)` e devolve as linhas por segundo."""
+    with tempfile.TemporaryDirectory() as pasta:
+        conn = database.connect_db(os.path.join(pasta, "benchmark.db"))
+        inicio = time.perf_counter()
+        gravar(conn, df)
+        tempo = time.perf_counter() - inicio
+        total = conn.execute("SELECT COUNT(*) FROM registros").fetchone()[0]
+        conn.close()
+    assert total == len(df), f"{nome}: {total} de {len(df)} linhas gravadas"
+    print(f"{nome:<32} {tempo:8.2f} s {len(df) / tempo:12,.0f} linhas/s")
+    return len(df) / tempo
+
+
+def gravar_to_sql(conn, df):
+    with database.write_transaction(conn) as cursor:
+        df.to_sql('registros', cursor.connection, if_exists='append', index=False)
+
+
+def gravar_em_massa(conn, df):
+    operations.bulk_insert_records(conn, df)
+
+
+def gravar_em_massa_adiando_indices(conn, df):
+    with database.deferred_indexes(conn):
+        operations.bulk_insert_records(conn, df)
+
+
+if __name__ == "__main__":
+    linhas = int(next((arg for arg in sys.argv[1:] if arg.isdigit()), 50000))
+    df = gerar_registros(linhas)
+    print(f"Gravando {linhas:,} registros sintéticos\n")
+    antes = medir("to_sql (view 'registros')", df, gravar_to_sql)
+    depois = medir("bulk_insert_records", df, gravar_em_massa)
+    if "--adiar-indices" in sys.argv:
+        medir("bulk_insert_records + índices", df, gravar_em_massa_adiando_indices)
+    print(f"\nGanho: {depois / antes:.1f}x")
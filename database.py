@@ -1,136 +1,1052 @@
 import sqlite3
 import os
+import math
+import hashlib
+import queue
+import socket
+import threading
+from contextlib import contextmanager
 import streamlit as st
 
 
 DB_FILENAME = "Frango Americano.db"
 
+# PRAGMAs aplicados uma única vez em cada conexão aberta pelo pool.
+# WAL permite que leitores e o escritor trabalhem ao mesmo tempo; busy_timeout
+# faz a conexão aguardar um lock em vez de falhar com "database is locked".
+CONNECTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -20000,  # Valor negativo = tamanho em KiB (~20 MB)
+    "mmap_size": 268435456,  # 256 MB
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",  # Impede excluir uma opção de configuração ainda usada em registros
+}
 
+# Quantidade máxima de conexões de leitura ociosas mantidas pelo pool.
+MAX_IDLE_READERS = 8
+
+
+class PooledConnection(sqlite3.Connection):
+    """Conexão SQLite que volta para o pool ao ser fechada, em vez de ser descartada."""
+
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
+    """
+    Pool de conexões do processo: várias conexões de leitura e um único escritor.
+    As escritas são serializadas por um lock, de modo que os leitores (em WAL)
+    nunca ficam bloqueados atrás de uma escrita em andamento.
+    """
+
+    def __init__(self, db_path, max_idle_readers=MAX_IDLE_READERS):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=max_idle_readers)
+        self._write_lock = threading.Lock()
+        self._writer = self._open()
+
+    def _open(self):
+        """Abre uma nova conexão já configurada com os PRAGMAs de performance."""
+        conn = sqlite3.connect(
+            self.db_path,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        for name, value in CONNECTION_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        """Retorna uma conexão de leitura ociosa ou abre uma nova."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, conn):
+        """Devolve uma conexão de leitura ao pool (ou a fecha se o pool estiver cheio)."""
+        if conn is self._writer:
+            return
+        conn.row_factory = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            sqlite3.Connection.close(conn)
+
+    def close(self):
+        """Fecha o escritor e as conexões de leitura ociosas."""
+        while True:
+            try:
+                sqlite3.Connection.close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        sqlite3.Connection.close(self._writer)
+
+    @contextmanager
+    def transaction(self):
+        """Executa uma transação de escrita no escritor único do processo."""
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                self._writer.rollback()
+                raise
+            else:
+                self._writer.commit()
+
+
+@st.cache_resource(show_spinner=False)
+def _get_pool(db_path):
+    """
+    Cria o pool uma única vez por processo para cada arquivo de banco e
+    aplica as migrações pendentes nesse momento, fora do caminho de cada rerun.
+    Se as migrações falharem, o pool é fechado e a exceção propagada: o st.cache_resource
+    não guarda o resultado, e a próxima conexão tenta de novo.
+    """
+    pool = ConnectionPool(db_path)
+    conn = pool.acquire()
+    try:
+        try:
+            run_migrations(conn)
+            ensure_base_triggers(conn)
+            if ensure_indexes(conn):
+                analyze_database(conn)
+            else:
+                optimize_database(conn)
+        finally:
+            conn.close()
+    except BaseException:
+        pool.close()
+        raise
+    return pool
+
+
+def get_pool(path=None):
+    """Retorna o pool de conexões compartilhado pelo processo."""
+    db_path = os.path.abspath(path or os.path.join(os.getcwd(), DB_FILENAME))
+    return _get_pool(db_path)
 
 
 def connect_db(path=None):
-    """Retorna uma conexão SQLite com o banco local.
+    """Retorna uma conexão SQLite de leitura vinda do pool do processo.
     Usa o arquivo `Frango Americano.db` por padrão. Faz tratamento de erros.
+    Chamar `close()` na conexão a devolve ao pool.
     """
     try:
-        db_path = path or os.path.join(os.getcwd(), DB_FILENAME)
-        conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False)
-        return conn
+        return get_pool(path).acquire()
     except Exception as e:
         st.error(f"Erro ao conectar ao banco de dados: {e}")
         return None
 
 
-def create_table(conn):
-    """Cria a tabela principal 'registros' se ela não existir."""
-    try:
-        sql_create_table = """
-        CREATE TABLE IF NOT EXISTS registros (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            data TEXT NOT NULL,
-            regional TEXT,
-            filial_remetente TEXT,
-            destino TEXT,
-            produto TEXT,
-            quantidade REAL,
-            unidade TEXT,
-            preco_unitario REAL,
-            valor_total REAL,
-            nfe TEXT,
-            observacoes TEXT,
-            tipo_operacao TEXT,
-            data_lancamento DATETIME DEFAULT CURRENT_TIMESTAMP,
-            usuario_lancamento TEXT
-        );
-        """
+@contextmanager
+def write_transaction(conn):
+    """
+    Abre uma transação de escrita e entrega um cursor.
+    Se `conn` veio do pool, a escrita é feita pelo escritor único do processo;
+    caso contrário, usa a própria conexão. Faz commit ao final ou rollback em caso de erro.
+    """
+    pool = getattr(conn, "pool", None)
+    if pool is not None:
+        with pool.transaction() as cursor:
+            yield cursor
+    else:
         cursor = conn.cursor()
-        cursor.execute(sql_create_table)
-        conn.commit()
-    except Exception as e:
-        st.error(f"Erro ao criar a tabela de registros: {e}")
+        try:
+            yield cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
 
-def create_settings_tables(conn):
-    """Cria as tabelas para as listas de opções (regionais, produtos, etc.)."""
-    # Nomes das tabelas usados na página de Configurações
-    setting_tables = ["regionais", "filiais", "destinos", "produtos", "unidades"]
-    try:
-        cursor = conn.cursor()
-        for table_name in setting_tables:
-            cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            );
-            """)
-        conn.commit()
-    except Exception as e:
-        st.error(f"Erro ao criar tabelas de configuração: {e}")
 
-def create_users_table(conn):
-    """Cria a tabela 'users' para autenticação se ela não existir."""
-    try:
-        sql_create_users_table = """
-        CREATE TABLE IF NOT EXISTS users (
+# --- Migrações de Esquema ---
+# Cada passo recebe um cursor dentro de uma transação de escrita e é aplicado
+# uma única vez, em ordem. A versão aplicada fica gravada em PRAGMA user_version.
+
+# Nomes das tabelas usados na página de Configurações
+SETTINGS_TABLES = ["regionais", "filiais", "destinos", "produtos", "unidades"]
+
+def _migration_create_base_tables(cursor):
+    """Cria as tabelas principais: registros, listas de opções, usuários e log."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS registros (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT NOT NULL,
+        regional TEXT,
+        filial_remetente TEXT,
+        destino TEXT,
+        produto TEXT,
+        quantidade REAL,
+        unidade TEXT,
+        preco_unitario REAL,
+        valor_total REAL,
+        nfe TEXT,
+        observacoes TEXT,
+        tipo_operacao TEXT,
+        data_lancamento DATETIME DEFAULT CURRENT_TIMESTAMP,
+        usuario_lancamento TEXT
+    );
+    """)
+    for table_name in SETTINGS_TABLES:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL
+            name TEXT NOT NULL UNIQUE
         );
-        """
-        cursor = conn.cursor()
-        cursor.execute(sql_create_users_table)
-        conn.commit()
-    except Exception as e:
-        st.error(f"Erro ao criar a tabela de usuários: {e}")
+        """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        password_hash TEXT NOT NULL
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS activity_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        user_name TEXT NOT NULL,
+        action TEXT NOT NULL,
+        details TEXT
+    );
+    """)
+
+def _migration_add_registros_columns(cursor):
+    """Adiciona à tabela 'registros' colunas que possam faltar em bancos de dados mais antigos."""
+    cursor.execute("PRAGMA table_info(registros);")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    if "nfe" not in existing_columns:
+        cursor.execute("ALTER TABLE registros ADD COLUMN nfe TEXT")
+    if "observacoes" not in existing_columns:
+        cursor.execute("ALTER TABLE registros ADD COLUMN observacoes TEXT")
+    if "tipo_operacao" not in existing_columns:
+        cursor.execute("ALTER TABLE registros ADD COLUMN tipo_operacao TEXT")
+    if "data_lancamento" not in existing_columns:
+        # Sem valor padrão para compatibilidade com versões mais antigas do SQLite.
+        # O valor será NULL para registros antigos, o que é tratado pela aplicação.
+        cursor.execute("ALTER TABLE registros ADD COLUMN data_lancamento DATETIME")
+    if "usuario_lancamento" not in existing_columns:
+        cursor.execute("ALTER TABLE registros ADD COLUMN usuario_lancamento TEXT DEFAULT 'N/A'")
 
-def create_log_table(conn):
-    """Cria a tabela 'activity_log' para registrar as ações dos usuários."""
+def _migration_add_user_role(cursor):
+    """Adiciona a coluna 'role' aos usuários e define o 'Administrador' como 'Admin'."""
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if "role" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'User' NOT NULL")
+        cursor.execute("UPDATE users SET role = 'Admin' WHERE username = 'Administrador'")
+
+# Campos de 'registros' indexados pela busca textual, na ordem das colunas do FTS5.
+SEARCH_COLUMNS = [
+    "regional", "filial_remetente", "destino", "produto",
+    "unidade", "nfe", "tipo_operacao", "usuario_lancamento",
+]
+
+def _plain_value(prefix, column):
+    """Expressão SQL do valor de uma coluna em um trigger (ex: 'new.regional')."""
+    return f"{prefix}.{column}"
+
+def _create_search_triggers(cursor, table, value=_plain_value):
+    """
+    Cria os triggers que mantêm 'registros_fts' sincronizado com `table`.
+    `value(prefix, coluna)` retorna a expressão SQL do texto indexado de cada coluna.
+    """
+    columns = ", ".join(SEARCH_COLUMNS)
+
+    def values(prefix):
+        return ", ".join(value(prefix, column) for column in SEARCH_COLUMNS)
+
+    insert_new = f"INSERT INTO registros_fts(rowid, {columns}) VALUES (new.id, {values('new')});"
+    delete_old = (
+        f"INSERT INTO registros_fts(registros_fts, rowid, {columns}) "
+        f"VALUES ('delete', old.id, {values('old')});"
+    )
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS registros_fts_ai AFTER INSERT ON {table} BEGIN {insert_new} END;")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS registros_fts_ad AFTER DELETE ON {table} BEGIN {delete_old} END;")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS registros_fts_au AFTER UPDATE ON {table} BEGIN {delete_old} {insert_new} END;")
+
+def _migration_create_search_index(cursor):
+    """
+    Cria o índice de busca textual (FTS5) sobre os campos pesquisáveis de 'registros'
+    e os triggers que o mantêm sincronizado em inserções, edições e exclusões.
+    """
     try:
-        sql_create_log_table = """
-        CREATE TABLE IF NOT EXISTS activity_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            user_name TEXT NOT NULL,
-            action TEXT NOT NULL,
-            details TEXT
+        cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS registros_fts USING fts5(
+            {", ".join(SEARCH_COLUMNS)},
+            content='registros', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
         );
-        """
-        cursor = conn.cursor()
-        cursor.execute(sql_create_log_table)
-        conn.commit()
-    except Exception as e:
-        st.error(f"Erro ao criar a tabela de log: {e}")
+        """)
+    except sqlite3.OperationalError:
+        # SQLite compilado sem FTS5: a busca continua funcionando com LIKE.
+        return
+    _create_search_triggers(cursor, "registros")
+    # Indexa os registros já existentes.
+    cursor.execute("INSERT INTO registros_fts(registros_fts) VALUES ('rebuild')")
+
+def _create_stats_triggers(cursor, table, stats_name):
+    """Cria os triggers que atualizam a linha `stats_name` de 'table_stats' a cada escrita em `table`."""
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {stats_name}_stats_ai AFTER INSERT ON {table} BEGIN
+        UPDATE table_stats SET row_count = row_count + 1, version = version + 1 WHERE name = '{stats_name}';
+    END;
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {stats_name}_stats_ad AFTER DELETE ON {table} BEGIN
+        UPDATE table_stats SET row_count = row_count - 1, version = version + 1 WHERE name = '{stats_name}';
+    END;
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {stats_name}_stats_au AFTER UPDATE ON {table} BEGIN
+        UPDATE table_stats SET version = version + 1 WHERE name = '{stats_name}';
+    END;
+    """)
+
+def _migration_create_table_stats(cursor):
+    """
+    Cria a tabela 'table_stats', com a contagem de linhas e um número de versão
+    (geração de escrita) por tabela, mantidos por triggers em 'registros'.
+    A versão aumenta a cada inserção, edição ou exclusão e serve para invalidar caches.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS table_stats (
+        name TEXT PRIMARY KEY,
+        row_count INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    cursor.execute("""
+    INSERT OR REPLACE INTO table_stats (name, row_count, version)
+    VALUES ('registros', (SELECT COUNT(*) FROM registros), 0);
+    """)
+    _create_stats_triggers(cursor, "registros", "registros")
+
+# Dimensões da tabela de resumo diário, na ordem da chave primária.
+ROLLUP_DIMENSIONS = [
+    "regional", "filial_remetente", "destino", "produto",
+    "tipo_operacao", "unidade", "usuario_lancamento",
+]
+
+def _create_rollup_triggers(cursor, table, watched_columns, value=_plain_value):
+    """
+    Cria os triggers que mantêm 'registros_daily' atualizado a cada escrita em `table`.
+    `watched_columns` são as colunas cuja edição altera o resumo; `value(prefix, coluna)`
+    retorna a expressão SQL do valor de cada coluna de 'registros'.
+    """
+    dims = ", ".join(ROLLUP_DIMENSIONS)
+
+    def key_values(prefix):
+        return ", ".join(f"COALESCE({value(prefix, dim)}, '')" for dim in ROLLUP_DIMENSIONS)
+
+    def key_match(prefix):
+        return " AND ".join(
+            [f"data = {prefix}.data"] + [f"{dim} = COALESCE({value(prefix, dim)}, '')" for dim in ROLLUP_DIMENSIONS]
+        )
+
+    def measures(prefix):
+        return ", ".join(
+            f"COALESCE(CAST({prefix}.{col} AS REAL), 0)" for col in ("quantidade", "valor_total", "preco_unitario")
+        )
+
+    add_row = f"""
+        INSERT INTO registros_daily (data, {dims}, quantidade, valor_total, soma_preco_unitario, num_registros)
+        VALUES (new.data, {key_values("new")}, {measures("new")}, 1)
+        ON CONFLICT (data, {dims}) DO UPDATE SET
+            quantidade = quantidade + excluded.quantidade,
+            valor_total = valor_total + excluded.valor_total,
+            soma_preco_unitario = soma_preco_unitario + excluded.soma_preco_unitario,
+            num_registros = num_registros + 1;
+    """
+    remove_row = f"""
+        UPDATE registros_daily SET
+            quantidade = quantidade - COALESCE(CAST(old.quantidade AS REAL), 0),
+            valor_total = valor_total - COALESCE(CAST(old.valor_total AS REAL), 0),
+            soma_preco_unitario = soma_preco_unitario - COALESCE(CAST(old.preco_unitario AS REAL), 0),
+            num_registros = num_registros - 1
+        WHERE {key_match("old")};
+        DELETE FROM registros_daily WHERE {key_match("old")} AND num_registros <= 0;
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS registros_daily_ai AFTER INSERT ON {table} BEGIN {add_row} END;")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS registros_daily_ad AFTER DELETE ON {table} BEGIN {remove_row} END;")
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS registros_daily_au
+    AFTER UPDATE OF {", ".join(watched_columns)} ON {table}
+    BEGIN {remove_row} {add_row} END;
+    """)
+
+def _migration_create_daily_rollup(cursor):
+    """
+    Cria a tabela 'registros_daily', com os totais por dia e combinação de dimensões,
+    e os triggers que a mantêm atualizada a cada inserção, edição ou exclusão em 'registros'.
+    Valores NULL nas dimensões são gravados como '' para que a chave agrupe corretamente.
+    """
+    dims = ", ".join(ROLLUP_DIMENSIONS)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS registros_daily (
+        data TEXT NOT NULL,
+        {" ".join(f"{dim} TEXT NOT NULL DEFAULT ''," for dim in ROLLUP_DIMENSIONS)}
+        quantidade REAL NOT NULL DEFAULT 0,
+        valor_total REAL NOT NULL DEFAULT 0,
+        soma_preco_unitario REAL NOT NULL DEFAULT 0,
+        num_registros INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (data, {dims})
+    ) WITHOUT ROWID;
+    """)
+    _create_rollup_triggers(
+        cursor, "registros", ["data"] + ROLLUP_DIMENSIONS + ["quantidade", "valor_total", "preco_unitario"]
+    )
+
+    # Carga inicial a partir dos registros existentes.
+    cursor.execute("DELETE FROM registros_daily")
+    cursor.execute(f"""
+    INSERT INTO registros_daily (data, {dims}, quantidade, valor_total, soma_preco_unitario, num_registros)
+    SELECT data, {", ".join(f"COALESCE({dim}, '')" for dim in ROLLUP_DIMENSIONS)},
+           SUM(COALESCE(CAST(quantidade AS REAL), 0)), SUM(COALESCE(CAST(valor_total AS REAL), 0)),
+           SUM(COALESCE(CAST(preco_unitario AS REAL), 0)), COUNT(*)
+    FROM registros
+    GROUP BY 1, {", ".join(str(i) for i in range(2, len(ROLLUP_DIMENSIONS) + 2))}
+    """)
+
+def _migration_add_settings_versions(cursor):
+    """
+    Estende 'table_stats' às tabelas de configuração, para que cada lista de opções
+    também tenha sua versão de dados, atualizada por triggers a cada escrita.
+    """
+    for table_name in SETTINGS_TABLES:
+        cursor.execute(
+            f"INSERT OR REPLACE INTO table_stats (name, row_count, version) "
+            f"VALUES (?, (SELECT COUNT(*) FROM {table_name}), 0)",
+            (table_name,)
+        )
+        _create_stats_triggers(cursor, table_name, table_name)
+
+# Colunas de 'registros' normalizadas: coluna -> tabela de configuração referenciada.
+# Em 'registros_base' cada uma vira '<coluna>_id', uma chave inteira para a tabela.
+DIMENSION_TABLES = {
+    "regional": "regionais",
+    "filial_remetente": "filiais",
+    "destino": "destinos",
+    "produto": "produtos",
+    "unidade": "unidades",
+}
+
+# Colunas de 'registros', na ordem exposta pela view.
+REGISTROS_COLUMNS = [
+    "id", "data", "regional", "filial_remetente", "destino", "produto", "quantidade", "unidade",
+    "preco_unitario", "valor_total", "nfe", "observacoes", "tipo_operacao", "data_lancamento",
+    "usuario_lancamento",
+]
+
+def base_column(column):
+    """Nome da coluna correspondente em 'registros_base' (ex: 'regional' -> 'regional_id')."""
+    return f"{column}_id" if column in DIMENSION_TABLES else column
+
+def _dimension_value(prefix, column):
+    """Expressão SQL do valor de uma coluna de 'registros' a partir de uma linha de 'registros_base'."""
+    if column in DIMENSION_TABLES:
+        return f"(SELECT name FROM {DIMENSION_TABLES[column]} WHERE id = {prefix}.{base_column(column)})"
+    return f"{prefix}.{column}"
+
+def _dimension_id(prefix, column):
+    """Expressão SQL que converte o nome recebido pela view na chave da tabela de configuração."""
+    return f"(SELECT id FROM {DIMENSION_TABLES[column]} WHERE name = {prefix}.{column})"
+
+def _create_base_triggers(cursor):
+    """Cria os triggers de contadores, resumo diário e busca de 'registros_base' que ainda não existirem."""
+    _create_stats_triggers(cursor, "registros_base", "registros")
+    _create_rollup_triggers(
+        cursor, "registros_base",
+        ["data"] + [base_column(dim) for dim in ROLLUP_DIMENSIONS] + ["quantidade", "valor_total", "preco_unitario"],
+        value=_dimension_value,
+    )
+    if has_search_index(cursor):
+        _create_search_triggers(cursor, "registros_base", value=_dimension_value)
+
+def _migration_normalize_dimensions(cursor):
+    """
+    Substitui os textos repetidos de regional, filial, destino, produto e unidade por chaves
+    inteiras para as tabelas de configuração correspondentes.
+    - As linhas passam para 'registros_base', com as colunas '<coluna>_id';
+    - 'registros' vira uma view com os nomes e colunas de sempre, então as consultas continuam
+      iguais. Inserções e edições na view cadastram automaticamente as opções novas;
+    - Renomear uma opção é um UPDATE de uma linha na tabela de configuração; os triggers
+      de renomeação só ajustam o resumo diário e o índice de busca.
+    """
+    # 1. Cadastra nas tabelas de configuração todos os valores usados nos registros.
+    for column, table_name in DIMENSION_TABLES.items():
+        cursor.execute(f"""
+        INSERT OR IGNORE INTO {table_name} (name)
+        SELECT DISTINCT {column} FROM registros WHERE NULLIF({column}, '') IS NOT NULL
+        """)
+
+    # 2. Copia as linhas para a nova tabela, preservando IDs e a sequência do autoincremento.
+    cursor.execute("""
+    CREATE TABLE registros_base (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT NOT NULL,
+        regional_id INTEGER REFERENCES regionais (id),
+        filial_remetente_id INTEGER REFERENCES filiais (id),
+        destino_id INTEGER REFERENCES destinos (id),
+        produto_id INTEGER REFERENCES produtos (id),
+        quantidade REAL,
+        unidade_id INTEGER REFERENCES unidades (id),
+        preco_unitario REAL,
+        valor_total REAL,
+        nfe TEXT,
+        observacoes TEXT,
+        tipo_operacao TEXT,
+        data_lancamento DATETIME DEFAULT CURRENT_TIMESTAMP,
+        usuario_lancamento TEXT
+    );
+    """)
+    base_columns = ", ".join(base_column(column) for column in REGISTROS_COLUMNS)
+    cursor.execute(f"""
+    INSERT INTO registros_base ({base_columns})
+    SELECT {", ".join(_dimension_id("registros", c) if c in DIMENSION_TABLES else c for c in REGISTROS_COLUMNS)}
+    FROM registros
+    """)
+    last_id = cursor.execute(
+        "SELECT MAX(seq) FROM sqlite_sequence WHERE name IN ('registros', 'registros_base')"
+    ).fetchone()[0]
+
+    # 3. Remove a tabela antiga. Os triggers saem antes, para que o resumo diário,
+    #    a busca e os contadores não sejam alterados pela exclusão.
+    for trigger in ("registros_fts", "registros_stats", "registros_daily"):
+        for suffix in ("ai", "ad", "au"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}_{suffix}")
+    cursor.execute("DROP TABLE registros")
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('registros', 'registros_base')")
+    if last_id is not None:
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('registros_base', ?)", (last_id,))
+
+    # 4. View de compatibilidade com as colunas e nomes de sempre.
+    view_columns = ",\n        ".join(
+        f"{DIMENSION_TABLES[column]}.name AS {column}" if column in DIMENSION_TABLES
+        else f"registros_base.{column} AS {column}"
+        for column in REGISTROS_COLUMNS
+    )
+    joins = "\n    ".join(
+        f"LEFT JOIN {table_name} ON {table_name}.id = registros_base.{base_column(column)}"
+        for column, table_name in DIMENSION_TABLES.items()
+    )
+    cursor.execute(f"""
+    CREATE VIEW registros AS
+    SELECT
+        {view_columns}
+    FROM registros_base
+    {joins}
+    """)
+
+    register_options = " ".join(
+        f"INSERT OR IGNORE INTO {table_name} (name) SELECT new.{column} WHERE NULLIF(new.{column}, '') IS NOT NULL;"
+        for column, table_name in DIMENSION_TABLES.items()
+    )
+
+    def new_value(column):
+        if column in DIMENSION_TABLES:
+            return _dimension_id("new", column)
+        if column == "data_lancamento":
+            return "COALESCE(new.data_lancamento, CURRENT_TIMESTAMP)"
+        return f"new.{column}"
+
+    cursor.execute(f"""
+    CREATE TRIGGER registros_view_insert INSTEAD OF INSERT ON registros BEGIN
+        {register_options}
+        INSERT INTO registros_base ({base_columns})
+        VALUES ({", ".join(new_value(column) for column in REGISTROS_COLUMNS)});
+    END;
+    """)
+    assignments = ", ".join(
+        f"{base_column(column)} = {new_value(column) if column in DIMENSION_TABLES else f'new.{column}'}"
+        for column in REGISTROS_COLUMNS if column != "id"
+    )
+    cursor.execute(f"""
+    CREATE TRIGGER registros_view_update INSTEAD OF UPDATE ON registros BEGIN
+        {register_options}
+        UPDATE registros_base SET {assignments} WHERE id = old.id;
+    END;
+    """)
+    cursor.execute("""
+    CREATE TRIGGER registros_view_delete INSTEAD OF DELETE ON registros BEGIN
+        DELETE FROM registros_base WHERE id = old.id;
+    END;
+    """)
+
+    # 5. Contadores, resumo diário e busca passam a acompanhar a tabela base.
+    _create_base_triggers(cursor)
+    has_fts = has_search_index(cursor)
+
+    # 6. Renomear uma opção atualiza o resumo diário e reindexa na busca apenas os
+    #    registros que a usam; a tabela base não é reescrita.
+    for column, table_name in DIMENSION_TABLES.items():
+        affected = f"id IN (SELECT id FROM registros_base WHERE {base_column(column)} = new.id)"
+        search_sql = ""
+        if has_fts:
+            columns = ", ".join(SEARCH_COLUMNS)
+            old_values = ", ".join("old.name" if c == column else c for c in SEARCH_COLUMNS)
+            search_sql = f"""
+            INSERT INTO registros_fts(registros_fts, rowid, {columns})
+            SELECT 'delete', id, {old_values} FROM registros WHERE {affected};
+            INSERT INTO registros_fts(rowid, {columns}) SELECT id, {columns} FROM registros WHERE {affected};
+            """
+        cursor.execute(f"""
+        CREATE TRIGGER {table_name}_rename_au AFTER UPDATE OF name ON {table_name}
+        WHEN old.name IS NOT new.name BEGIN
+            UPDATE registros_daily SET {column} = new.name WHERE {column} = old.name;
+            {search_sql}
+            UPDATE table_stats SET version = version + 1 WHERE name = 'registros';
+        END;
+        """)
+
+# Campos que identificam o conteúdo de uma linha importada (ver import_hash).
+IMPORT_HASH_COLUMNS = ["data", "filial_remetente", "produto", "destino", "quantidade", "preco_unitario", "nfe"]
+
+def import_hash(values, occurrence=0):
+    """
+    Impressão digital (SHA-256) de uma linha, a partir dos valores de IMPORT_HASH_COLUMNS.
+    Os valores são normalizados antes: vazio e NULL se equivalem, números comparam pelo valor
+    (10 e 10.0 dão o mesmo hash) e textos ignoram espaços nas pontas e maiúsculas.
+    `occurrence` é a ordem da linha entre as de mesmo conteúdo no arquivo (0 para a primeira):
+    linhas iguais repetidas de propósito recebem hashes distintos e são todas gravadas, e
+    reenviar o arquivo continua sem duplicar nenhuma. A primeira ocorrência mantém o hash
+    calculado antes da contagem existir.
+    """
+    parts = []
+    for value in values:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            parts.append("")
+        elif isinstance(value, (int, float)):
+            parts.append(repr(float(value)))
+        else:
+            parts.append(str(value).strip().casefold())
+    if occurrence:
+        parts.append(f"#{occurrence}")
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def _migration_add_import_hash(cursor):
+    """
+    Adiciona a 'registros_base' a coluna 'hash_importacao' (ver import_hash) com um índice
+    único, para que reimportar a mesma planilha não duplique registros. Registros lançados
+    pelo formulário ficam sem hash. Os registros existentes recebem o hash do seu conteúdo;
+    se já houver linhas repetidas, apenas a mais antiga fica com ele.
+    """
+    cursor.execute("ALTER TABLE registros_base ADD COLUMN hash_importacao TEXT")
+    hashes = {}
+    for row in cursor.execute(f"SELECT id, {', '.join(IMPORT_HASH_COLUMNS)} FROM registros ORDER BY id").fetchall():
+        hashes.setdefault(import_hash(row[1:]), row[0])
+    # Um único UPDATE, para que os triggers de busca não reindexem linha a linha.
+    cursor.execute("CREATE TEMP TABLE import_hashes (id INTEGER PRIMARY KEY, hash TEXT NOT NULL)")
+    cursor.executemany("INSERT INTO import_hashes (hash, id) VALUES (?, ?)", hashes.items())
+    cursor.execute("""
+    UPDATE registros_base SET hash_importacao = import_hashes.hash
+    FROM import_hashes WHERE import_hashes.id = registros_base.id
+    """)
+    cursor.execute("DROP TABLE import_hashes")
+    # Fora de MANAGED_INDEXES: é uma restrição, e não pode sair em deferred_indexes.
+    cursor.execute("""
+    CREATE UNIQUE INDEX uq_registros_hash_importacao ON registros_base (hash_importacao)
+    WHERE hash_importacao IS NOT NULL
+    """)
+
+def _migration_create_import_jobs(cursor):
+    """
+    Cria a tabela 'import_jobs', a fila das importações de planilhas feitas em segundo plano:
+    o arquivo enviado, a situação, o progresso, os totais e o relatório de erros de cada uma.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT NOT NULL,
+        user_name TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendente',
+        file_data BLOB,
+        total_rows INTEGER NOT NULL DEFAULT 0,
+        rows_read INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        duplicates INTEGER NOT NULL DEFAULT 0,
+        invalid INTEGER NOT NULL DEFAULT 0,
+        rule_counts TEXT,
+        chunk_errors TEXT,
+        error_report BLOB,
+        message TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        started_at DATETIME,
+        finished_at DATETIME
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS import_jobs_status ON import_jobs (status)")
+
+def _migration_hash_repeated_rows(cursor):
+    """
+    Completa o hash das linhas repetidas que a migração 9 deixou sem ele (só a mais antiga de
+    cada conteúdo o recebeu): as demais, em ordem de id, recebem o hash da 2ª, 3ª... ocorrência
+    (ver import_hash). Registros de conteúdo único lançados pelo formulário continuam sem hash.
+    """
+    rows = cursor.execute(f"""
+    SELECT r.id, b.hash_importacao, {', '.join(f'r.{col}' for col in IMPORT_HASH_COLUMNS)}
+    FROM registros r JOIN registros_base b ON b.id = r.id ORDER BY r.id
+    """).fetchall()
+    existing = {row[1] for row in rows if row[1] is not None}
+    next_occurrence, hashes = {}, {}
+    for row_id, row_hash, *values in rows:
+        if row_hash is not None:
+            continue
+        content_hash = import_hash(values)
+        if content_hash not in existing:
+            continue
+        occurrence = next_occurrence.get(content_hash, 1)
+        while import_hash(values, occurrence) in existing:
+            occurrence += 1
+        hashes[row_id] = import_hash(values, occurrence)
+        existing.add(hashes[row_id])
+        next_occurrence[content_hash] = occurrence + 1
+    cursor.execute("CREATE TEMP TABLE import_hashes (id INTEGER PRIMARY KEY, hash TEXT NOT NULL)")
+    cursor.executemany("INSERT INTO import_hashes (id, hash) VALUES (?, ?)", hashes.items())
+    cursor.execute("""
+    UPDATE registros_base SET hash_importacao = import_hashes.hash
+    FROM import_hashes WHERE import_hashes.id = registros_base.id
+    """)
+    cursor.execute("DROP TABLE import_hashes")
+
+def _migration_create_bulk_loads(cursor):
+    """
+    Cria a tabela 'bulk_loads', com as cargas em massa em andamento (ver deferred_triggers):
+    quem as executa, o último sinal de vida e até que id de 'registros_base' os contadores,
+    o resumo diário e a busca já foram atualizados.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS bulk_loads (
+        owner TEXT PRIMARY KEY,
+        covered_id INTEGER NOT NULL,
+        heartbeat DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+# Lista ordenada de (versão, descrição, passo). Novos passos entram sempre no final.
+MIGRATIONS = [
+    (1, "Tabelas iniciais", _migration_create_base_tables),
+    (2, "Colunas adicionais em registros", _migration_add_registros_columns),
+    (3, "Função (role) dos usuários", _migration_add_user_role),
+    (4, "Índice de busca textual (FTS5)", _migration_create_search_index),
+    (5, "Contadores de linhas e versão de dados", _migration_create_table_stats),
+    (6, "Resumo diário de registros (registros_daily)", _migration_create_daily_rollup),
+    (7, "Versão de dados das tabelas de configuração", _migration_add_settings_versions),
+    (8, "Chaves inteiras para as dimensões de registros", _migration_normalize_dimensions),
+    (9, "Hash de conteúdo para importações sem duplicatas", _migration_add_import_hash),
+    (10, "Fila de importações em segundo plano", _migration_create_import_jobs),
+    (11, "Hash das linhas repetidas", _migration_hash_repeated_rows),
+    (12, "Cargas em massa em andamento", _migration_create_bulk_loads),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    """Retorna a versão de esquema gravada no banco (PRAGMA user_version)."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
 
 def run_migrations(conn):
     """
     Garante que a estrutura do banco de dados esteja atualizada.
-    Adiciona colunas que possam estar faltando em bancos de dados mais antigos.
+    Aplica apenas os passos com versão maior que a gravada no banco; quando o
+    banco já está na versão atual, custa uma única leitura de PRAGMA.
+    Cada passo roda em sua própria transação: se um falhar, ele é desfeito, os anteriores
+    ficam gravados e a exceção é propagada (a próxima chamada retoma a partir dele).
+    """
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+    for version, description, step in MIGRATIONS:
+        try:
+            with write_transaction(conn) as cursor:
+                # Confere a versão dentro da transação para não reaplicar um passo
+                # que outro processo tenha acabado de aplicar.
+                current_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                if version <= current_version:
+                    continue
+                step(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+        except Exception as e:
+            raise RuntimeError(f"falha na migração {version} ({description}): {e}") from e
+
+
+# --- Índices Secundários ---
+# Índices mantidos pela aplicação: nome -> (tabela, colunas). Índices com o prefixo
+# 'idx_' que não estejam nesta lista são considerados obsoletos e removidos.
+MANAGED_INDEXES = {
+    # Filtro de período e MIN/MAX(data) do seletor de datas.
+    "idx_registros_data": ("registros_base", "data"),
+    # Período + filtros mais usados.
+    "idx_registros_data_regional_produto": ("registros_base", "data, regional_id, produto_id"),
+    # Filtros de igualdade, renomeação de opções e verificação das chaves estrangeiras.
+    "idx_registros_regional": ("registros_base", "regional_id"),
+    "idx_registros_filial_remetente": ("registros_base", "filial_remetente_id"),
+    "idx_registros_destino": ("registros_base", "destino_id"),
+    "idx_registros_produto": ("registros_base", "produto_id"),
+    "idx_registros_unidade": ("registros_base", "unidade_id"),
+    "idx_registros_tipo_operacao": ("registros_base", "tipo_operacao"),
+    "idx_registros_usuario_lancamento": ("registros_base", "usuario_lancamento"),
+}
+
+def _index_sql(name, table, columns):
+    """Monta o CREATE INDEX no mesmo formato que o SQLite grava em sqlite_master."""
+    return f"CREATE INDEX {name} ON {table} ({columns})"
+
+def ensure_indexes(conn):
+    """
+    Sincroniza os índices do banco com MANAGED_INDEXES: cria os que faltam,
+    recria os que tiveram a definição alterada e remove os obsoletos.
+    Retorna True se algum índice foi alterado.
     """
     try:
-        cursor = conn.cursor()
-        # Obtém informações sobre as colunas da tabela 'registros'
-        cursor.execute("PRAGMA table_info(registros);")
-        existing_columns = [row[1] for row in cursor.fetchall()]
-
-        # Define as colunas que devem existir e seus tipos
-        all_columns = {
-            "nfe": "TEXT",
-            "observacoes": "TEXT",
-            "tipo_operacao": "TEXT",
-            "data_lancamento": "DATETIME",
-            "usuario_lancamento": "TEXT"
-        }
-
-        for col, col_type in all_columns.items():
-            if col not in existing_columns:
-                st.info(f"Atualizando banco de dados: Adicionando coluna '{col}'...")
-                if col == 'data_lancamento':
-                    # Adiciona a coluna sem um valor padrão para compatibilidade com versões mais antigas do SQLite.
-                    # O valor será NULL para registros antigos, o que é tratado pela aplicação.
-                    cursor.execute(f"ALTER TABLE registros ADD COLUMN {col} {col_type}")
-                elif col == 'usuario_lancamento':
-                    cursor.execute(f"ALTER TABLE registros ADD COLUMN {col} {col_type} DEFAULT 'N/A'")
-                else:
-                    cursor.execute(f"ALTER TABLE registros ADD COLUMN {col} {col_type}")
-        conn.commit()
+        existing = dict(conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'"
+        ).fetchall())
+        changed = False
+        with write_transaction(conn) as cursor:
+            for name in existing:
+                if name not in MANAGED_INDEXES:
+                    cursor.execute(f"DROP INDEX IF EXISTS {name}")
+                    changed = True
+            for name, (table, columns) in MANAGED_INDEXES.items():
+                expected_sql = _index_sql(name, table, columns)
+                if existing.get(name) == expected_sql:
+                    continue
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+                cursor.execute(expected_sql)
+                changed = True
+        return changed
     except Exception as e:
-        st.error(f"Erro ao executar migrações no banco de dados: {e}")
\ No newline at end of file
+        st.error(f"Erro ao atualizar os índices do banco de dados: {e}")
+        return False
+
+# Triggers por linha que a inserção em massa troca por uma atualização por lote.
+BULK_SUSPENDED_TRIGGERS = ["registros_stats_ai", "registros_daily_ai", "registros_fts_ai"]
+
+# Uma carga em massa sem sinal de vida (gravado a cada lote) há mais que isso é dada como
+# interrompida (ex: o processo caiu) e deixa de impedir o reparo em ensure_base_triggers.
+BULK_LOAD_STALE_SECONDS = 600
+
+def _bulk_load_owner():
+    """Identifica a carga em massa desta thread em 'bulk_loads' (máquina, processo e thread)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def _bulk_covered_id(cursor):
+    """
+    Enquanto houver uma carga em massa em andamento (em qualquer processo), o maior id de
+    'registros_base' já refletido nos contadores, no resumo diário e na busca; senão, None.
+    """
+    return cursor.execute("SELECT MAX(covered_id) FROM bulk_loads").fetchone()[0]
+
+def _delete_stale_bulk_loads(cursor):
+    """Remove de 'bulk_loads' as cargas sem sinal de vida há mais de BULK_LOAD_STALE_SECONDS."""
+    cursor.execute(
+        "DELETE FROM bulk_loads WHERE heartbeat < datetime('now', ?)", (f"-{BULK_LOAD_STALE_SECONDS} seconds",)
+    )
+
+def _add_to_derived_tables(cursor, after_id):
+    """
+    Atualiza, com um comando por conjunto, os contadores, o resumo diário e a busca com as
+    linhas de 'registros_base' de id maior que `after_id`. Retorna o maior id incluído.
+    """
+    inserted, last_id = cursor.execute(
+        "SELECT COUNT(*), COALESCE(MAX(id), ?) FROM registros_base WHERE id > ?", (after_id, after_id)
+    ).fetchone()
+    if inserted == 0:
+        return after_id
+    cursor.execute(
+        "UPDATE table_stats SET row_count = row_count + ?, version = version + 1 WHERE name = 'registros'",
+        (inserted,)
+    )
+    dims = ", ".join(ROLLUP_DIMENSIONS)
+    cursor.execute(f"""
+    INSERT INTO registros_daily (data, {dims}, quantidade, valor_total, soma_preco_unitario, num_registros)
+    SELECT data, {", ".join(f"COALESCE({dim}, '')" for dim in ROLLUP_DIMENSIONS)},
+           SUM(COALESCE(CAST(quantidade AS REAL), 0)), SUM(COALESCE(CAST(valor_total AS REAL), 0)),
+           SUM(COALESCE(CAST(preco_unitario AS REAL), 0)), COUNT(*)
+    FROM registros
+    WHERE id > ?
+    GROUP BY 1, {", ".join(str(i) for i in range(2, len(ROLLUP_DIMENSIONS) + 2))}
+    ON CONFLICT (data, {dims}) DO UPDATE SET
+        quantidade = quantidade + excluded.quantidade,
+        valor_total = valor_total + excluded.valor_total,
+        soma_preco_unitario = soma_preco_unitario + excluded.soma_preco_unitario,
+        num_registros = num_registros + excluded.num_registros
+    """, (after_id,))
+    if has_search_index(cursor):
+        columns = ", ".join(SEARCH_COLUMNS)
+        cursor.execute(
+            f"INSERT INTO registros_fts(rowid, {columns}) SELECT id, {columns} FROM registros WHERE id > ?",
+            (after_id,)
+        )
+    return last_id
+
+def bulk_insert_base_rows(cursor, columns, rows):
+    """
+    Insere `rows` (tuplas na ordem de `columns`) em 'registros_base' com executemany, na
+    transação de `cursor`, e retorna quantas foram gravadas: linhas cujo 'hash_importacao'
+    já existe são ignoradas (ON CONFLICT DO NOTHING). Durante uma carga em massa (ver
+    deferred_triggers), os contadores, o resumo diário e a busca são atualizados no fim do
+    lote com um comando por conjunto, e a carga desta thread registra seu sinal de vida;
+    fora dela, pelos triggers, linha a linha.
+    """
+    if not rows:
+        return 0
+    covered_id = _bulk_covered_id(cursor)
+    cursor.executemany(
+        f"INSERT INTO registros_base ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+        "ON CONFLICT DO NOTHING",
+        rows
+    )
+    inserted = cursor.rowcount
+    if covered_id is not None:
+        if inserted:
+            covered_id = _add_to_derived_tables(cursor, covered_id)
+            cursor.execute("UPDATE bulk_loads SET covered_id = ?", (covered_id,))
+        cursor.execute("UPDATE bulk_loads SET heartbeat = CURRENT_TIMESTAMP WHERE owner = ?", (_bulk_load_owner(),))
+    return inserted
+
+@contextmanager
+def deferred_triggers(conn):
+    """
+    Desliga os triggers AFTER INSERT de contadores, resumo diário e busca de 'registros_base'
+    (BULK_SUSPENDED_TRIGGERS) durante uma carga em massa: cada lote de bulk_insert_base_rows
+    atualiza essas tabelas por conjunto, pois no FTS5 inserções linha a linha geram um
+    segmento por comando e custam muito mais. Os triggers são removidos uma vez no início e
+    recriados uma vez no final, e não a cada lote, para não invalidar a todo momento o
+    esquema das outras conexões. Linhas gravadas por outras conexões durante a carga entram
+    no lote seguinte ou no final. Dentro de outra carga da mesma thread, não faz nada.
+
+    A carga fica registrada em 'bulk_loads', no próprio banco, para que outros processos
+    saibam que os triggers estão fora de propósito (ensure_base_triggers não os "repara") e
+    para que cargas simultâneas compartilhem a suspensão: os triggers só voltam quando a
+    última termina. Se o processo cair no meio da carga, ensure_base_triggers repara o banco
+    assim que ela ficar sem sinal de vida (BULK_LOAD_STALE_SECONDS).
+    """
+    owner = _bulk_load_owner()
+    # Só esta thread grava a sua linha, então a leitura fora da transação basta (e, dentro de
+    # outra carga, não gera um commit a mais por lote).
+    if conn.execute("SELECT 1 FROM bulk_loads WHERE owner = ?", (owner,)).fetchone() is not None:
+        yield
+        return
+    with write_transaction(conn) as cursor:
+        covered_id = _bulk_covered_id(cursor)
+        if covered_id is None:
+            for name in BULK_SUSPENDED_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            covered_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM registros_base").fetchone()[0]
+        cursor.execute("INSERT INTO bulk_loads (owner, covered_id) VALUES (?, ?)", (owner, covered_id))
+    try:
+        yield
+    finally:
+        with write_transaction(conn) as cursor:
+            covered_id = _bulk_covered_id(cursor)
+            cursor.execute("DELETE FROM bulk_loads WHERE owner = ?", (owner,))
+            _delete_stale_bulk_loads(cursor)
+            if _bulk_covered_id(cursor) is None:
+                _add_to_derived_tables(cursor, covered_id)
+                _create_base_triggers(cursor)
+
+def ensure_base_triggers(conn):
+    """
+    Recria os triggers de BULK_SUSPENDED_TRIGGERS que uma carga interrompida (ex: o servidor
+    caiu no meio de uma importação) deixou removidos, atualizando antes os contadores, o
+    resumo diário e a busca com as linhas que eles deixaram de acompanhar. Enquanto alguma
+    carga em andamento der sinal de vida em 'bulk_loads', os triggers estão fora de propósito
+    e nada é feito. Retorna True se o banco precisou ser reparado.
+    """
+    with write_transaction(conn) as cursor:
+        expected = [name for name in BULK_SUSPENDED_TRIGGERS if name != "registros_fts_ai" or has_search_index(cursor)]
+        existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        if all(name in existing for name in expected):
+            return False
+        covered_id = _bulk_covered_id(cursor)
+        _delete_stale_bulk_loads(cursor)
+        if _bulk_covered_id(cursor) is not None:
+            return False
+        if covered_id is None:
+            # Sem registro da carga: recalcula tudo a partir de 'registros_base'.
+            cursor.execute("UPDATE table_stats SET row_count = 0 WHERE name = 'registros'")
+            cursor.execute("DELETE FROM registros_daily")
+            if has_search_index(cursor):
+                cursor.execute("INSERT INTO registros_fts(registros_fts) VALUES ('delete-all')")
+            covered_id = 0
+        _add_to_derived_tables(cursor, covered_id)
+        _create_base_triggers(cursor)
+    return True
+
+@contextmanager
+def deferred_indexes(conn, table="registros_base"):
+    """
+    Remove os índices gerenciados de `table` durante uma carga muito grande e os recria
+    (com ANALYZE) ao final: montar cada índice uma vez sai mais barato que atualizá-lo a
+    cada linha inserida. Enquanto a carga roda, as consultas nessa tabela ficam mais lentas.
+    """
+    names = [name for name, (index_table, _) in MANAGED_INDEXES.items() if index_table == table]
+    with write_transaction(conn) as cursor:
+        for name in names:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    try:
+        yield
+    finally:
+        ensure_indexes(conn)
+        analyze_database(conn)
+
+def analyze_database(conn):
+    """Recalcula as estatísticas (ANALYZE) usadas pelo planejador de consultas."""
+    try:
+        with write_transaction(conn) as cursor:
+            cursor.execute("ANALYZE")
+    except Exception as e:
+        st.error(f"Erro ao analisar o banco de dados: {e}")
+
+def optimize_database(conn):
+    """Executa PRAGMA optimize, que só reanalisa as tabelas cujas estatísticas estão desatualizadas."""
+    try:
+        with write_transaction(conn) as cursor:
+            cursor.execute("PRAGMA optimize")
+    except Exception as e:
+        st.error(f"Erro ao otimizar o banco de dados: {e}")
+
+def refresh_table_stats(conn):
+    """Recalcula a contagem de linhas de 'table_stats' a partir das tabelas (ex: após manutenção manual no banco)."""
+    try:
+        with write_transaction(conn) as cursor:
+            cursor.execute("""
+            UPDATE table_stats SET row_count = (SELECT COUNT(*) FROM registros_base), version = version + 1
+            WHERE name = 'registros'
+            """)
+    except Exception as e:
+        st.error(f"Erro ao atualizar os contadores do banco de dados: {e}")
+
+def has_search_index(conn):
+    """Indica se o índice de busca textual (FTS5) de 'registros' está disponível."""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'registros_fts'").fetchone()
+    return row is not None
+
+def explain_query_plan(conn, query, params=()):
+    """Retorna as linhas de EXPLAIN QUERY PLAN de uma consulta (ex: 'SEARCH registros_base USING INDEX ...')."""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    return [row[3] for row in rows]
+
+def uses_full_scan(conn, query, params=(), table="registros_base"):
+    """Indica se a consulta percorre a tabela inteira (SCAN sem índice) em vez de usar um índice."""
+    for detail in explain_query_plan(conn, query, params):
+        if detail.startswith(f"SCAN {table}") and "INDEX" not in detail:
+            return True
+    return False
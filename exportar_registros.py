@@ -0,0 +1,78 @@
+"""
+Exportação agendada dos registros, sem abrir o aplicativo.
+
+Grava os registros com os mesmos filtros do dashboard em um dos formatos de exportação
+(xlsx, csv, csv.gz, parquet) ou no relatório gerencial com as abas de totais ('relatorio').
+Pensado para o Agendador de Tarefas do Windows ou o cron, alimentando o Power BI com um
+arquivo atualizado todos os dias. O arquivo é escrito ao lado do destino e só então
+renomeado, para que nenhum leitor veja um arquivo pela metade.
+
+Uso: python exportar_registros.py [--formato parquet] [--saida arquivo] [--inicio AAAA-MM-DD]
+     [--fim AAAA-MM-DD] [--dias N] [--regional ...] [--filial ...] [--produto ...] [--destino ...]
+     [--tipo-operacao ...] [--unidade ...] [--usuario ...] [--banco caminho.db]
+"""
+import argparse
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+import database
+import operations
+
+# Opção da linha de comando -> filtro do dashboard.
+FILTROS = {
+    'regional': 'regional', 'filial': 'branch', 'produto': 'product', 'destino': 'destination',
+    'tipo_operacao': 'operation_type', 'unidade': 'unit', 'usuario': 'user',
+}
+
+
+def ler_argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta os registros filtrados para um arquivo.")
+    parser.add_argument('--formato', choices=list(operations.EXPORT_FORMATS), default='parquet')
+    parser.add_argument('--saida', help="arquivo de destino (padrão: registros_residuos_<data>.<extensão>)")
+    parser.add_argument('--inicio', type=date.fromisoformat, help="data inicial (padrão: todos os registros)")
+    parser.add_argument('--fim', type=date.fromisoformat, help="data final (padrão: hoje)")
+    parser.add_argument('--dias', type=int, help="exporta apenas os últimos N dias até --fim")
+    for opcao in FILTROS:
+        parser.add_argument(f"--{opcao.replace('_', '-')}", dest=opcao, default="Todos")
+    parser.add_argument('--banco', help=f"arquivo do banco (padrão: {database.DB_FILENAME})")
+    return parser.parse_args(argv)
+
+
+def montar_filtros(args):
+    """Converte os argumentos no dicionário de filtros usado pelo dashboard."""
+    fim = args.fim or date.today()
+    if args.dias:
+        inicio = fim - timedelta(days=args.dias - 1)
+    else:
+        # 1900 é anterior a qualquer registro e ainda cabe nas datas do Excel (relatório).
+        inicio = args.inicio or date(1900, 1, 1)
+    filtros = dict(start_date=inicio.isoformat(), end_date=fim.isoformat())
+    filtros.update({chave: getattr(args, opcao) for opcao, chave in FILTROS.items()})
+    return filtros
+
+
+def exportar(conn, filtros, formato, saida):
+    """Grava a exportação em um arquivo temporário e o move para `saida` ao final."""
+    temporario = f"{saida}.tmp"
+    try:
+        with open(temporario, 'wb') as arquivo:
+            operations.write_dashboard_export(conn, arquivo, filtros, formato)
+        os.replace(temporario, saida)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+if __name__ == "__main__":
+    args = ler_argumentos()
+    extensao = operations.EXPORT_FORMATS[args.formato][1]
+    saida = args.saida or f"registros_residuos_{datetime.now().strftime('%Y%m%d')}.{extensao}"
+    conn = database.connect_db(args.banco)
+    if conn is None:
+        sys.exit(1)
+    try:
+        exportar(conn, montar_filtros(args), args.formato, saida)
+    finally:
+        conn.close()
+    print(f"Exportado: {saida} ({os.path.getsize(saida) / 1e6:.1f} MB)")
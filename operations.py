@@ -1,13 +1,34 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
 import sqlite3
 from sqlite3 import Error
 import io
+import csv
+import gzip
+import os
+import codecs
+import itertools
+import queue
+import tempfile
+import threading
+import json
+import contextlib
+import unicodedata
+import openpyxl
+import xlsxwriter
 import plotly.express as px
-from datetime import datetime
-import base64
+from datetime import datetime, timezone
 import hashlib
+import functools
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import database
 
 def calculate_total(quantity, unit_price):
     """Calcula o valor total a partir da quantidade e preço unitário."""
@@ -25,9 +46,8 @@ def log_activity(conn, user_name, action, details=""):
     """Registra uma atividade no log."""
     try:
         sql = "INSERT INTO activity_log (user_name, action, details) VALUES (?, ?, ?)"
-        cursor = conn.cursor()
-        cursor.execute(sql, (user_name, action, details))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (user_name, action, details))
     except Error as e:
         st.warning(f"Não foi possível registrar a atividade no log: {e}")
 
@@ -49,9 +69,8 @@ def add_user(conn, username, password, role='User'):
     try:
         password_hash = hash_password(password)
         sql = "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)"
-        cursor = conn.cursor()
-        cursor.execute(sql, (username, password_hash, role))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (username, password_hash, role))
         st.success(f"Usuário '{username}' criado com sucesso! Você já pode fazer o login.")
         return True
     except sqlite3.IntegrityError:
@@ -102,9 +121,8 @@ def update_user_password(conn, admin_user, target_user, new_password):
     try:
         new_password_hash = hash_password(new_password)
         sql = "UPDATE users SET password_hash = ? WHERE username = ?"
-        cursor = conn.cursor()
-        cursor.execute(sql, (new_password_hash, target_user))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (new_password_hash, target_user))
         log_activity(conn, admin_user, "Reset de Senha", f"Senha do usuário '{target_user}' foi resetada.")
         st.success(f"Senha do usuário '{target_user}' foi atualizada com sucesso!")
         return True
@@ -116,9 +134,8 @@ def delete_user(conn, admin_user, target_user):
     """Exclui um usuário do banco de dados."""
     try:
         sql = "DELETE FROM users WHERE username = ?"
-        cursor = conn.cursor()
-        cursor.execute(sql, (target_user,))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (target_user,))
         log_activity(conn, admin_user, "Excluir Usuário", f"Usuário '{target_user}' foi excluído.")
         st.success(f"Usuário '{target_user}' excluído com sucesso!")
     except Error as e:
@@ -128,9 +145,8 @@ def update_user_role(conn, admin_user, target_user, new_role):
     """Atualiza a função (role) de um usuário específico."""
     try:
         sql = "UPDATE users SET role = ? WHERE username = ?"
-        cursor = conn.cursor()
-        cursor.execute(sql, (new_role, target_user))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (new_role, target_user))
         log_activity(conn, admin_user, "Atualizar Função", f"Função do usuário '{target_user}' alterada para '{new_role}'.")
         st.success(f"Função do usuário '{target_user}' atualizada para '{new_role}' com sucesso!")
         return True
@@ -140,6 +156,70 @@ def update_user_role(conn, admin_user, target_user, new_role):
 
 # --- Funções de Gerenciamento de Registros ---
 
+# --- Validação de Registros ---
+def _is_blank(column):
+    """Regra: o campo de texto `column` está vazio (ou ausente)."""
+    return lambda df: df[column].fillna('').astype(str).str.strip() == ''
+
+# Regras de validação: (motivo, função que recebe o DataFrame normalizado e retorna a
+# máscara das linhas que violam a regra). As mesmas regras validam a planilha importada
+# inteira e um registro isolado (ver validate_records e validate_record).
+RECORD_VALIDATION_RULES = [
+    ("Data inválida ou em branco", lambda df: df['data'].isna()),
+    ("Quantidade inválida, não numérica ou em branco", lambda df: df['quantidade'].isna()),
+    ("Preço unitário inválido, não numérico ou em branco", lambda df: df['preco_unitario'].isna()),
+    ("Quantidade deve ser maior que zero", lambda df: df['quantidade'] <= 0),
+    ("Campo 'Tipo de Operação' obrigatório não preenchido", _is_blank('tipo_operacao')),
+    ("Campo 'Regional' obrigatório não preenchido", _is_blank('regional')),
+    ("Campo 'Produto' obrigatório não preenchido", _is_blank('produto')),
+    ("Campo 'Unidade' obrigatório não preenchido", _is_blank('unidade')),
+]
+
+# O formulário de registros também exige a filial remetente e o destino.
+FORM_VALIDATION_RULES = RECORD_VALIDATION_RULES + [
+    ("Campo 'Filial Remetente' obrigatório não preenchido", _is_blank('filial_remetente')),
+    ("Campo 'Destino' obrigatório não preenchido", _is_blank('destino')),
+]
+
+def validate_records(df, rules=RECORD_VALIDATION_RULES):
+    """
+    Aplica todas as regras a todas as linhas de uma vez, como uma matriz booleana (linha x regra).
+    Retorna (invalid_mask, reasons, rule_counts):
+    - invalid_mask: Series booleana das linhas com algum erro;
+    - reasons: Series com os motivos de cada linha inválida, separados por '; ';
+    - rule_counts: {motivo: número de linhas}, apenas das regras violadas.
+    """
+    messages = [message for message, _ in rules]
+    if len(df):
+        matrix = np.column_stack([np.asarray(check(df), dtype=bool) for _, check in rules])
+    else:
+        matrix = np.zeros((0, len(rules)), dtype=bool)
+    invalid = matrix.any(axis=1)
+    rule_counts = {message: int(count) for message, count in zip(messages, matrix.sum(axis=0)) if count}
+
+    # Cada combinação de erros vira um número (um bit por regra); o texto dos motivos é
+    # montado uma única vez por combinação distinta, e não uma vez por linha.
+    codes = matrix[invalid].astype(np.int64) @ (np.int64(1) << np.arange(len(rules), dtype=np.int64))
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    texts = np.array(
+        ["; ".join(message for bit, message in enumerate(messages) if (code >> bit) & 1) for code in unique_codes],
+        dtype=object,
+    )
+    reasons = pd.Series(texts[inverse.ravel()], index=df.index[invalid], dtype=object)
+    return pd.Series(invalid, index=df.index), reasons, rule_counts
+
+def validate_record(record, rules=FORM_VALIDATION_RULES):
+    """
+    Valida um único registro (dicionário com as colunas da tabela) com as mesmas regras
+    da importação. Retorna a lista de motivos de erro (vazia se o registro for válido).
+    """
+    df = pd.DataFrame([record])
+    df['data'] = pd.to_datetime(df['data'], errors='coerce')
+    for col in ['quantidade', 'preco_unitario']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    _, reasons, _ = validate_records(df, rules)
+    return reasons.iloc[0].split("; ") if len(reasons) else []
+
 def add_record(conn, user_name, data, tipo_operacao, regional, remetente, destino, produto, quantidade, unidade, preco_unitario, valor_total, nfe, observacoes):
     """Insere um novo registro no banco de dados."""
     # Padroniza os valores de texto para garantir consistência
@@ -153,8 +233,12 @@ def add_record(conn, user_name, data, tipo_operacao, regional, remetente, destin
     observacoes = str(observacoes).strip()
 
     # Validação de entrada para garantir a integridade dos dados
-    if not (quantidade > 0):
-        st.error("❌ Falha ao adicionar registro: A 'Quantidade' deve ser maior que zero.")
+    errors = validate_record({
+        "data": data, "tipo_operacao": tipo_operacao, "regional": regional, "produto": produto,
+        "quantidade": quantidade, "unidade": unidade, "preco_unitario": preco_unitario,
+    }, RECORD_VALIDATION_RULES)
+    if errors:
+        st.error(f"❌ Falha ao adicionar registro: {'; '.join(errors)}.")
         return False
 
     try:
@@ -187,12 +271,13 @@ def add_record(conn, user_name, data, tipo_operacao, regional, remetente, destin
 
         sql = ''' INSERT INTO registros(data, tipo_operacao, regional, filial_remetente, destino, produto, quantidade, unidade, preco_unitario, valor_total, nfe, observacoes, usuario_lancamento)
                   VALUES(:data, :tipo_operacao, :regional, :filial_remetente, :destino, :produto, :quantidade, :unidade, :preco_unitario, :valor_total, :nfe, :observacoes, :usuario_lancamento) '''
-        cursor = conn.cursor()
-        cursor.execute(sql, registro_dict)
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, registro_dict)
+            # Inserções na view 'registros' não atualizam lastrowid; o ID vem da tabela base.
+            new_id = cursor.execute("SELECT MAX(id) FROM registros_base").fetchone()[0]
         st.success(f"✅ Registro adicionado com sucesso!")
         # Log da atividade
-        log_activity(conn, user_name, "Adicionar Registro", f"ID do novo registro: {cursor.lastrowid}")
+        log_activity(conn, user_name, "Adicionar Registro", f"ID do novo registro: {new_id}")
         return True
     except Error as e:
         st.error(f"❌ Falha ao adicionar registro: {e}")
@@ -201,12 +286,11 @@ def add_record(conn, user_name, data, tipo_operacao, regional, remetente, destin
 def delete_all_records(conn, user_name):
     """Exclui TODOS os registros da tabela 'registros'."""
     try:
-        sql = 'DELETE FROM registros'
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        # Reseta a sequência do autoincremento para o SQLite
-        cursor.execute("DELETE FROM sqlite_sequence WHERE name='registros'")
-        conn.commit()
+        sql = 'DELETE FROM registros_base'
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql)
+            # Reseta a sequência do autoincremento para o SQLite
+            cursor.execute("DELETE FROM sqlite_sequence WHERE name='registros_base'")
         log_activity(conn, user_name, "Excluir Todos os Registros", "Todos os registros foram apagados.")
         st.success("✅ Todos os registros foram excluídos com sucesso!")
     except Error as e:
@@ -298,9 +382,8 @@ def update_record(conn, user_name, record_id, data, tipo_operacao, regional, rem
                       unidade = :unidade, preco_unitario = :preco_unitario, valor_total = :valor_total,
                       nfe = :nfe, observacoes = :observacoes 
                   WHERE id = :id '''
-        cursor = conn.cursor()
-        cursor.execute(sql, registro_dict)
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, registro_dict)
         st.success(f"✅ Registro ID {record_id} atualizado com sucesso!")
         log_activity(conn, user_name, "Editar Registro", f"Registro ID {record_id} foi modificado.")
     except Error as e:
@@ -316,10 +399,9 @@ def delete_record(conn, user_name, record_id):
         return
 
     try:
-        sql = 'DELETE FROM registros WHERE id = ?'
-        cursor = conn.cursor()
-        cursor.execute(sql, (record_id,))
-        conn.commit()
+        sql = 'DELETE FROM registros_base WHERE id = ?'
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (record_id,))
         log_activity(conn, user_name, "Excluir Registro", f"Registro ID {record_id} foi excluído.")
         st.success(f"✅ Registro ID {record_id} excluído com sucesso!")
     except Error as e:
@@ -340,11 +422,11 @@ def delete_records_bulk(conn, user_name, record_ids):
     try:
         # Cria a string de placeholders (?, ?, ?) para a cláusula IN
         placeholders = ', '.join('?' for _ in record_ids)
-        sql = f'DELETE FROM registros WHERE id IN ({placeholders})'
+        # Exclui direto na tabela base: exclusões pela view não contam em rowcount.
+        sql = f'DELETE FROM registros_base WHERE id IN ({placeholders})'
         
-        cursor = conn.cursor()
-        cursor.execute(sql, record_ids)
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, record_ids)
         
         num_deleted = cursor.rowcount
         log_activity(conn, user_name, "Excluir Múltiplos Registros", f"{num_deleted} registros foram excluídos. IDs: {', '.join(map(str, record_ids))}")
@@ -353,60 +435,46 @@ def delete_records_bulk(conn, user_name, record_ids):
         st.error(f"❌ Falha ao excluir os registros: {e}")
 
 def migrate_old_records(conn):
-    """Padroniza os dados de texto existentes na tabela de registros."""
+    """
+    Padroniza os nomes das opções usadas nos registros (regional, filial, destino, produto e unidade).
+    Os registros guardam apenas a chave de cada opção, então basta renomear a opção. Se o nome
+    padronizado já existir, os registros passam a usar a opção existente e a duplicada é removida.
+    """
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, regional, filial_remetente, destino, produto, unidade FROM registros")
-        records = cursor.fetchall()
-
-        updates_to_perform = []
-        for record in records:
-            rec_id, regional, remetente, destino, produto, unidade = record
-
-            # Aplica as mesmas regras de padronização dos formulários
-            std_regional = str(regional).strip().title()
-            std_remetente = str(remetente).strip().title()
-            std_destino = str(destino).strip().title()
-            std_produto = str(produto).strip().title()
-            std_unidade = str(unidade).strip().title()
-
-            # Verifica se houve alguma mudança para evitar updates desnecessários
-            if (std_regional != regional or
-                std_remetente != remetente or
-                std_destino != destino or
-                std_produto != produto or
-                std_unidade != unidade):
-                updates_to_perform.append((std_regional, std_remetente, std_destino, std_produto, std_unidade, rec_id))
-
-        if not updates_to_perform:
+        renames = []
+        for column, table_name in database.DIMENSION_TABLES.items():
+            cursor.execute(f"SELECT id, name FROM {table_name}")
+            for option_id, name in cursor.fetchall():
+                # Aplica as mesmas regras de padronização dos formulários
+                std_name = str(name).strip().title()
+                if std_name != name:
+                    renames.append((column, table_name, option_id, std_name))
+
+        if not renames:
             st.info("✅ Todos os registros já estão padronizados. Nenhuma ação foi necessária.")
             return
 
-        sql_update = "UPDATE registros SET regional = ?, filial_remetente = ?, destino = ?, produto = ?, unidade = ? WHERE id = ?"
-        cursor.executemany(sql_update, updates_to_perform)
-        conn.commit()
-        st.success(f"✅ Migração concluída! {len(updates_to_perform)} registros foram atualizados para o novo padrão.")
+        updated_records = 0
+        with database.write_transaction(conn) as write_cursor:
+            for column, table_name, option_id, std_name in renames:
+                id_column = database.base_column(column)
+                write_cursor.execute(f"SELECT COUNT(*) FROM registros_base WHERE {id_column} = ?", (option_id,))
+                updated_records += write_cursor.fetchone()[0]
+
+                write_cursor.execute(f"SELECT id FROM {table_name} WHERE name = ?", (std_name,))
+                existing = write_cursor.fetchone()
+                if existing is None:
+                    write_cursor.execute(f"UPDATE {table_name} SET name = ? WHERE id = ?", (std_name, option_id))
+                else:
+                    write_cursor.execute(
+                        f"UPDATE registros_base SET {id_column} = ? WHERE {id_column} = ?", (existing[0], option_id)
+                    )
+                    write_cursor.execute(f"DELETE FROM {table_name} WHERE id = ?", (option_id,))
+        st.success(f"✅ Migração concluída! {len(renames)} opções foram padronizadas, atualizando {updated_records} registros.")
     except Error as e:
         st.error(f"❌ Ocorreu um erro durante a migração dos dados: {e}")
 
-def run_user_role_migration(conn):
-    """Adiciona a coluna 'role' à tabela de usuários se ela não existir."""
-    try:
-        cursor = conn.cursor()
-        # Verifica se a coluna 'role' já existe
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'role' not in columns:
-            st.info("Aplicando migração: adicionando coluna 'role' aos usuários...")
-            # Adiciona a coluna com um valor padrão 'User'
-            cursor.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'User' NOT NULL")
-            # Define o 'Administrador' como 'Admin'
-            cursor.execute("UPDATE users SET role = 'Admin' WHERE username = 'Administrador'")
-            conn.commit()
-            st.success("Migração de função de usuário concluída.")
-    except Error as e:
-        st.error(f"Erro durante a migração da função de usuário: {e}")
-
 def get_setting_options(conn, table_name):
     """Busca todas as opções de uma tabela de configuração."""
     try:
@@ -418,18 +486,6 @@ def get_setting_options(conn, table_name):
         st.error(f"Falha ao buscar opções de '{table_name}': {e}")
         return []
 
-def get_distinct_field_options(conn, field_name):
-    """Busca valores únicos de um campo específico na tabela de registros."""
-    try:
-        cursor = conn.cursor()
-        # A construção da query é segura aqui, pois 'field_name' é controlado internamente.
-        cursor.execute(f"SELECT DISTINCT {field_name} FROM registros WHERE {field_name} IS NOT NULL AND {field_name} != '' ORDER BY {field_name} ASC")
-        rows = cursor.fetchall()
-        return [row[0] for row in rows]
-    except Error as e:
-        st.error(f"Falha ao buscar opções distintas para '{field_name}': {e}")
-        return []
-
 def add_setting_option(conn, table_name, name):
     """Adiciona uma nova opção a uma tabela de configuração."""
     # Padroniza o nome antes de inserir para manter a consistência
@@ -441,23 +497,50 @@ def add_setting_option(conn, table_name, name):
 
     try:
         sql = f"INSERT INTO {table_name} (name) VALUES (?)"
-        cursor = conn.cursor()
-        cursor.execute(sql, (standardized_name,))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (standardized_name,))
         st.success(f"Opção '{standardized_name}' adicionada com sucesso!")
     except Error as e:
         st.error(f"❌ Falha ao adicionar opção: {e}. Verifique se a opção já existe.")
 
+def rename_setting_option(conn, table_name, old_name, new_name):
+    """
+    Renomeia uma opção de uma tabela de configuração. Os registros guardam apenas a chave
+    da opção, então todos passam a exibir o novo nome sem que nenhum seja reescrito.
+    """
+    standardized_name = str(new_name).strip().title()
+
+    if not standardized_name:
+        st.warning("O nome da opção não pode ser vazio.")
+        return False
+
+    try:
+        sql = f"UPDATE {table_name} SET name = ? WHERE name = ?"
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (standardized_name, old_name))
+        st.success(f"Opção '{old_name}' renomeada para '{standardized_name}'!")
+        return True
+    except sqlite3.IntegrityError:
+        st.error(f"❌ Já existe uma opção chamada '{standardized_name}'.")
+        return False
+    except Error as e:
+        st.error(f"❌ Falha ao renomear opção: {e}")
+        return False
+
 def delete_setting_option(conn, table_name, name):
-    """Remove uma opção de uma tabela de configuração."""
+    """Remove uma opção de uma tabela de configuração. Retorna False se a opção estiver em uso."""
     try:
         sql = f"DELETE FROM {table_name} WHERE name = ?"
-        cursor = conn.cursor()
-        cursor.execute(sql, (name,))
-        conn.commit()
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(sql, (name,))
         st.success(f"Opção '{name}' removida com sucesso!")
+        return True
+    except sqlite3.IntegrityError:
+        st.error(f"❌ A opção '{name}' está em uso em registros e não pode ser removida.")
+        return False
     except Error as e:
         st.error(f"❌ Falha ao remover opção: {e}")
+        return False
 
 def get_activity_log(conn):
     """Busca todos os registros do log de atividades."""
@@ -473,160 +556,469 @@ def get_activity_log(conn):
         st.error(f"Falha ao buscar o log de atividades: {e}")
         return pd.DataFrame()
 
+# --- Carregamento Tipado de Registros ---
+# Coluna do banco -> (nome exibido, tipo no DataFrame). Os números são lidos já como float64,
+# as colunas de texto com poucos valores distintos viram 'category' e as datas são
+# convertidas uma única vez na leitura.
+RECORD_COLUMNS = {
+    'id': ('ID', 'int64'),
+    'data': ('Data', 'date'),
+    'data_lancamento': ('Data de Lançamento', 'date'),
+    'usuario_lancamento': ('Usuário', 'category'),
+    'tipo_operacao': ('Tipo de Operação', 'category'),
+    'regional': ('Regional', 'category'),
+    'filial_remetente': ('Filial Remetente', 'category'),
+    'destino': ('Destino', 'category'),
+    'produto': ('Produto', 'category'),
+    'quantidade': ('Quantidade', 'float64'),
+    'unidade': ('Unidade', 'category'),
+    'preco_unitario': ('Preço Unitário', 'float64'),
+    'valor_total': ('Valor Total', 'float64'),
+    'nfe': ('NFe', 'text'),
+    'observacoes': ('Observacoes', 'text'),
+}
+
+def _record_select_sql(column):
+    """Expressão do SELECT para uma coluna de RECORD_COLUMNS."""
+    if RECORD_COLUMNS[column][1] == 'float64':
+        # Converte no próprio SQLite, tratando NULL e textos não numéricos como zero.
+        return f"COALESCE(CAST({column} AS REAL), 0.0) AS {column}"
+    return column
+
+def _records_query(columns, where_sql="", order_sql="", categorical=True):
+    """Monta a consulta de _load_records e os argumentos de tipo e datas do pd.read_sql_query."""
+    select_parts, dtypes, date_columns = [], {}, []
+    for column in columns:
+        kind = RECORD_COLUMNS[column][1]
+        select_parts.append(_record_select_sql(column))
+        if kind == 'float64':
+            dtypes[column] = 'float64'
+        else:
+            if kind == 'date':
+                date_columns.append(column)
+            elif kind == 'category' and categorical:
+                dtypes[column] = 'category'
+            elif kind == 'int64':
+                dtypes[column] = 'int64'
+
+    query = f"SELECT {', '.join(select_parts)} FROM registros {where_sql} {order_sql}"
+    return query, {'dtype': dtypes, 'parse_dates': {column: {'format': 'ISO8601'} for column in date_columns}}
+
+def _load_records(conn, columns, where_sql="", params=(), order_sql="", categorical=True):
+    """
+    Carrega registros em um DataFrame já tipado e com os nomes de colunas de exibição.
+    - `columns`: colunas do banco a projetar (chaves de RECORD_COLUMNS; todas elas, passando
+      o próprio RECORD_COLUMNS);
+    - `categorical`: converte as colunas de baixa cardinalidade para 'category'
+      (vale a pena em consultas grandes; em páginas pequenas pode ser desligado).
+    """
+    query, read_options = _records_query(columns, where_sql, order_sql, categorical)
+    df = pd.read_sql_query(query, conn, params=list(params), **read_options)
+    return df.rename(columns={column: RECORD_COLUMNS[column][0] for column in columns})
+
+def _iter_record_chunks(conn, columns, chunk_size, where_sql="", params=(), order_sql=""):
+    """Como _load_records, mas entrega os registros em DataFrames de até `chunk_size` linhas."""
+    query, read_options = _records_query(columns, where_sql, order_sql)
+    names = {column: RECORD_COLUMNS[column][0] for column in columns}
+    for chunk in pd.read_sql_query(query, conn, params=list(params), chunksize=chunk_size, **read_options):
+        yield chunk.rename(columns=names)
+
 def get_all_records(conn):
     """Busca todos os registros no banco de dados e retorna um DataFrame."""
-        # Esta função foi refatorada para ser mais limpa e robusta.
     try:
-        # Lê os dados diretamente para um DataFrame, convertendo a coluna 'data' para datetime.
-        query = "SELECT * FROM registros ORDER BY id DESC"
-        df = pd.read_sql_query(query, conn, parse_dates=['data', 'data_lancamento'])
-
+        df = _load_records(conn, RECORD_COLUMNS, order_sql="ORDER BY id DESC")
         if df.empty:
             return pd.DataFrame()
-
-        # Renomeia as colunas do banco de dados para nomes mais amigáveis para exibição.
-        df.rename(columns={
-            'id': 'ID', 'data': 'Data', 'data_lancamento': 'Data de Lançamento',
-            'usuario_lancamento': 'Usuário', 'tipo_operacao': 'Tipo de Operação', 
-            'regional': 'Regional',
-            'filial_remetente': 'Filial Remetente', 'destino': 'Destino',
-            'produto': 'Produto', 'quantidade': 'Quantidade', 'observacoes': 'Observacoes',
-            'unidade': 'Unidade', 'preco_unitario': 'Preço Unitário',
-            'valor_total': 'Valor Total', 'nfe': 'NFe'
-        }, inplace=True)
-
-        # Garante que as colunas numéricas sejam do tipo correto, tratando possíveis erros.
-        numeric_cols = ['Quantidade', 'Preço Unitário', 'Valor Total']
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
         return df
 
     except (Error, pd.errors.DatabaseError) as e:
         st.error(f"Falha ao buscar registros: {e}")
         return pd.DataFrame()
 
-def get_records_count(conn, search_query: str = "") -> int:
-    """Conta o número total de registros, opcionalmente filtrando por uma query de busca."""
-    cursor = conn.cursor()
-    query = "SELECT COUNT(*) FROM registros"
-    params = []
-    if search_query:
-        search_term = f"%{search_query.lower()}%"
-        # Concatena colunas para uma busca ampla. Usa COALESCE para tratar valores NULL.
-        query += """ 
-            WHERE LOWER(COALESCE(regional, '') || ' ' || 
-                       COALESCE(filial_remetente, '') || ' ' || 
-                       COALESCE(destino, '') || ' ' || 
-                       COALESCE(produto, '') || ' ' || 
-                       COALESCE(unidade, '') || ' ' || 
-                       COALESCE(nfe, '') || ' ' || 
-                       COALESCE(tipo_operacao, '') || ' ' ||
-                       COALESCE(usuario_lancamento, '')) LIKE ?
-        """
-        params.append(search_term)
-    
-    cursor.execute(query, params)
-    count = cursor.fetchone()[0]
-    return count
-
-def get_paginated_records(conn, limit: int, offset: int, search_query: str = "") -> pd.DataFrame:
-    """Busca uma 'página' de registros do banco de dados com opção de busca."""
-    query = "SELECT * FROM registros"
-    params = []
-    if search_query:
-        search_term = f"%{search_query.lower()}%"
-        query += """ 
-            WHERE LOWER(COALESCE(regional, '') || ' ' || 
-                       COALESCE(filial_remetente, '') || ' ' || 
-                       COALESCE(destino, '') || ' ' || 
-                       COALESCE(produto, '') || ' ' || 
-                       COALESCE(unidade, '') || ' ' || 
-                       COALESCE(nfe, '') || ' ' || 
-                       COALESCE(tipo_operacao, '') || ' ' ||
-                       COALESCE(usuario_lancamento, '')) LIKE ?
-        """
-        params.append(search_term)
+def _build_fts_query(search_query: str) -> str:
+    """
+    Converte o texto digitado em uma consulta FTS5: cada termo vira uma busca por prefixo
+    e todos os termos precisam aparecer no registro (ex: 'ara ovo' -> '"ara"* "ovo"*').
+    """
+    terms = search_query.split()
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
 
-    query += " ORDER BY id DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
-    
-    df = pd.read_sql_query(query, conn, params=params, parse_dates=['data', 'data_lancamento'])
+def _build_search_clause(conn, search_query: str):
+    """
+    Monta as condições da busca textual e seus parâmetros, para compor a cláusula WHERE.
+    Usa o índice FTS5 quando disponível; caso contrário, recorre ao LIKE sobre as colunas concatenadas.
+    """
+    if not search_query or not search_query.strip():
+        return [], []
+    if database.has_search_index(conn):
+        return (
+            ["id IN (SELECT rowid FROM registros_fts WHERE registros_fts MATCH ?)"],
+            [_build_fts_query(search_query)],
+        )
+    # Concatena colunas para uma busca ampla. Usa COALESCE para tratar valores NULL.
+    return ["""LOWER(COALESCE(regional, '') || ' ' || 
+                   COALESCE(filial_remetente, '') || ' ' || 
+                   COALESCE(destino, '') || ' ' || 
+                   COALESCE(produto, '') || ' ' || 
+                   COALESCE(unidade, '') || ' ' || 
+                   COALESCE(nfe, '') || ' ' || 
+                   COALESCE(tipo_operacao, '') || ' ' ||
+                   COALESCE(usuario_lancamento, '')) LIKE ?"""], [f"%{search_query.lower()}%"]
+
+def _search_source_table(conn, search_query: str) -> str:
+    """
+    Tabela a consultar quando só 'id' e 'data' são necessários (contagens e cursores).
+    A tabela base dispensa os JOINs de nomes da view 'registros'; a exceção é a busca
+    por LIKE (sem FTS5), que filtra pelos nomes das opções.
+    """
+    if search_query and search_query.strip() and not database.has_search_index(conn):
+        return "registros"
+    return "registros_base"
+
+def get_data_version(conn, table_name: str = "registros") -> int:
+    """
+    Retorna a versão (geração de escrita) de uma tabela, mantida por triggers.
+    Muda a cada inserção, edição ou exclusão, e por isso serve como chave de cache.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM table_stats WHERE name = ?", (table_name,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    except Error:
+        return 0
 
+def _count_records(conn, search_query: str = "", min_key: tuple = None, limit: int = None) -> int:
+    """Executa a contagem de registros; com `limit`, para de contar em `limit + 1`."""
+    cursor = conn.cursor()
+    conditions, params = _build_search_clause(conn, search_query)
+    if min_key is not None:
+        conditions.append("(data, id) >= (?, ?)")
+        params.extend(min_key)
+    query = f"SELECT 1 FROM {_search_source_table(conn, search_query)}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    cursor.execute(f"SELECT COUNT(*) FROM ({query})", params)
+    return cursor.fetchone()[0]
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def _cached_search_count(_conn, search_query: str, limit, data_version: int) -> int:
+    """Contagem de uma busca, cacheada por termo; `data_version` invalida o cache após escritas."""
+    return _count_records(_conn, search_query, limit=limit)
+
+def get_records_count(conn, search_query: str = "", min_key: tuple = None, limit: int = None) -> int:
+    """
+    Conta o número total de registros, opcionalmente filtrando por uma query de busca.
+    - Sem busca, lê a contagem mantida por triggers em 'table_stats' (sem COUNT(*)).
+    - Com busca, o resultado fica em cache até a próxima escrita em 'registros'.
+    - Com `limit`, a busca para de contar ao passar de `limit` e retorna `limit + 1`,
+      permitindo exibir "1000+" sem contar todo o conjunto de resultados.
+    - Com `min_key` (um cursor de get_records_page), conta apenas os registros com
+      (data, id) maior ou igual a ele, isto é, os que vêm antes do cursor na listagem.
+    """
+    has_search = bool(search_query and search_query.strip())
+    if min_key is not None:
+        return _count_records(conn, search_query, min_key=min_key)
+    if not has_search:
+        cursor = conn.cursor()
+        cursor.execute("SELECT row_count FROM table_stats WHERE name = 'registros'")
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        return _count_records(conn)
+    return _cached_search_count(conn, search_query.strip(), limit, get_data_version(conn))
+
+def get_records_page(conn, limit: int, after: tuple = None, before: tuple = None, search_query: str = ""):
+    """
+    Busca uma 'página' de registros por keyset (seek), do registro mais recente para o mais
+    antigo: em ordem decrescente de data e, na mesma data, de ID. Os cursores são tuplas
+    (data, id) (ver page_cursor):
+    - `after`: página seguinte, com os registros que vêm depois dele;
+    - `before`: página anterior, com os registros que vêm antes dele.
+    O custo é proporcional ao tamanho da página, qualquer que seja a profundidade
+    (o índice de 'data' já traz o ID em ordem).
+    Retorna uma tupla (DataFrame, has_more), onde `has_more` indica se ainda há
+    registros além desta página na direção pedida.
+    """
+    conditions, params = _build_search_clause(conn, search_query)
+    if before is not None:
+        conditions.append("(data, id) > (?, ?)")
+        params.extend(before)
+        order = "ASC"
+    else:
+        if after is not None:
+            conditions.append("(data, id) < (?, ?)")
+            params.extend(after)
+        order = "DESC"
+
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    # Busca uma linha a mais apenas para saber se existe uma próxima página.
+    order_sql = f"ORDER BY data {order}, id {order} LIMIT ?"
+    params.append(limit + 1)
+
+    # Páginas são pequenas: colunas de texto ficam como texto simples, sem 'category'.
+    df = _load_records(conn, RECORD_COLUMNS, where_sql, params, order_sql, categorical=False)
+
+    has_more = len(df) > limit
     if df.empty:
-        return pd.DataFrame()
+        return pd.DataFrame(), has_more
+    df = df.iloc[:limit]
+    if order == "ASC":
+        df = df.iloc[::-1].reset_index(drop=True)
+    return df, has_more
 
-    # Renomeia as colunas para consistência com o resto do app, evitando erros de chave
-    df.rename(columns={
-        'id': 'ID', 'data': 'Data', 'data_lancamento': 'Data de Lançamento',
-        'usuario_lancamento': 'Usuário', 'tipo_operacao': 'Tipo de Operação', 'regional': 'Regional',
-        'filial_remetente': 'Filial Remetente', 'destino': 'Destino',
-        'produto': 'Produto', 'quantidade': 'Quantidade', 'observacoes': 'Observacoes',
-        'unidade': 'Unidade', 'preco_unitario': 'Preço Unitário',
-        'valor_total': 'Valor Total', 'nfe': 'NFe'
-    }, inplace=True)
-
-    # Garante que as colunas numéricas sejam do tipo correto
-    for col in ['Quantidade', 'Preço Unitário', 'Valor Total']:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        
-    return df
+def page_cursor(df, position, include=False):
+    """
+    Cursor (data, id) de get_records_page a partir do registro na posição `position` de uma
+    página. Com `include`, o cursor fica logo acima do registro, para que a página `after`
+    comece por ele.
+    """
+    row = df.iloc[position]
+    record_id = int(row['ID'])
+    return (row['Data'].strftime('%Y-%m-%d'), record_id + 1 if include else record_id)
 
-def get_dashboard_data(conn, start_date, end_date, regional, branch, product, destination, operation_type, unit, user):
-    """Busca dados filtrados do banco de dados especificamente para o dashboard."""
-    query = "SELECT * FROM registros WHERE data BETWEEN ? AND ?"
+def find_page_cursor_for_date(conn, target_date, search_query: str = ""):
+    """
+    Retorna o cursor (`after` de get_records_page) que posiciona a listagem no primeiro
+    registro com data igual ou anterior a `target_date`, ou None se não houver nenhum.
+    """
+    conditions, params = _build_search_clause(conn, search_query)
+    conditions.append("data <= ?")
+    params.append(target_date)
+    cursor = conn.cursor()
+    table = _search_source_table(conn, search_query)
+    cursor.execute(
+        f"SELECT data, id FROM {table} WHERE " + " AND ".join(conditions) + " ORDER BY data DESC, id DESC LIMIT 1",
+        params
+    )
+    row = cursor.fetchone()
+    return (row[0], row[1] + 1) if row is not None else None
+
+# --- Cache de Resultados do Dashboard (por sessão) ---
+# Trocar o tipo de um gráfico ou o período de agrupamento reexecuta o script inteiro;
+# com este cache, as consultas do dashboard só rodam de novo quando os filtros mudam
+# ou quando a tabela 'registros' recebe uma escrita (nova versão em table_stats).
+DASHBOARD_CACHE_KEY = "dashboard_result_cache"
+DASHBOARD_CACHE_MAX_ENTRIES = 32
+
+def _freeze_cache_arg(value):
+    """Converte dicionários e listas em tuplas, para que possam compor a chave do cache."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze_cache_arg(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_cache_arg(item) for item in value)
+    return value
+
+def _session_cached(func):
+    """
+    Guarda o resultado de uma consulta do dashboard em st.session_state, em um LRU limitado
+    a DASHBOARD_CACHE_MAX_ENTRIES entradas. A chave é composta pelo nome da função, pelos
+    argumentos (filtros) e pela versão de dados de 'registros'; entradas de versões antigas
+    são descartadas assim que uma nova versão é observada.
+    Os resultados são compartilhados entre reexecuções e não devem ser alterados in-place.
+    """
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        # Fora de uma execução da página (modo bare, ou na função de um st.download_button)
+        # não há st.session_state: a consulta roda sem cache.
+        if get_script_run_ctx(suppress_warning=True) is None:
+            return func(conn, *args, **kwargs)
+
+        data_version = get_data_version(conn)
+        cache = st.session_state.setdefault(DASHBOARD_CACHE_KEY, OrderedDict())
+        key = (func.__name__, _freeze_cache_arg(args), _freeze_cache_arg(kwargs), data_version)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        # Houve escrita desde o último acesso: nada do que está no cache vale mais.
+        for stale_key in [k for k in cache if k[-1] != data_version]:
+            del cache[stale_key]
+
+        result = func(conn, *args, **kwargs)
+        cache[key] = result
+        while len(cache) > DASHBOARD_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+        return result
+    return wrapper
+
+def _build_dashboard_filters(start_date, end_date, regional, branch, product, destination, operation_type, unit, user):
+    """
+    Monta as condições SQL e os parâmetros dos filtros do dashboard.
+    Usada tanto na tabela 'registros' quanto no resumo 'registros_daily', que têm os mesmos nomes de colunas.
+    """
+    conditions = ["data BETWEEN ? AND ?"]
     params = [start_date, end_date]
 
     # Adiciona filtros dinamicamente à consulta SQL
-    if regional and regional != "Todos":
-        query += " AND regional = ?"
-        params.append(regional)
-    if branch and branch != "Todos":
-        query += " AND filial_remetente = ?"
-        params.append(branch)
-    if product and product != "Todos":
-        query += " AND produto = ?"
-        params.append(product)
-    if destination and destination != "Todos":
-        query += " AND destino = ?"
-        params.append(destination)
-    if operation_type and operation_type != "Todos":
-        query += " AND tipo_operacao = ?"
-        params.append(operation_type)
-    if unit and unit != "Todos":
-        query += " AND unidade = ?"
-        params.append(unit)
-    if user and user != "Todos":
-        query += " AND usuario_lancamento = ?"
-        params.append(user)
-
-    # Executa a consulta e carrega os dados em um DataFrame
-    df = pd.read_sql_query(query, conn, params=params, parse_dates=['data', 'data_lancamento'])
-
-    # Renomeia as colunas para nomes mais amigáveis
-    df.rename(columns={
-        'id': 'ID', 'data': 'Data', 'data_lancamento': 'Data de Lançamento',
-        'usuario_lancamento': 'Usuário', 'tipo_operacao': 'Tipo de Operação', 
-        'regional': 'Regional',
-        'filial_remetente': 'Filial Remetente', 'destino': 'Destino',
-        'produto': 'Produto', 'quantidade': 'Quantidade', 'observacoes': 'Observacoes',
-        'unidade': 'Unidade', 'preco_unitario': 'Preço Unitário',
-        'valor_total': 'Valor Total', 'nfe': 'NFe'
-    }, inplace=True)
-
-    # Garante que as colunas numéricas sejam do tipo correto
-    numeric_cols = ['Quantidade', 'Preço Unitário', 'Valor Total']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-    return df
+    filters = [
+        ("regional", regional), ("filial_remetente", branch), ("produto", product),
+        ("destino", destination), ("tipo_operacao", operation_type),
+        ("unidade", unit), ("usuario_lancamento", user),
+    ]
+    for column, value in filters:
+        if value and value != "Todos":
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    return conditions, params
+
+# --- Consultas Agregadas do Dashboard ---
+# Motor de agregação do dashboard: as linhas do resumo 'registros_daily' que atendem aos
+# filtros do dashboard (passados como dicionário em `filters`) são lidas uma única
+# vez, só com as dimensões exibidas, o mês e as somas, e cada dimensão é agrupada uma única
+# vez com todas as medidas. KPIs, rankings, Top 10, narrativas, gráficos e o relatório
+# gerencial saem desses resumos, guardados pelo cache da sessão.
+
+# Rótulo exibido no dashboard -> coluna do banco.
+DASHBOARD_DIMENSIONS = {
+    'Regional': 'regional',
+    'Filial Remetente': 'filial_remetente',
+    'Destino': 'destino',
+    'Produto': 'produto',
+    'Tipo de Operação': 'tipo_operacao',
+    'Unidade': 'unidade',
+    'Usuário': 'usuario_lancamento',
+}
+
+# Dimensões resumidas pelo motor (além do mês, na chave 'Mês' no formato 'AAAA-MM').
+DASHBOARD_SUMMARY_DIMENSIONS = ['Regional', 'Filial Remetente', 'Destino', 'Produto']
+
+# Colunas somadas em cada resumo; o preço unitário médio é 'Soma Preço Unitário' / 'Registros'.
+DASHBOARD_SUMS = ['Valor Total', 'Quantidade', 'Soma Preço Unitário', 'Registros']
+
+def _aggregate_dashboard_rollup(rollup):
+    """
+    Agrupa as linhas do resumo diário uma vez por dimensão e retorna {dimensão: resumo},
+    cada resumo com 'Valor Total', 'Quantidade', 'Registros' e 'Preço Médio' em ordem
+    decrescente de receita, mais os totais gerais em 'Totais'.
+    """
+    aggregates = {}
+    for dimension in [*DASHBOARD_SUMMARY_DIMENSIONS, 'Mês']:
+        summary = rollup.groupby(dimension, observed=True, sort=False)[DASHBOARD_SUMS].sum()
+        summary['Preço Médio'] = summary.pop('Soma Preço Unitário') / summary['Registros']
+        summary.index = summary.index.astype(str)
+        aggregates[dimension] = summary.sort_values('Valor Total', ascending=False).reset_index()
+    totals = rollup[DASHBOARD_SUMS].sum()
+    aggregates['Totais'] = {
+        'Valor Total': float(totals['Valor Total']),
+        'Quantidade': float(totals['Quantidade']),
+        'Registros': int(totals['Registros']),
+    }
+    return aggregates
+
+@_session_cached
+def get_dashboard_aggregates(conn, filters):
+    """
+    Lê as linhas filtradas do resumo diário em uma única consulta e devolve os resumos de
+    _aggregate_dashboard_rollup. As dimensões chegam como 'category', então cada groupby
+    trabalha sobre os códigos inteiros, sem refazer o hash dos textos.
+    """
+    conditions, params = _build_dashboard_filters(**filters)
+    dimensions = ", ".join(f'{DASHBOARD_DIMENSIONS[d]} AS "{d}"' for d in DASHBOARD_SUMMARY_DIMENSIONS)
+    query = f"""
+        SELECT {dimensions}, substr(data, 1, 7) AS "Mês",
+               valor_total AS "Valor Total", quantidade AS "Quantidade",
+               soma_preco_unitario AS "Soma Preço Unitário", num_registros AS "Registros"
+        FROM registros_daily
+        WHERE {' AND '.join(conditions)}"""
+    rollup = pd.read_sql_query(
+        query, conn, params=params,
+        dtype={dimension: 'category' for dimension in [*DASHBOARD_SUMMARY_DIMENSIONS, 'Mês']},
+    )
+    return _aggregate_dashboard_rollup(rollup)
+
+def get_dashboard_totals(conn, filters):
+    """Retorna a receita total, a quantidade total e o número de registros para os filtros."""
+    return get_dashboard_aggregates(conn, filters)['Totais']
+
+def get_dashboard_dimension_summary(conn, filters, dimension):
+    """Retorna o resumo de `dimension` (uma de DASHBOARD_SUMMARY_DIMENSIONS) com todas as medidas."""
+    return get_dashboard_aggregates(conn, filters)[dimension]
+
+def get_dashboard_ranking(conn, filters, dimension, measure='Valor Total', limit=None):
+    """Retorna os totais de `measure` por `dimension`, em ordem decrescente (ex: Top 10 Filiais por Receita)."""
+    ranking = get_dashboard_dimension_summary(conn, filters, dimension)[[dimension, measure]]
+    if measure != 'Valor Total':
+        ranking = ranking.sort_values(measure, ascending=False)
+    return ranking if limit is None else ranking.head(limit)
+
+def get_dashboard_product_summary(conn, filters):
+    """Retorna, por produto, a receita total, a quantidade total e o preço unitário médio."""
+    return get_dashboard_dimension_summary(conn, filters, 'Produto')[['Produto', 'Valor Total', 'Quantidade', 'Preço Médio']]
+
+def _monthly_series(aggregates):
+    """Série mensal a partir do resumo 'Mês', com os meses sem registros preenchidos com zero."""
+    df = aggregates['Mês'][['Mês', 'Valor Total', 'Quantidade']]
+    if df.empty:
+        return pd.DataFrame(columns=['Data', 'Valor Total', 'Quantidade'])
+    df = df.set_index(pd.PeriodIndex(df['Mês'], freq='M')).drop(columns='Mês').sort_index()
+    months = pd.period_range(df.index.min(), df.index.max(), freq='M')
+    df = df.reindex(months, fill_value=0.0)
+    df.index = df.index.to_timestamp()
+    df.index.name = 'Data'
+    return df.reset_index()
+
+def get_dashboard_monthly_series(conn, filters):
+    """
+    Retorna a receita e a quantidade por mês ('Data' = primeiro dia do mês).
+    Meses sem registros dentro do intervalo aparecem com valor zero.
+    """
+    return _monthly_series(get_dashboard_aggregates(conn, filters))
+
+# --- Opções dos Filtros (facetas) ---
+FILTER_ALL_OPTION = "Todos"
+
+@st.cache_data(max_entries=10, show_spinner=False)
+def _load_filter_combinations(_conn, data_version: int):
+    """
+    Lê, em uma única consulta, as combinações distintas das dimensões filtráveis a partir
+    do resumo diário (bem menor que 'registros'). Cacheado por versão de dados.
+    """
+    columns = ", ".join(DASHBOARD_DIMENSIONS.values())
+    return pd.read_sql_query(f"SELECT DISTINCT {columns} FROM registros_daily", _conn)
+
+def get_filter_options(conn, selections=None):
+    """
+    Retorna um dicionário {coluna: [opções em ordem alfabética]} para todas as dimensões
+    de DASHBOARD_DIMENSIONS, calculado sobre o mesmo resultado cacheado.
+    Com `selections` ({coluna: valor selecionado}), as opções ficam em cascata: as de cada
+    dimensão são restritas pelos valores escolhidos nas *outras* dimensões ("Todos" não filtra).
+    O valor já selecionado em uma dimensão é sempre mantido em sua própria lista.
+    """
+    try:
+        combinations = _load_filter_combinations(conn, get_data_version(conn))
+    except (Error, pd.errors.DatabaseError) as e:
+        st.error(f"Falha ao buscar as opções dos filtros: {e}")
+        return {column: [] for column in DASHBOARD_DIMENSIONS.values()}
+
+    active = {
+        column: value for column, value in (selections or {}).items()
+        if value not in (None, "", FILTER_ALL_OPTION)
+    }
+    options = {}
+    for column in DASHBOARD_DIMENSIONS.values():
+        values = combinations[column]
+        mask = pd.Series(True, index=combinations.index)
+        for other_column, value in active.items():
+            if other_column != column:
+                mask &= combinations[other_column] == value
+        column_options = set(values[mask & (values != "")].dropna())
+        if column in active:
+            column_options.add(active[column])
+        options[column] = sorted(column_options)
+    return options
 
 def display_dashboard(conn):
     """Exibe um dashboard interativo que busca dados sob demanda."""
     # Busca as datas mínima e máxima para o seletor de datas de forma eficiente.
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT MIN(data), MAX(data) FROM registros")
+        # Subconsultas separadas permitem que MIN e MAX usem o índice de 'data'
+        # (um único SELECT MIN(data), MAX(data) percorre a tabela inteira).
+        cursor.execute("SELECT (SELECT MIN(data) FROM registros_base), (SELECT MAX(data) FROM registros_base)")
         min_date_str, max_date_str = cursor.fetchone()
 
         if not min_date_str or not max_date_str:
@@ -644,151 +1036,140 @@ def display_dashboard(conn):
     # --- Filtros ---
     with st.popover("📅 Filtros de Análise", use_container_width=True):
         col_filter1, col_filter2 = st.columns(2)
-        all_option_str = "Todos"
+        all_option_str = FILTER_ALL_OPTION
+
+        # Todas as listas vêm de uma única consulta cacheada e ficam em cascata:
+        # cada uma mostra só os valores compatíveis com o que foi escolhido nas demais.
+        filter_keys = {column: f"dashboard_filter_{column}" for column in DASHBOARD_DIMENSIONS.values()}
+        filter_options = get_filter_options(
+            conn, {column: st.session_state.get(key) for column, key in filter_keys.items()}
+        )
 
         with col_filter1:
             start_date = st.date_input("Data de Início", min_date, min_value=min_date, max_value=max_date)
             
-            # Busca as opções de filtro diretamente da tabela de registros para refletir os dados existentes
-            regionals = get_distinct_field_options(conn, "regional")
             selected_regional = st.selectbox(
                 "Regional",
-                options=[all_option_str] + regionals
+                options=[all_option_str] + filter_options["regional"],
+                key=filter_keys["regional"]
             )
 
-            branches = get_distinct_field_options(conn, "filial_remetente")
             selected_branch = st.selectbox(
                 "Filial Remetente",
-                options=[all_option_str] + branches
+                options=[all_option_str] + filter_options["filial_remetente"],
+                key=filter_keys["filial_remetente"]
             )
 
-            operation_types = get_distinct_field_options(conn, "tipo_operacao")
             selected_operation_type = st.selectbox(
                 "Tipo de Operação",
-                options=[all_option_str] + operation_types
+                options=[all_option_str] + filter_options["tipo_operacao"],
+                key=filter_keys["tipo_operacao"]
             )
 
-            users = get_distinct_field_options(conn, "usuario_lancamento")
             selected_user = st.selectbox(
                 "Usuário de Lançamento",
-                options=[all_option_str] + users
+                options=[all_option_str] + filter_options["usuario_lancamento"],
+                key=filter_keys["usuario_lancamento"]
             )
 
         with col_filter2:
             end_date = st.date_input("Data de Fim", max_date, min_value=min_date, max_value=max_date)
 
-            destinations = get_distinct_field_options(conn, "destino")
             selected_destination = st.selectbox(
                 "Destino",
-                options=[all_option_str] + destinations
+                options=[all_option_str] + filter_options["destino"],
+                key=filter_keys["destino"]
             )
 
-            products = get_distinct_field_options(conn, "produto")
             selected_product = st.selectbox(
                 "Produto",
-                options=[all_option_str] + products
+                options=[all_option_str] + filter_options["produto"],
+                key=filter_keys["produto"]
             )
 
-            units = get_distinct_field_options(conn, "unidade")
             selected_unit = st.selectbox(
                 "Unidade",
-                options=[all_option_str] + units
+                options=[all_option_str] + filter_options["unidade"],
+                key=filter_keys["unidade"]
             )
 
-    # Busca os dados no banco de dados com base nos filtros selecionados
+    filters = dict(
+        start_date=start_date, end_date=end_date,
+        regional=selected_regional, branch=selected_branch,
+        product=selected_product, destination=selected_destination,
+        operation_type=selected_operation_type,
+        unit=selected_unit, user=selected_user
+    )
+
+    # KPIs e gráficos usam consultas agregadas sobre o resumo diário: o dashboard recebe
+    # apenas os pequenos resultados de cada GROUP BY, nunca as linhas brutas.
     with st.spinner("Buscando e processando dados..."):
-        df_filtered = get_dashboard_data(
-            conn, start_date=start_date, end_date=end_date,
-            regional=selected_regional, branch=selected_branch,
-            product=selected_product, destination=selected_destination,
-            operation_type=selected_operation_type,
-            unit=selected_unit, user=selected_user
-        )
+        totals = get_dashboard_totals(conn, filters)
 
-    if df_filtered.empty:
+    if totals['Registros'] == 0:
         st.warning("⚠️ Nenhum registro encontrado para os filtros selecionados.")
         return
 
     # --- Botões de Exportação ---
-    # O restante da função continua igual, pois já opera sobre o df_filtered
     st.subheader("Exportar Dados Filtrados")
-    col_export1, col_export2, _ = st.columns([1, 1, 4])
-
-    with col_export1:
-        # Exportar para Excel
-        try:
-            st.markdown(
-                get_table_download_link(
-                    df_filtered,
-                    f"relatorio_residuos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                    "Exportar para Excel",
-                    "excellogo.png"
-                ),
-                unsafe_allow_html=True
-            )
-        except FileNotFoundError:
-            # Fallback para o botão padrão se o logo não for encontrado
+    # Os arquivos só são gerados quando o usuário clica em um dos botões (ver export_download_data).
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    export_columns = st.columns(len(EXPORT_FORMATS))
+    for column, (file_format, (label, extension, mime, _)) in zip(export_columns, EXPORT_FORMATS.items()):
+        with column:
             st.download_button(
-                label="📥 Exportar para Excel (logo não encontrado)",
-                data=to_excel(df_filtered),
-                file_name=f"relatorio_residuos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                label=label,
+                data=export_download_data(conn, filters, file_format),
+                file_name=f"relatorio_residuos_{timestamp}.{extension}",
+                mime=mime,
+                on_click="ignore",
                 use_container_width=True
             )
-
-    with col_export2:
-        # Exportar para CSV
-        csv_data = df_filtered.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📄 Exportar para CSV",
-            data=csv_data,
-            file_name=f"relatorio_residuos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv",
-            use_container_width=True
-        )
     st.divider()
 
     # --- KPIs ---
     st.subheader("Indicadores Chave de Performance (KPIs)")
-    total_revenue = df_filtered['Valor Total'].sum()
-    total_quantity = df_filtered['Quantidade'].sum()
-    num_records = len(df_filtered)
+    total_revenue = totals['Valor Total']
+    total_quantity = totals['Quantidade']
+    num_records = totals['Registros']
     
     col1, col2, col3 = st.columns(3)
     col1.metric(label="Receita Total", value=f"R$ {total_revenue:,.2f}")
     col2.metric(label="Quantidade Total (KG/Un)", value=f"{total_quantity:,.2f}")
     col3.metric(label="Total de Registros", value=f"{num_records:,}")
 
+    revenue_by_regional = get_dashboard_ranking(conn, filters, 'Regional')
+    revenue_by_filial = get_dashboard_ranking(conn, filters, 'Filial Remetente', limit=10)
+    revenue_by_destino = get_dashboard_ranking(conn, filters, 'Destino', limit=10)
+    product_summary = get_dashboard_product_summary(conn, filters)
+    monthly_series = get_dashboard_monthly_series(conn, filters)
+
     # --- NARRATIVAS ---
     st.subheader("Análises e Narrativas")
     try:
         # Principais Influenciadores
-        top_regional_revenue = df_filtered.groupby('Regional')['Valor Total'].sum()
-        if not top_regional_revenue.empty:
-            top_regional = top_regional_revenue.idxmax()
+        if not revenue_by_regional.empty:
+            top_regional = revenue_by_regional['Regional'].iloc[0]
             st.markdown(f"🏆 **Regional Destaque:** A regional **{top_regional}** foi a que gerou maior receita no período selecionado.")
 
-        top_filial_revenue = df_filtered.groupby('Filial Remetente')['Valor Total'].sum()
-        if not top_filial_revenue.empty:
-            top_filial = top_filial_revenue.idxmax()
+        if not revenue_by_filial.empty:
+            top_filial = revenue_by_filial['Filial Remetente'].iloc[0]
             st.markdown(f"🏢 **Filial Destaque:** A filial **{top_filial}** foi a principal contribuinte para a receita.")
 
-        top_product_revenue = df_filtered.groupby('Produto')['Valor Total'].sum()
-        if not top_product_revenue.empty:
-            top_product = top_product_revenue.idxmax()
+        if not product_summary.empty:
+            top_product = product_summary['Produto'].iloc[0]
             st.markdown(f"📦 **Produto Destaque:** O produto **{top_product}** foi o mais lucrativo no período.")
 
             # Análise de Influenciadores de Produto
-            total_revenue_for_narrative = df_filtered['Valor Total'].sum()
-            if total_revenue_for_narrative > 0:
-                top_3_products = top_product_revenue.nlargest(3)
-                top_3_percentage = (top_3_products.sum() / total_revenue_for_narrative) * 100
-                top_3_names = ", ".join([f"**{name}**" for name in top_3_products.index])
+            if total_revenue > 0:
+                top_3_products = product_summary.head(3)
+                top_3_percentage = (top_3_products['Valor Total'].sum() / total_revenue) * 100
+                top_3_names = ", ".join([f"**{name}**" for name in top_3_products['Produto']])
                 st.markdown(f"📊 **Principais Influenciadores:** Os produtos {top_3_names} são os principais motores da receita, representando juntos **{top_3_percentage:.1f}%** do total.")
 
         # Análise de Tendência Mensal
-        monthly_revenue = df_filtered.set_index('Data').resample('M')['Valor Total'].sum()
-        monthly_quantity = df_filtered.set_index('Data').resample('M')['Quantidade'].sum()
+        monthly_revenue = monthly_series.set_index('Data')['Valor Total']
+        monthly_quantity = monthly_series.set_index('Data')['Quantidade']
 
         if len(monthly_revenue) > 1:
             x = np.arange(len(monthly_revenue))
@@ -834,8 +1215,6 @@ def display_dashboard(conn):
             label_visibility="collapsed"
         )
 
-        revenue_by_regional = df_filtered.groupby('Regional')['Valor Total'].sum().reset_index()
-
         if chart_type_regional == "Pizza":
             fig_regional = px.pie(revenue_by_regional, values='Valor Total', names='Regional', hole=.3,
                              color_discrete_sequence=px.colors.sequential.Blues_r)
@@ -845,8 +1224,8 @@ def display_dashboard(conn):
                 hovertemplate='<b>Regional:</b> %{label}<br><b>Receita:</b> R$ %{value:,.2f}<br><b>Percentual:</b> %{percent}<extra></extra>'
             )
         else: # Barras
-            revenue_by_regional = revenue_by_regional.sort_values(by='Valor Total', ascending=True)
-            fig_regional = px.bar(revenue_by_regional, x='Valor Total', y='Regional', orientation='h', text=revenue_by_regional['Valor Total'].apply(lambda x: f'R$ {x:,.2f}'))
+            revenue_by_regional_sorted = revenue_by_regional.sort_values(by='Valor Total', ascending=True)
+            fig_regional = px.bar(revenue_by_regional_sorted, x='Valor Total', y='Regional', orientation='h', text=revenue_by_regional_sorted['Valor Total'].apply(lambda x: f'R$ {x:,.2f}'))
             fig_regional.update_traces(hovertemplate='<b>Regional:</b> %{y}<br><b>Receita:</b> R$ %{x:,.2f}<extra></extra>',
                                       textposition='outside')
             fig_regional.update_layout(yaxis_title="Regional", xaxis_title="Valor Total (R$)")
@@ -854,9 +1233,9 @@ def display_dashboard(conn):
         st.plotly_chart(fig_regional, use_container_width=True)
 
         st.subheader("Top 10 Filiais por Receita")
-        revenue_by_filial = df_filtered.groupby('Filial Remetente')['Valor Total'].sum().nlargest(10).sort_values(ascending=True)
-        fig_bar_h = px.bar(revenue_by_filial, x=revenue_by_filial.values, y=revenue_by_filial.index, orientation='h',
-                           text=revenue_by_filial.apply(lambda x: f'R$ {x:,.2f}'))
+        revenue_by_filial = revenue_by_filial.sort_values(by='Valor Total', ascending=True)
+        fig_bar_h = px.bar(revenue_by_filial, x='Valor Total', y='Filial Remetente', orientation='h',
+                           text=revenue_by_filial['Valor Total'].apply(lambda x: f'R$ {x:,.2f}'))
         fig_bar_h.update_traces(
             hovertemplate='<b>Filial:</b> %{y}<br><b>Receita:</b> R$ %{x:,.2f}<extra></extra>',
             textposition='outside'
@@ -865,9 +1244,9 @@ def display_dashboard(conn):
         st.plotly_chart(fig_bar_h, use_container_width=True)
 
         st.subheader("Top 10 Destinos por Receita")
-        revenue_by_destino = df_filtered.groupby('Destino')['Valor Total'].sum().nlargest(10).sort_values(ascending=True)
-        fig_bar_destino = px.bar(revenue_by_destino, x=revenue_by_destino.values, y=revenue_by_destino.index, orientation='h',
-                                 text=revenue_by_destino.apply(lambda x: f'R$ {x:,.2f}'))
+        revenue_by_destino = revenue_by_destino.sort_values(by='Valor Total', ascending=True)
+        fig_bar_destino = px.bar(revenue_by_destino, x='Valor Total', y='Destino', orientation='h',
+                                 text=revenue_by_destino['Valor Total'].apply(lambda x: f'R$ {x:,.2f}'))
         fig_bar_destino.update_traces(
             hovertemplate='<b>Destino:</b> %{y}<br><b>Receita:</b> R$ %{x:,.2f}<extra></extra>',
             textposition='outside'
@@ -877,17 +1256,15 @@ def display_dashboard(conn):
 
     with col2:
         st.subheader("Análise de Receita por Produto")
-        revenue_by_product = df_filtered.groupby('Produto')['Valor Total'].sum()
-        if not revenue_by_product.empty:
-            product_analysis_df = pd.DataFrame({
-                'Valor Total': revenue_by_product,
-                'Percentual': (revenue_by_product / total_revenue) * 100 if total_revenue > 0 else 0
-            }).nlargest(10, 'Valor Total').sort_values(by='Valor Total', ascending=True)
+        if not product_summary.empty:
+            product_analysis_df = product_summary.head(10).assign(
+                Percentual=lambda df: (df['Valor Total'] / total_revenue) * 100 if total_revenue > 0 else 0
+            ).sort_values(by='Valor Total', ascending=True)
 
             fig_prod = px.bar(
                 product_analysis_df,
                 x='Valor Total',
-                y=product_analysis_df.index,
+                y='Produto',
                 orientation='h',
                 text=product_analysis_df['Valor Total'].apply(lambda x: f'R$ {x:,.2f}'),
                 custom_data=[product_analysis_df['Percentual']]
@@ -903,9 +1280,9 @@ def display_dashboard(conn):
             st.plotly_chart(fig_prod, use_container_width=True)
 
         st.subheader("Top 10 Produtos por Quantidade")
-        quantity_by_product = df_filtered.groupby('Produto')['Quantidade'].sum().nlargest(10).sort_values(ascending=True)
-        fig_bar_qty = px.bar(quantity_by_product, x=quantity_by_product.values, y=quantity_by_product.index, orientation='h',
-                           text=quantity_by_product.apply(lambda x: f'{x:,.2f}'))
+        quantity_by_product = product_summary.nlargest(10, 'Quantidade').sort_values(by='Quantidade', ascending=True)
+        fig_bar_qty = px.bar(quantity_by_product, x='Quantidade', y='Produto', orientation='h',
+                           text=quantity_by_product['Quantidade'].apply(lambda x: f'{x:,.2f}'))
         fig_bar_qty.update_traces(
             hovertemplate='<b>Produto:</b> %{y}<br><b>Quantidade Total:</b> %{x:,.2f}<extra></extra>',
             textposition='outside'
@@ -914,12 +1291,9 @@ def display_dashboard(conn):
         st.plotly_chart(fig_bar_qty, use_container_width=True)
 
         st.subheader("Receita vs. Quantidade por Produto")
-        # Agrupa os dados por produto, somando receita e quantidade
-        rev_qty_by_product = df_filtered.groupby('Produto').agg({'Valor Total': 'sum', 'Quantidade': 'sum'}).reset_index()
-
-        if not rev_qty_by_product.empty:
+        if not product_summary.empty:
             fig_scatter = px.scatter(
-                rev_qty_by_product,
+                product_summary,
                 x='Quantidade',
                 y='Valor Total',
                 size='Valor Total',      # O tamanho da bolha representa a receita
@@ -936,9 +1310,8 @@ def display_dashboard(conn):
             st.plotly_chart(fig_scatter, use_container_width=True)
 
         st.subheader("Média de Preço Unitário por Produto")
-        avg_price_by_product = df_filtered.groupby('Produto')['Preço Unitário'].mean().reset_index()
-        if not avg_price_by_product.empty:
-            avg_price_by_product.rename(columns={'Preço Unitário': 'Preço Médio (R$)'}, inplace=True)
+        if not product_summary.empty:
+            avg_price_by_product = product_summary[['Produto', 'Preço Médio']].rename(columns={'Preço Médio': 'Preço Médio (R$)'})
             avg_price_by_product = avg_price_by_product.sort_values(by='Preço Médio (R$)', ascending=False)
             st.dataframe(avg_price_by_product.style.format({'Preço Médio (R$)': 'R$ {:,.2f}'}),
                          use_container_width=True,
@@ -1116,54 +1489,356 @@ def _create_evolution_chart(df, date_col, value_col, period_code, period_label,
         y_axis_label="Quantidade"
     )
 
-def to_excel(df):
-    """Converte um DataFrame para um arquivo Excel em memória."""
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Dados')
-    processed_data = output.getvalue()
-    return processed_data
-
-def get_table_download_link(df, filename, text, logo_path):
-    """
-    Generates an HTML link to download a data frame as an Excel file,
-    styled to look like a button with a logo.
-    """
-    excel_data = to_excel(df)
-    b64_excel = base64.b64encode(excel_data).decode()
-
-    with open(logo_path, "rb") as f:
-        logo_data = f.read()
-    b64_logo = base64.b64encode(logo_data).decode()
-
-    # CSS to style the link as a button. Using a class to avoid ID conflicts.
-    button_css = """
-        <style>
-        .download-button-custom {
-            display: inline-flex;
-            align-items: center;
-            justify-content: center;
-            background-color: #F0F2F6;
-            color: #3133F;
-            padding: 0.4rem 0.75rem;
-            border-radius: 0.5rem;
-            border: 1px solid rgba(49, 51, 63, 0.2);
-            text-decoration: none;
-            font-weight: 400;
-            font-size: 14px;
-            transition: all 0.2s;
-            width: 100%;
-            box-sizing: border-box;
-        }
-        .download-button-custom:hover { border-color: #0068C9; color: #0068C9; }
-        .download-button-custom:active { background-color: #e0e2e6; }
-        </style>
+# --- Escrita de Arquivos em Fluxo ---
+# Os arquivos exportados são gravados em blocos, direto em um arquivo binário: as planilhas
+# linha a linha pelo xlsxwriter em modo 'constant_memory' (cada linha vai para um arquivo
+# temporário assim que a seguinte começa), o CSV (opcionalmente em gzip) e o Parquet bloco
+# a bloco. Para download, o destino é um SpooledTemporaryFile, que passa para o disco acima
+# de EXPORT_SPOOL_MAX_SIZE; assim uma exportação grande não mantém ao mesmo tempo o
+# DataFrame, o arquivo em um BytesIO e sua cópia.
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+EXCEL_DATE_FORMAT = 'dd/mm/yyyy'
+EXCEL_DATETIME_FORMAT = 'dd/mm/yyyy hh:mm:ss'
+EXCEL_NUMBER_FORMAT = '#,##0.00'
+EXCEL_MONTH_FORMAT = 'mm/yyyy'
+EXCEL_PERCENT_FORMAT = '0.00%'
+
+# Tipo de RECORD_COLUMNS -> tipo Arrow no Parquet. As colunas de baixa cardinalidade
+# (regional, filial, produto...) são gravadas como dicionário, que o Power BI e o pandas
+# leem sem repetir cada texto linha a linha.
+PARQUET_TYPES = {
+    'int64': pa.int64(),
+    'float64': pa.float64(),
+    'date': pa.timestamp('ms'),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'text': pa.string(),
+}
+
+def _spooled_bytes(write):
+    """Executa `write(output)` sobre um SpooledTemporaryFile e retorna os bytes gravados."""
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as output:
+        write(output)
+        output.seek(0)
+        return output.read()
+
+def _iter_record_rows(conn, columns, where_sql="", params=(), order_sql=""):
+    """Lê os registros direto do cursor do SQLite, em blocos de EXPORT_CHUNK_SIZE tuplas."""
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {', '.join(_record_select_sql(column) for column in columns)} FROM registros {where_sql} {order_sql}",
+        list(params),
+    )
+    return itertools.chain.from_iterable(iter(lambda: cursor.fetchmany(EXPORT_CHUNK_SIZE), []))
+
+def _write_excel_value(worksheet, row, col, value):
+    """Escreve um valor de tipo livre: números como número, o resto como texto."""
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_)):
+        worksheet.write_number(row, col, value)
+    else:
+        worksheet.write_string(row, col, str(value))
+
+def _excel_cell_writer(workbook, kind):
+    """Retorna a função que escreve uma célula de uma coluna do tipo `kind` (tipos de RECORD_COLUMNS)."""
+    if kind == 'float64':
+        number_format = workbook.add_format({'num_format': EXCEL_NUMBER_FORMAT})
+        return lambda worksheet, row, col, value: worksheet.write_number(row, col, value, number_format)
+    if kind == 'int64':
+        return lambda worksheet, row, col, value: worksheet.write_number(row, col, value)
+    if kind == 'percent':
+        percent_format = workbook.add_format({'num_format': EXCEL_PERCENT_FORMAT})
+        return lambda worksheet, row, col, value: worksheet.write_number(row, col, value, percent_format)
+    if kind == 'month':
+        month_format = workbook.add_format({'num_format': EXCEL_MONTH_FORMAT})
+        return lambda worksheet, row, col, value: worksheet.write_datetime(row, col, value, month_format)
+    if kind == 'date':
+        date_format = workbook.add_format({'num_format': EXCEL_DATE_FORMAT})
+        datetime_format = workbook.add_format({'num_format': EXCEL_DATETIME_FORMAT})
+
+        def write_date(worksheet, row, col, value):
+            # Do SQLite as datas chegam como texto ISO ('2024-01-25' ou '2024-01-25 10:30:00').
+            if isinstance(value, str):
+                try:
+                    value = datetime.fromisoformat(value)
+                except ValueError:
+                    return worksheet.write_string(row, col, value)
+            has_time = isinstance(value, datetime) and (value.hour or value.minute or value.second)
+            worksheet.write_datetime(row, col, value, datetime_format if has_time else date_format)
+        return write_date
+    return _write_excel_value
+
+def _new_workbook(output):
+    """Abre um livro do xlsxwriter em modo 'constant_memory' gravando no arquivo binário `output`."""
+    return xlsxwriter.Workbook(output, {'constant_memory': True})
+
+def _write_excel_sheet(workbook, sheet_name, rows, headers, kinds):
     """
-    href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64_excel}" download="{filename}" class="download-button-custom"><img src="data:image/png;base64,{b64_logo}" width="16" style="margin-right: 8px;">{text}</a>'
-    return f"{button_css}{href}"
+    Escreve `rows` (iterável de tuplas, consumido uma única vez) em uma nova aba de `workbook`.
+    `kinds` dá o tipo de cada coluna (os de RECORD_COLUMNS, 'percent' ou 'month');
+    células None ficam vazias.
+    """
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True})
+    writers = [_excel_cell_writer(workbook, kind) for kind in kinds]
+    for col, (header, kind) in enumerate(zip(headers, kinds)):
+        worksheet.write_string(0, col, str(header), header_format)
+        if kind == 'date':
+            worksheet.set_column(col, col, 18)
+    worksheet.freeze_panes(1, 0)
+
+    for row_number, row in enumerate(rows, start=1):
+        for col, value in enumerate(row):
+            if value is not None:
+                writers[col](worksheet, row_number, col, value)
+    return worksheet
+
+def _dataframe_excel_kind(series):
+    """Tipo de coluna (como em RECORD_COLUMNS) usado para escrever uma coluna de DataFrame."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return 'date'
+    if pd.api.types.is_float_dtype(series):
+        return 'float64'
+    if pd.api.types.is_integer_dtype(series):
+        return 'int64'
+    return 'text'
+
+def _write_dataframe_sheet(workbook, sheet_name, df, kinds=None):
+    """Escreve um DataFrame em uma nova aba; `kinds` sobrepõe o tipo deduzido de algumas colunas."""
+    rows = (
+        tuple(None if pd.isna(value) else value for value in row)
+        for row in df.itertuples(index=False, name=None)
+    )
+    column_kinds = [(kinds or {}).get(column) or _dataframe_excel_kind(df[column]) for column in df.columns]
+    return _write_excel_sheet(workbook, sheet_name, rows, df.columns, column_kinds)
+
+def to_excel(df, sheet_name='Dados'):
+    """Converte um DataFrame para um arquivo Excel, escrito em fluxo (ver _write_excel_sheet)."""
+    def write(output):
+        with _new_workbook(output) as workbook:
+            _write_dataframe_sheet(workbook, sheet_name, df)
+    return _spooled_bytes(write)
+
+def _write_records_sheet(workbook, sheet_name, conn, where_sql="", params=(), order_sql="", columns=RECORD_COLUMNS):
+    """Escreve em uma nova aba os registros lidos do cursor, com os tipos de RECORD_COLUMNS."""
+    rows = _iter_record_rows(conn, columns, where_sql, params, order_sql)
+    headers = [RECORD_COLUMNS[column][0] for column in columns]
+    kinds = [RECORD_COLUMNS[column][1] for column in columns]
+    return _write_excel_sheet(workbook, sheet_name, rows, headers, kinds)
+
+def write_records_excel(conn, output, where_sql="", params=(), order_sql="", columns=RECORD_COLUMNS, sheet_name='Dados'):
+    """
+    Grava em `output` a planilha dos registros lidos do cursor, sem montar um DataFrame.
+    Cada coluna recebe o tipo e o formato de número/data de RECORD_COLUMNS.
+    """
+    with _new_workbook(output) as workbook:
+        _write_records_sheet(workbook, sheet_name, conn, where_sql, params, order_sql, columns)
 
-def get_template_excel():
-    """Cria e retorna um arquivo Excel modelo para download."""
+def write_records_csv(conn, output, where_sql="", params=(), order_sql="", columns=RECORD_COLUMNS, compress=False):
+    """
+    Grava em `output` o CSV (UTF-8, separado por vírgula) dos registros lidos do cursor.
+    Com `compress`, o arquivo é compactado em gzip enquanto é escrito. As datas saem
+    no formato ISO em que estão no banco.
+    """
+    binary = gzip.GzipFile(fileobj=output, mode='wb', mtime=0) if compress else output
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow(RECORD_COLUMNS[column][0] for column in columns)
+    writer.writerows(_iter_record_rows(conn, columns, where_sql, params, order_sql))
+    # detach() devolve o arquivo sem fechá-lo: quem abriu `output` é quem o fecha.
+    text.flush()
+    text.detach()
+    if compress:
+        binary.close()
+
+def write_records_parquet(conn, output, where_sql="", params=(), order_sql="", columns=RECORD_COLUMNS):
+    """
+    Grava em `output` um Parquet dos registros, bloco a bloco, com os tipos de PARQUET_TYPES:
+    números e datas tipados e colunas de baixa cardinalidade codificadas em dicionário.
+    """
+    schema = pa.schema([(RECORD_COLUMNS[column][0], PARQUET_TYPES[RECORD_COLUMNS[column][1]]) for column in columns])
+    with pq.ParquetWriter(output, schema) as writer:
+        for chunk in _iter_record_chunks(conn, columns, EXPORT_CHUNK_SIZE, where_sql, params, order_sql):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+def _dashboard_where(filters):
+    """Cláusula WHERE e parâmetros dos filtros do dashboard, para as funções write_records_*."""
+    conditions, params = _build_dashboard_filters(**filters)
+    return "WHERE " + " AND ".join(conditions), params
+
+# --- Relatório Gerencial ---
+# Um livro com os dados brutos e, em abas separadas, as mesmas tabelas que o dashboard
+# desenha, calculadas uma única vez no SQLite sobre o resumo diário: quem abre o relatório
+# encontra os totais prontos, sem montar tabelas dinâmicas sobre centenas de milhares de linhas.
+
+# Aba -> dimensão de DASHBOARD_SUMMARY_DIMENSIONS totalizada nela (ver get_dashboard_aggregates).
+REPORT_RANKING_SHEETS = {
+    'Receita por Regional': 'Regional',
+    'Filiais': 'Filial Remetente',
+    'Destinos': 'Destino',
+    'Produtos': 'Produto',
+}
+
+# Filtro do dashboard -> rótulo na aba 'Resumo'.
+REPORT_FILTER_LABELS = {
+    'regional': 'Regional', 'branch': 'Filial Remetente', 'product': 'Produto',
+    'destination': 'Destino', 'operation_type': 'Tipo de Operação', 'unit': 'Unidade', 'user': 'Usuário',
+}
+
+def _report_summary(filters, totals):
+    """Aba 'Resumo': período, filtros aplicados e os KPIs do dashboard."""
+    def format_date(value):
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').strftime('%d/%m/%Y')
+
+    rows = [
+        ('Período', f"{format_date(filters['start_date'])} a {format_date(filters['end_date'])}"),
+        *((label, filters[key] or FILTER_ALL_OPTION) for key, label in REPORT_FILTER_LABELS.items()),
+        ('Receita Total (R$)', totals['Valor Total']),
+        ('Quantidade Total', totals['Quantidade']),
+        ('Total de Registros', totals['Registros']),
+        ('Gerado em', datetime.now().strftime('%d/%m/%Y %H:%M')),
+    ]
+    return pd.DataFrame(rows, columns=['Item', 'Valor'])
+
+def write_dashboard_report(conn, output, filters):
+    """
+    Grava em `output` o relatório gerencial dos filtros do dashboard: 'Resumo', uma aba por
+    ranking de REPORT_RANKING_SHEETS (com o percentual da receita), 'Evolução Mensal'
+    e, por último, os dados brutos em 'Dados'.
+    """
+    # Fora da página não há cache de sessão: os resumos são calculados uma vez e reaproveitados aqui.
+    aggregates = get_dashboard_aggregates(conn, filters)
+    totals = aggregates['Totais']
+    with _new_workbook(output) as workbook:
+        _write_dataframe_sheet(workbook, 'Resumo', _report_summary(filters, totals))
+        for sheet_name, dimension in REPORT_RANKING_SHEETS.items():
+            ranking = aggregates[dimension].assign(
+                Percentual=lambda df: df['Valor Total'] / totals['Valor Total'] if totals['Valor Total'] else 0.0
+            )
+            _write_dataframe_sheet(workbook, sheet_name, ranking, {'Percentual': 'percent'})
+        monthly = _monthly_series(aggregates).rename(columns={'Data': 'Mês'})
+        _write_dataframe_sheet(workbook, 'Evolução Mensal', monthly, {'Mês': 'month'})
+        _write_records_sheet(workbook, 'Dados', conn, *_dashboard_where(filters), columns=DASHBOARD_EXPORT_COLUMNS)
+
+# --- Exportação sob Demanda ---
+# O dashboard não monta mais o arquivo a cada reexecução: st.download_button recebe uma
+# função, que o Streamlit só executa quando o usuário clica no botão. O arquivo gerado fica
+# em disco, em cache por filtros, formato e versão de dados (na memória, só o caminho), e
+# cliques repetidos com os mesmos filtros reaproveitam o arquivo pronto.
+EXPORT_CACHE_MAX_ENTRIES = 8
+
+# Colunas dos registros nos arquivos exportados pelo dashboard: as dimensões e medidas que ele
+# filtra e resume. NFe e observações só aparecem na listagem de registros e não são lidas.
+DASHBOARD_EXPORT_COLUMNS = [
+    'id', 'data', 'data_lancamento', 'usuario_lancamento', 'tipo_operacao', 'regional',
+    'filial_remetente', 'destino', 'produto', 'quantidade', 'unidade', 'preco_unitario', 'valor_total',
+]
+
+# Formato -> (rótulo do botão, extensão do arquivo, tipo MIME, função que grava em um
+# arquivo binário os registros com os filtros do dashboard).
+EXPORT_FORMATS = {
+    'xlsx': (
+        "📥 Exportar para Excel", "xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        lambda conn, output, filters: write_records_excel(
+            conn, output, *_dashboard_where(filters), columns=DASHBOARD_EXPORT_COLUMNS
+        ),
+    ),
+    'csv': (
+        "📄 Exportar para CSV", "csv", "text/csv",
+        lambda conn, output, filters: write_records_csv(
+            conn, output, *_dashboard_where(filters), columns=DASHBOARD_EXPORT_COLUMNS
+        ),
+    ),
+    'csv.gz': (
+        "🗜️ CSV compactado (gzip)", "csv.gz", "application/gzip",
+        lambda conn, output, filters: write_records_csv(
+            conn, output, *_dashboard_where(filters), columns=DASHBOARD_EXPORT_COLUMNS, compress=True
+        ),
+    ),
+    'parquet': (
+        "📦 Exportar para Parquet", "parquet", "application/vnd.apache.parquet",
+        lambda conn, output, filters: write_records_parquet(
+            conn, output, *_dashboard_where(filters), columns=DASHBOARD_EXPORT_COLUMNS
+        ),
+    ),
+    'relatorio': (
+        "📊 Relatório Gerencial", "xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        write_dashboard_report,
+    ),
+}
+
+def write_dashboard_export(conn, output, filters, file_format):
+    """
+    Grava em `output` os registros com os filtros do dashboard (os mesmos de
+    `_build_dashboard_filters`) no formato `file_format`, uma das chaves de EXPORT_FORMATS.
+    """
+    EXPORT_FORMATS[file_format][3](conn, output, filters)
+
+@st.cache_resource(show_spinner=False)
+def _export_files():
+    """
+    Cria uma única vez por processo o cache dos arquivos exportados: um OrderedDict
+    (chave -> caminho do arquivo), do usado há mais tempo ao mais recente, e o lock que o protege.
+    """
+    return OrderedDict(), threading.Lock()
+
+def _cached_export_path(db_path, filters, file_format, data_version):
+    """
+    Retorna o caminho do arquivo exportado dos registros filtrados, gerando-o em um arquivo
+    temporário se não estiver no cache; `filters` vem congelado em tuplas e `data_version`
+    invalida o cache após escritas em 'registros'. Acima de EXPORT_CACHE_MAX_ENTRIES
+    arquivos, o usado há mais tempo é apagado.
+    Roda fora da reexecução da página, por isso usa uma conexão de leitura própria do pool.
+    """
+    files, lock = _export_files()
+    key = (db_path, filters, file_format, data_version)
+    with lock:
+        path = files.get(key)
+        if path is not None and os.path.exists(path):
+            files.move_to_end(key)
+            return path
+
+    handle, path = tempfile.mkstemp(prefix="exportacao_", suffix="." + EXPORT_FORMATS[file_format][1])
+    conn = database.get_pool(db_path).acquire()
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            write_dashboard_export(conn, output, dict(filters), file_format)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        conn.close()
+
+    with lock:
+        if key in files:
+            # Outro clique gerou o mesmo arquivo ao mesmo tempo: fica o que chegou primeiro.
+            os.remove(path)
+            path = files[key]
+        files[key] = path
+        files.move_to_end(key)
+        while len(files) > EXPORT_CACHE_MAX_ENTRIES:
+            _, old_path = files.popitem(last=False)
+            with contextlib.suppress(OSError):
+                os.remove(old_path)
+    return path
+
+def _cached_export(db_path, filters, file_format, data_version):
+    """Lê o arquivo exportado de _cached_export_path para o download."""
+    with open(_cached_export_path(db_path, filters, file_format, data_version), 'rb') as file:
+        return file.read()
+
+def export_download_data(conn, filters, file_format):
+    """
+    Retorna a função a ser passada em `data` do st.download_button: o arquivo no formato
+    `file_format` com os registros dos filtros do dashboard, gerado apenas no clique.
+    """
+    db_path = conn.pool.db_path
+    key = (_freeze_cache_arg(filters), file_format, get_data_version(conn))
+    return lambda: _cached_export(db_path, *key)
+
+def _template_dataframe():
+    """Linha de exemplo com as colunas da planilha modelo de importação."""
     # A ordem das colunas foi ajustada para corresponder à estrutura do arquivo do usuário.
     template_data = {
         'Tipo de Operação': ['Venda'],
@@ -1178,133 +1853,795 @@ def get_template_excel():
         'NFe': ['123456'],
         'Observacoes': ['Exemplo de observação.']
     }
-    df_template = pd.DataFrame(template_data)
-    return to_excel(df_template)
+    return pd.DataFrame(template_data)
+
+def get_template_excel():
+    """Cria e retorna um arquivo Excel modelo para download."""
+    return to_excel(_template_dataframe())
+
+def get_template_csv():
+    """Cria e retorna um CSV modelo para download, no padrão brasileiro (';' e vírgula decimal)."""
+    csv_text = _template_dataframe().to_csv(sep=IMPORT_CSV_SEPARATOR, decimal=',', index=False)
+    # Com BOM, o Excel abre o arquivo com os acentos corretos.
+    return csv_text.encode('utf-8-sig')
+
+# --- Importação de Planilhas ---
+# Aceita Excel (.xlsx), CSV e Parquet, escolhidos pela extensão do arquivo. Todos os formatos
+# chegam ao mesmo pipeline: blocos de IMPORT_CHUNK_SIZE linhas, com os cabeçalhos originais e
+# o número da linha no índice, que são normalizados, validados e gravados pelo escritor único.
+# - Excel: as abas são lidas com o openpyxl em modo somente leitura por um pool de processos
+#   (ler XLSX consome CPU e, em threads, ficaria preso ao GIL), em paralelo com a gravação;
+# - CSV: lido em blocos pelo parser em C do pandas, no padrão brasileiro (';' e vírgula decimal);
+# - Parquet: lido em lotes, apenas com as colunas do modelo, já tipado (sem passar por texto).
+IMPORT_CHUNK_SIZE = 5000
+# Máximo de linhas com erro guardadas para o relatório; as demais são apenas contadas.
+MAX_IMPORT_ERROR_ROWS = 10000
+
+# Cabeçalho normalizado (minúsculo, sem acentos) -> coluna do banco.
+IMPORT_COLUMN_ALIASES = {
+    'tipo de operacao': 'tipo_operacao',
+    'filial remetente': 'filial_remetente',
+    'preco unitario': 'preco_unitario',
+    'valor total': 'valor_total',
+}
+IMPORT_REQUIRED_COLUMNS = [
+    "tipo_operacao", "regional", "filial_remetente", "data", "produto", "destino",
+    "quantidade", "unidade", "preco_unitario"
+]
+IMPORT_OPTIONAL_COLUMNS = ["nfe", "observacoes"]
+# Colunas que o Parquet pode trazer já tipadas (número ou data); as demais são texto.
+IMPORT_TYPED_COLUMNS = ["data", "quantidade", "preco_unitario"]
+# Extensões aceitas no upload.
+IMPORT_FILE_TYPES = ["xlsx", "csv", "parquet"]
+# Separador padrão dos CSVs (o padrão brasileiro, já que a vírgula é o separador decimal).
+IMPORT_CSV_SEPARATOR = ";"
+
+# Processos que leem e validam as abas das planilhas em paralelo.
+IMPORT_PARSE_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# Blocos já lidos e validados à espera do escritor. Limita a memória da importação: quando a
+# fila enche, os processos de leitura esperam a gravação alcançá-los.
+IMPORT_MAX_PENDING_CHUNKS = 2 * IMPORT_PARSE_WORKERS
+
+# Linhas gravadas por transação na inserção em massa.
+BULK_INSERT_BATCH_SIZE = 5000
+# A partir deste número de linhas, a importação recria os índices só no final.
+BULK_DEFER_INDEXES_ROWS = 100000
+
+def _normalize_import_header(name):
+    """Normaliza um cabeçalho da planilha (ex: 'Preço Unitário' -> 'preco_unitario')."""
+    normalized = unicodedata.normalize("NFKD", str(name).strip().lower())
+    normalized = normalized.encode("ascii", "ignore").decode("utf-8")
+    return IMPORT_COLUMN_ALIASES.get(normalized, normalized)
+
+def _excel_cell_to_text(value):
+    """Converte o valor de uma célula para texto, como o pd.read_excel(dtype=str) faria."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _list_import_sheets(file_data):
+    """Retorna as abas da planilha como tuplas (nome, número estimado de linhas de dados)."""
+    workbook = openpyxl.load_workbook(io.BytesIO(file_data), read_only=True, data_only=True)
+    try:
+        return [(sheet.title, max((sheet.max_row or 0) - 1, 0)) for sheet in workbook.worksheets]
+    finally:
+        workbook.close()
 
-def process_excel_upload(conn, user_name, uploaded_file):
+def _iter_excel_chunks(uploaded_file, chunk_size=IMPORT_CHUNK_SIZE, sheet_name=None):
     """
-    Processa o upload de uma planilha Excel e insere os registros no banco de dados.
-    Esta versão foi otimizada para performance e robustez, fornecendo feedback detalhado sobre erros.
+    Lê uma aba da planilha (a primeira, se `sheet_name` não for informado) com o openpyxl
+    em modo somente leitura e gera tuplas (total_estimado_de_linhas, DataFrame) com até
+    `chunk_size` linhas cada.
+    Os valores vêm como texto, com os cabeçalhos originais; o índice é o número da linha
+    na planilha. Linhas totalmente em branco são ignoradas.
     """
-    if uploaded_file is None:
-        st.warning("Por favor, faça o upload de um arquivo Excel.")
-        return
+    workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name is not None else workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header_row = next(rows, None)
+        if header_row is None:
+            return
 
+        # Cabeçalhos vazios ou repetidos recebem nomes únicos, como no pandas.
+        header, seen = [], {}
+        for position, value in enumerate(header_row):
+            name = _excel_cell_to_text(value) or f"Unnamed: {position}"
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            header.append(name)
+
+        total_rows = max((sheet.max_row or 0) - 1, 0)
+        width = len(header)
+        buffer, row_numbers = [], []
+        for row_number, row in enumerate(rows, start=2):
+            values = [_excel_cell_to_text(value) for value in row[:width]]
+            if not any(value.strip() for value in values):
+                continue
+            values += [''] * (width - len(values))
+            buffer.append(values)
+            row_numbers.append(row_number)
+            if len(buffer) >= chunk_size:
+                yield total_rows, pd.DataFrame(buffer, columns=header, index=row_numbers)
+                buffer, row_numbers = [], []
+        if buffer:
+            yield total_rows, pd.DataFrame(buffer, columns=header, index=row_numbers)
+    finally:
+        workbook.close()
+
+def _parse_import_dates(values):
+    """
+    Converte as datas da planilha. Células de data chegam como texto ISO ('2024-01-25 00:00:00')
+    e são lidas nesse formato; as digitadas como texto são lidas no padrão brasileiro (dia primeiro).
+    O formato não é inferido pela primeira linha, para que o resultado não dependa dos blocos.
+    Colunas já em formato de data (Parquet) são mantidas.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.tz_localize(None) if values.dt.tz is not None else values
+    dates = pd.to_datetime(values, errors='coerce', format='ISO8601')
+    typed_text = dates.isna() & (values != '')
+    if typed_text.any():
+        dates[typed_text] = pd.to_datetime(values[typed_text], errors='coerce', format='mixed', dayfirst=True)
+    return dates
+
+def _parse_import_numbers(values):
+    """
+    Converte uma coluna numérica da planilha. Textos com vírgula seguem o padrão brasileiro
+    ('1.234,56'); os demais usam ponto decimal. Colunas já numéricas (Parquet) são mantidas.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_numeric(values, errors='coerce').astype('float64')
+    has_comma = values.str.contains(',', regex=False)
+    brazilian = values.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    return pd.to_numeric(values.where(~has_comma, brazilian), errors='coerce')
+
+def _prepare_import_chunk(chunk, user_name):
+    """
+    Normaliza e valida um bloco da planilha (cabeçalhos originais; valores em texto, exceto
+    as colunas de IMPORT_TYPED_COLUMNS que o Parquet já traz tipadas).
+    Retorna (df_to_insert, df_invalid, rule_counts): as linhas válidas já no formato da tabela,
+    as linhas inválidas com os valores originais, o número da linha e o motivo do erro, e o
+    número de linhas que violaram cada regra.
+    """
+    df = chunk.set_axis([_normalize_import_header(col) for col in chunk.columns], axis=1)
+
+    # 3. Limpeza e Conversão de Tipos
+    for col in ['tipo_operacao', 'regional', 'filial_remetente', 'destino', 'produto', 'unidade']:
+        df[col] = df[col].str.strip().str.title()
+
+    # Adiciona colunas opcionais se não existirem
+    for col in IMPORT_OPTIONAL_COLUMNS:
+        if col not in df.columns: df[col] = ''
+    df['nfe'] = df['nfe'].str.strip()
+    df['observacoes'] = df['observacoes'].str.strip()
+
+    # Converte tipos de dados, tratando erros e formatos (ex: vírgula decimal)
+    df['data'] = _parse_import_dates(df['data'])
+    df['quantidade'] = _parse_import_numbers(df['quantidade'])
+    df['preco_unitario'] = _parse_import_numbers(df['preco_unitario'])
+
+    # 4. Validação Detalhada e Separação de Dados
+    invalid_mask, reasons, rule_counts = validate_records(df)
+
+    df_valid = df[~invalid_mask].copy()
+    df_invalid = chunk[invalid_mask].copy()
+
+    # Gera a coluna de motivo do erro para o relatório
+    if not df_invalid.empty:
+        df_invalid['Motivo do Erro'] = reasons
+        df_invalid.insert(0, 'Linha', df_invalid.index)
+
+    # 5. Preparação dos Dados Válidos
+    # PERFORMANCE: Cálculo vetorizado, muito mais rápido que df.apply
+    df_valid['valor_total'] = (df_valid['quantidade'] * df_valid['preco_unitario']).round(2)
+    df_valid['data'] = df_valid['data'].dt.strftime('%Y-%m-%d')
+    # Adiciona as informações de quem e quando o registro foi adicionado
+    df_valid['usuario_lancamento'] = user_name
+    # Hash do conteúdo: linhas já importadas antes são ignoradas na gravação. As repetidas
+    # dentro do arquivo são numeradas depois, por _number_repeated_rows.
+    df_valid['hash_importacao'] = [
+        database.import_hash(values)
+        for values in zip(*(_sql_values(df_valid[col]) for col in database.IMPORT_HASH_COLUMNS))
+    ]
+
+    final_columns_to_insert = IMPORT_REQUIRED_COLUMNS + IMPORT_OPTIONAL_COLUMNS + ['valor_total', 'usuario_lancamento', 'hash_importacao']
+    return df_valid[final_columns_to_insert], df_invalid, rule_counts
+
+def _number_repeated_rows(df_to_insert, occurrences):
+    """
+    Troca o hash das linhas de conteúdo repetido no arquivo pelo da sua ocorrência (2ª, 3ª...,
+    ver database.import_hash), para que linhas iguais repetidas na planilha sejam todas
+    gravadas. `occurrences` conta as linhas de cada conteúdo já vistas (hash -> quantidade) e é
+    compartilhado por todos os blocos e abas de um mesmo arquivo; por isso a numeração é feita
+    pelo escritor, e não nos processos de leitura. Como as linhas repetidas são iguais, a ordem
+    de chegada dos blocos não muda o conjunto de hashes do arquivo.
+    """
+    hashes = df_to_insert['hash_importacao'].tolist()
+    rows = None
+    for position, content_hash in enumerate(hashes):
+        occurrence = occurrences.get(content_hash, 0)
+        occurrences[content_hash] = occurrence + 1
+        if occurrence:
+            if rows is None:
+                rows = list(zip(*(_sql_values(df_to_insert[col]) for col in database.IMPORT_HASH_COLUMNS)))
+            hashes[position] = database.import_hash(rows[position], occurrence)
+    if rows is None:
+        return df_to_insert
+    return df_to_insert.assign(hash_importacao=hashes)
+
+def _csv_encoding(file_data):
+    """Detecta a codificação do CSV: UTF-8 (com ou sem BOM) ou, se não for válido, Windows-1252."""
     try:
-        # 1. Leitura e Normalização de Colunas
-        df = pd.read_excel(uploaded_file, dtype=str).fillna('')
-        df_original_for_report = df.copy() # Cópia para o relatório de erros
-
-        df.columns = (
-            df.columns.str.strip()
-            .str.lower()
-            .str.normalize("NFKD")
-            .str.encode("ascii", "ignore")
-            .str.decode("utf-8")
+        codecs.getincrementaldecoder("utf-8")().decode(file_data[:1 << 20], final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+def _iter_csv_chunks(file_data, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Lê um CSV em blocos e gera tuplas (total_estimado_de_linhas, DataFrame) no mesmo formato
+    de _iter_excel_chunks: valores em texto, cabeçalhos originais e o número da linha no índice.
+    O separador é ';', a menos que o cabeçalho só tenha vírgulas.
+    """
+    encoding = _csv_encoding(file_data)
+    header_line = file_data.split(b"\n", 1)[0].decode(encoding, errors="replace")
+    separator = "," if IMPORT_CSV_SEPARATOR not in header_line and "," in header_line else IMPORT_CSV_SEPARATOR
+    total_rows = max(file_data.count(b"\n") - 1, 0)
+
+    reader = pd.read_csv(
+        io.BytesIO(file_data), sep=separator, encoding=encoding, dtype=str,
+        keep_default_na=False, skip_blank_lines=False, chunksize=chunk_size,
+    )
+    next_row = 2
+    for chunk in reader:
+        chunk.index = pd.RangeIndex(next_row, next_row + len(chunk))
+        next_row += len(chunk)
+        # Linhas vazias ou só com separadores (ex: ';;;') são ignoradas, como no Excel. Elas não
+        # são descartadas pelo parser, para que o índice continue sendo o número da linha.
+        filled = chunk.apply(lambda column: column.fillna('').str.strip() != '').any(axis=1)
+        if filled.any():
+            yield total_rows, chunk[filled]
+
+def _iter_parquet_chunks(file_data, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Lê um Parquet em lotes e gera tuplas (total_de_linhas, DataFrame) para o pipeline de importação.
+    Só as colunas do modelo são lidas. Textos vêm como strings do Arrow (sem cópia para objetos
+    Python) e números e datas chegam já tipados; o índice é o número do registro no arquivo.
+    Colunas de texto gravadas com outro tipo (ex: NFe numérica) são convertidas como no Excel.
+    """
+    parquet_file = pq.ParquetFile(io.BytesIO(file_data))
+    known_columns = set(IMPORT_REQUIRED_COLUMNS + IMPORT_OPTIONAL_COLUMNS)
+    columns = [name for name in parquet_file.schema_arrow.names if _normalize_import_header(name) in known_columns]
+    total_rows = parquet_file.metadata.num_rows
+    arrow_strings = pd.StringDtype("pyarrow")
+
+    next_row = 1
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        chunk = batch.to_pandas(
+            types_mapper={pa.string(): arrow_strings, pa.large_string(): arrow_strings}.get, date_as_object=False
         )
-        df.rename(columns={
-            'tipo de operacao': 'tipo_operacao',
-            'filial remetente': 'filial_remetente',
-            'preco unitario': 'preco_unitario',
-            'preço unitario': 'preco_unitario',
-            'preço unitário': 'preco_unitario',
-            'valor total': 'valor_total',
-            'nfe': 'nfe',
-            'observacoes': 'observacoes'
-        }, inplace=True)
+        chunk.index = pd.RangeIndex(next_row, next_row + len(chunk))
+        next_row += len(chunk)
+        for name in chunk.columns:
+            if _normalize_import_header(name) in IMPORT_TYPED_COLUMNS:
+                continue
+            if chunk[name].dtype != arrow_strings:
+                chunk[name] = chunk[name].astype(object).map(_excel_cell_to_text).astype(arrow_strings)
+            chunk[name] = chunk[name].fillna('')
+        yield total_rows, chunk
+
+def _check_import_columns(chunk):
+    """Levanta ValueError se faltarem colunas obrigatórias no cabeçalho do bloco."""
+    columns = {_normalize_import_header(col) for col in chunk.columns}
+    missing_columns = [col for col in IMPORT_REQUIRED_COLUMNS if col not in columns]
+    if missing_columns:
+        raise ValueError(f"A planilha está com colunas faltando ou com nomes incorretos: {', '.join(missing_columns)}")
+
+# Nos processos do pool de leitura: a fila por onde os blocos lidos chegam ao escritor e o
+# número do job em andamento (ver _get_parse_pool).
+_parsed_chunks = None
+_current_parse_job = None
+# Números dos jobs de leitura, que identificam as mensagens de cada importação na fila.
+_parse_job_ids = itertools.count(1)
+
+def _init_parse_worker(parsed_chunks, current_parse_job):
+    """Inicializa um processo do pool de leitura com a fila de blocos e o job em andamento."""
+    global _parsed_chunks, _current_parse_job
+    _parsed_chunks, _current_parse_job = parsed_chunks, current_parse_job
+
+def _send_parsed(job, message):
+    """
+    Envia ao escritor uma mensagem (tipo, aba, conteúdo) do job `job`, esperando enquanto a
+    fila estiver cheia. Retorna False, sem enviar, se o job foi interrompido no escritor.
+    """
+    while _current_parse_job.value == job:
+        try:
+            _parsed_chunks.put((job, *message), timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-        # 2. Verificação de Colunas Essenciais
-        required_columns = [
-            "tipo_operacao", "regional", "filial_remetente", "data", "produto", "destino",
-            "quantidade", "unidade", "preco_unitario"
-        ]
-        optional_columns = ["nfe", "observacoes"]
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            st.error(f"❌ A planilha está com colunas faltando ou com nomes incorretos: {', '.join(missing_columns)}")
+def _parse_import_sheet(job, path, sheet_name, user_name, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Lê e valida uma aba da planilha gravada em `path`. Roda em um processo do pool de leitura
+    (ver _get_parse_pool) e envia ao escritor cada bloco de _prepare_import_chunk assim que fica
+    pronto, como ('chunk', aba, (df_to_insert, df_invalid, rule_counts)), e ('done', aba, None)
+    no final. Se faltarem colunas obrigatórias na aba, envia apenas ('skipped', aba, mensagem).
+    """
+    for i, (_, chunk) in enumerate(_iter_excel_chunks(path, chunk_size, sheet_name)):
+        if i == 0:
+            try:
+                _check_import_columns(chunk)
+            except ValueError as e:
+                _send_parsed(job, ('skipped', sheet_name, str(e)))
+                return
+        if not _send_parsed(job, ('chunk', sheet_name, _prepare_import_chunk(chunk, user_name))):
             return
+    _send_parsed(job, ('done', sheet_name, None))
 
-        # 3. Limpeza e Conversão de Tipos
-        df['tipo_operacao'] = df['tipo_operacao'].str.strip().str.title()
-        df['regional'] = df['regional'].str.strip().str.title()
-        df['filial_remetente'] = df['filial_remetente'].str.strip().str.title()
-        df['destino'] = df['destino'].str.strip().str.title()
-        df['produto'] = df['produto'].str.strip().str.title()
-        df['unidade'] = df['unidade'].str.strip().str.title()
-
-        # Adiciona colunas opcionais se não existirem
-        for col in optional_columns:
-            if col not in df.columns: df[col] = ''
-        df['nfe'] = df['nfe'].str.strip()
-        df['observacoes'] = df['observacoes'].str.strip()
-
-        # Converte tipos de dados, tratando erros e formatos (ex: vírgula decimal)
-        df['data'] = pd.to_datetime(df['data'], errors='coerce', dayfirst=True)
-        df['quantidade'] = pd.to_numeric(df['quantidade'].str.replace(',', '.', regex=False), errors='coerce')
-        df['preco_unitario'] = pd.to_numeric(df['preco_unitario'].str.replace(',', '.', regex=False), errors='coerce')
-
-        # 4. Validação Detalhada e Separação de Dados
-        error_conditions = {
-            "Data inválida ou em branco": df['data'].isna(),
-            "Quantidade inválida, não numérica ou em branco": df['quantidade'].isna(),
-            "Preço unitário inválido, não numérico ou em branco": df['preco_unitario'].isna(),
-            "Quantidade deve ser maior que zero": df['quantidade'] <= 0,
-            "Campo 'Tipo de Operação' obrigatório não preenchido": df['tipo_operacao'] == '',
-            "Campo 'Regional' obrigatório não preenchido": df['regional'] == '',
-            "Campo 'Produto' obrigatório não preenchido": df['produto'] == '',
-            "Campo 'Unidade' obrigatório não preenchido": df['unidade'] == '',
-        }
+@st.cache_resource(show_spinner=False)
+def _get_parse_pool():
+    """
+    Cria uma única vez por processo o pool de processos que lê as planilhas, com a fila por
+    onde os blocos lidos chegam ao escritor (no máximo IMPORT_MAX_PENDING_CHUNKS), o número
+    do job em andamento e o lock que deixa um job por vez no pool.
+    Usa 'spawn': o servidor do Streamlit tem várias threads, e um fork copiaria locks em uso.
+    """
+    context = multiprocessing.get_context("spawn")
+    parsed_chunks = context.Queue(maxsize=IMPORT_MAX_PENDING_CHUNKS)
+    current_parse_job = context.Value('q', 0)
+    pool = ProcessPoolExecutor(
+        max_workers=IMPORT_PARSE_WORKERS, mp_context=context,
+        initializer=_init_parse_worker, initargs=(parsed_chunks, current_parse_job),
+    )
+    return pool, parsed_chunks, current_parse_job, threading.Lock()
 
-        # Cria uma máscara booleana para identificar todas as linhas inválidas
-        invalid_mask = pd.Series(False, index=df.index)
-        for condition in error_conditions.values():
-            invalid_mask |= condition
-
-        df_valid = df[~invalid_mask].copy()
-        df_invalid = df_original_for_report[invalid_mask].copy()
-
-        # Gera a coluna de motivo do erro para o relatório
-        if not df_invalid.empty:
-            error_messages = pd.Series('', index=df_invalid.index)
-            for reason, condition in error_conditions.items():
-                # Aplica a condição na máscara de linhas inválidas
-                rows_with_this_error = condition[invalid_mask]
-                error_messages.loc[rows_with_this_error] = error_messages.loc[rows_with_this_error].apply(lambda x: (x + '; ' if x else '') + reason)
-            df_invalid['Motivo do Erro'] = error_messages
-
-        # 5. Processamento dos Dados Válidos
-        if df_valid.empty:
-            st.error("❌ Nenhum registro válido encontrado na planilha para importação.")
+def _iter_parsed_sheets(file_data, sheets, user_name, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Lê e valida as abas `sheets` da planilha no pool de leitura, até IMPORT_PARSE_WORKERS ao
+    mesmo tempo, e gera as mensagens (tipo, aba, conteúdo) de _parse_import_sheet à medida que
+    chegam, exceto as de fim de aba. Os processos recebem o caminho de uma cópia temporária do
+    arquivo, e não o seu conteúdo. Se a gravação parar no meio (exceção ou gerador fechado),
+    os processos abandonam o job no próximo bloco.
+    """
+    pool, parsed_chunks, current_parse_job, lock = _get_parse_pool()
+    with lock:
+        job = next(_parse_job_ids)
+        current_parse_job.value = job
+        handle, path = tempfile.mkstemp(suffix=".xlsx")
+        with os.fdopen(handle, 'wb') as file:
+            file.write(file_data)
+        futures = []
+        try:
+            futures = [pool.submit(_parse_import_sheet, job, path, sheet_name, user_name, chunk_size) for sheet_name, _ in sheets]
+            remaining = len(futures)
+            while remaining:
+                try:
+                    message_job, kind, sheet_name, content = parsed_chunks.get(timeout=1)
+                except queue.Empty:
+                    failed = next((future for future in futures if future.done() and future.exception() is not None), None)
+                    if failed is not None:
+                        raise failed.exception()
+                    continue
+                if message_job != job:
+                    # Sobra de um job interrompido.
+                    continue
+                if kind != 'chunk':
+                    remaining -= 1
+                if kind != 'done':
+                    yield kind, sheet_name, content
+        except BrokenProcessPool:
+            # Um processo de leitura morreu (ex: falta de memória): o próximo job cria um pool novo.
+            _get_parse_pool.clear()
+            raise
+        finally:
+            current_parse_job.value = 0
+            wait(futures)
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+def _sql_values(series):
+    """Converte uma coluna em uma lista de valores Python aceitos pelo sqlite3 (NaN/NA -> None)."""
+    return series.astype(object).where(series.notna(), None).tolist()
+
+def _base_rows(cursor, df):
+    """
+    Cadastra, na transação de `cursor`, as opções novas de `df` nas tabelas de configuração e
+    retorna (colunas, linhas) para 'registros_base', com os nomes trocados pelas chaves.
+    """
+    option_ids = {}
+    for column, table_name in database.DIMENSION_TABLES.items():
+        if column not in df.columns:
+            continue
+        names = [name for name in df[column].dropna().unique() if name != '']
+        cursor.executemany(f"INSERT OR IGNORE INTO {table_name} (name) VALUES (?)", [(name,) for name in names])
+        cursor.execute(f"SELECT name, id FROM {table_name}")
+        option_ids[column] = dict(cursor.fetchall())
+
+    # Monta as linhas a partir das colunas (sem iterar linha a linha no pandas).
+    columns, column_values = [], []
+    for column in df.columns:
+        values = df[column]
+        if column in option_ids:
+            values = values.map(option_ids[column]).astype('Int64')
+        columns.append(database.base_column(column))
+        column_values.append(_sql_values(values))
+    return columns, list(zip(*column_values))
+
+def bulk_insert_records(conn, df, batch_size=BULK_INSERT_BATCH_SIZE):
+    """
+    Insere em massa um DataFrame com colunas de 'registros' (ex: saída de _prepare_import_chunk).
+    Com a coluna 'hash_importacao', linhas já gravadas antes são ignoradas.
+    Em vez de passar pela view linha a linha (to_sql), cadastra de uma vez as opções novas,
+    converte os nomes em chaves e grava direto em 'registros_base' com executemany sobre
+    um único INSERT preparado (ver database.bulk_insert_base_rows), em uma transação por
+    lote de `batch_size` linhas (a primeira também cadastra as opções), com os triggers por
+    linha desligados (ver database.deferred_triggers; quem grava vários DataFrames seguidos
+    pode envolver a carga toda). Assim, um bloco da importação é gravado com um único commit.
+    Retorna o número de registros inseridos (sem contar os ignorados).
+    """
+    if df.empty:
+        return 0
+
+    inserted = 0
+    with database.deferred_triggers(conn):
+        for start in range(0, len(df), batch_size):
+            with database.write_transaction(conn) as cursor:
+                if start == 0:
+                    columns, rows = _base_rows(cursor, df)
+                inserted += database.bulk_insert_base_rows(cursor, columns, rows[start:start + batch_size])
+    return inserted
+
+def _import_file_type(file_name):
+    """Retorna o formato do arquivo pela extensão ('xlsx', 'csv' ou 'parquet'), ou levanta ValueError."""
+    extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+    if extension not in IMPORT_FILE_TYPES:
+        raise ValueError(f"Formato de arquivo não suportado: '.{extension}'. Use {', '.join('.' + t for t in IMPORT_FILE_TYPES)}.")
+    return extension
+
+def import_file(conn, user_name, file_name, file_data, chunk_size=IMPORT_CHUNK_SIZE, on_progress=None):
+    """
+    Importa um arquivo (Excel, CSV ou Parquet, pela extensão de `file_name`) para o banco, sem
+    interface: é o trabalho feito por cada job da fila de importações (ver submit_import_job).
+    - Excel: as abas são lidas e validadas em paralelo pelo pool de processos (ver
+      _iter_parsed_sheets), e cada bloco é gravado assim que chega. Abas sem as colunas
+      obrigatórias são ignoradas e listadas em 'skipped_sheets';
+    - CSV e Parquet: o arquivo é lido como uma única sequência de blocos.
+    No máximo IMPORT_MAX_PENDING_CHUNKS blocos lidos esperam pela gravação, então o uso de
+    memória não depende do tamanho do arquivo.
+    Cada bloco é gravado em suas próprias transações. Erros de gravação de um bloco são
+    registrados e a importação continua nos blocos seguintes. Linhas já importadas (mesmo
+    hash de conteúdo) são ignoradas, então reenviar o mesmo arquivo não duplica registros.
+    `on_progress(linhas_lidas, total_de_linhas, inseridos)` é chamado ao fim de cada bloco.
+    Retorna um dicionário com os totais, as contagens por motivo de erro, os erros de gravação
+    e as linhas inválidas (limitadas a MAX_IMPORT_ERROR_ROWS). Levanta ValueError se o formato
+    não for suportado ou se faltarem colunas obrigatórias (em todas as abas, no Excel).
+    """
+    file_type = _import_file_type(file_name)
+    if file_type == 'xlsx':
+        sheets = _list_import_sheets(file_data)
+        total_rows = sum(rows for _, rows in sheets)
+        stream = None
+    else:
+        sheets = []
+        stream = (_iter_csv_chunks if file_type == 'csv' else _iter_parquet_chunks)(file_data, chunk_size)
+        first = next(stream, None)
+        total_rows = first[0] if first else 0
+    result = {
+        'total_rows': total_rows, 'rows_read': 0, 'inserted': 0, 'duplicates': 0,
+        'invalid': 0, 'rule_counts': {}, 'chunk_errors': [], 'skipped_sheets': [], 'invalid_rows': None,
+    }
+    invalid_reports = []
+    column_errors = []
+    occurrences = {}
+
+    def write_chunk(sheet_name, df_to_insert, df_invalid, chunk_rule_counts):
+        df_to_insert = _number_repeated_rows(df_to_insert, occurrences)
+        result['rows_read'] += len(df_to_insert) + len(df_invalid)
+        result['invalid'] += len(df_invalid)
+        for reason, count in chunk_rule_counts.items():
+            result['rule_counts'][reason] = result['rule_counts'].get(reason, 0) + count
+        kept_rows = sum(len(report) for report in invalid_reports)
+        if not df_invalid.empty and kept_rows < MAX_IMPORT_ERROR_ROWS:
+            if len(sheets) > 1:
+                df_invalid.insert(0, 'Aba', sheet_name)
+            invalid_reports.append(df_invalid.head(MAX_IMPORT_ERROR_ROWS - kept_rows))
+
+        if not df_to_insert.empty:
+            try:
+                # A coluna 'data_lancamento' será preenchida pelo DEFAULT CURRENT_TIMESTAMP do banco.
+                chunk_inserted = bulk_insert_records(conn, df_to_insert)
+                result['inserted'] += chunk_inserted
+                result['duplicates'] += len(df_to_insert) - chunk_inserted
+            except Error as e:
+                location = f"Aba '{sheet_name}', linhas" if len(sheets) > 1 else "Linhas"
+                result['chunk_errors'].append(f"{location} {df_to_insert.index[0]} a {df_to_insert.index[-1]}: {e}")
+
+        if on_progress is not None:
+            on_progress(result['rows_read'], result['total_rows'], result['inserted'])
+
+    # Os triggers por linha ficam desligados durante todo o arquivo e, em cargas muito
+    # grandes, os índices são recriados uma única vez no final.
+    with contextlib.ExitStack() as index_maintenance:
+        if result['total_rows'] >= BULK_DEFER_INDEXES_ROWS:
+            index_maintenance.enter_context(database.deferred_indexes(conn))
+        index_maintenance.enter_context(database.deferred_triggers(conn))
+        if stream is not None:
+            if first is not None:
+                _check_import_columns(first[1])
+                for _, chunk in itertools.chain([first], stream):
+                    write_chunk(None, *_prepare_import_chunk(chunk, user_name))
         else:
-            # PERFORMANCE: Cálculo vetorizado, muito mais rápido que df.apply
-            df_valid['valor_total'] = (df_valid['quantidade'] * df_valid['preco_unitario']).round(2)
-            df_valid['data'] = df_valid['data'].dt.strftime('%Y-%m-%d')
-            # Adiciona as informações de quem e quando o registro foi adicionado
-            df_valid['usuario_lancamento'] = user_name
-
-            # Prepara o DataFrame final para inserção no banco
-            final_columns_to_insert = required_columns + optional_columns + ['valor_total', 'usuario_lancamento']
-            df_to_insert = df_valid[final_columns_to_insert]
-
-            # Insere o DataFrame diretamente no banco de dados (mais performático)
-            # A coluna 'data_lancamento' será preenchida pelo DEFAULT CURRENT_TIMESTAMP do banco.
-            df_to_insert.to_sql('registros', conn, if_exists='append', index=False)
-            conn.commit()
-            
-            log_activity(conn, user_name, "Importação de Planilha", f"{len(df_valid)} registros adicionados.")
-            st.success(f"✅ Importação concluída! {len(df_valid)} registros adicionados com sucesso.")
-
-        # 6. Feedback Detalhado sobre Erros
-        if not df_invalid.empty:
-            st.warning(f"⚠️ {len(df_invalid)} linhas foram ignoradas por conterem dados inválidos ou incompletos.")
-            with st.expander("Ver detalhes das linhas com erro"):
-                st.dataframe(df_invalid, use_container_width=True)
-                st.download_button(
-                    label="📥 Baixar Relatório de Erros",
-                    data=to_excel(df_invalid),
-                    file_name=f"relatorio_erros_importacao_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-
-    except Exception as e:
-        st.error(f"❌ Ocorreu um erro inesperado ao processar o arquivo Excel: {e}")
\ No newline at end of file
+            for kind, sheet_name, content in _iter_parsed_sheets(file_data, sheets, user_name, chunk_size):
+                if kind == 'skipped':
+                    column_errors.append(content)
+                    result['skipped_sheets'].append(f"Aba '{sheet_name}': {content}")
+                else:
+                    write_chunk(sheet_name, *content)
+
+    if len(column_errors) == len(sheets) and column_errors:
+        raise ValueError(column_errors[0])
+    # Planilhas gravadas sem as dimensões da aba não informam o total de antemão.
+    result['total_rows'] = max(result['total_rows'], result['rows_read'])
+    if invalid_reports:
+        result['invalid_rows'] = pd.concat(invalid_reports)
+    if result['inserted']:
+        details = f"{result['inserted']} registros adicionados."
+        if result['duplicates']:
+            details += f" {result['duplicates']} duplicados ignorados."
+        log_activity(conn, user_name, "Importação de Planilha", details)
+    return result
+
+# --- Fila de Importações ---
+# As planilhas enviadas viram jobs na tabela 'import_jobs' e são processadas em segundo plano,
+# uma de cada vez (o banco tem um único escritor), fora do rerun da página de upload; a leitura
+# das abas é dividida entre os processos do pool de leitura. A página só lê a situação dos
+# jobs, e o arquivo fica no banco até ser processado.
+
+IMPORT_JOB_STATUS = {
+    'pendente': "⏳ Na fila",
+    'processando': "🔄 Processando",
+    'concluido': "✅ Concluído",
+    'erro': "❌ Falhou",
+}
+# Situações em que um job ainda pode mudar (e a lista precisa ser atualizada).
+IMPORT_JOB_ACTIVE_STATUSES = ('pendente', 'processando')
+# Intervalo de atualização da lista de importações na página de upload.
+IMPORT_JOBS_REFRESH_SECONDS = 2
+
+def _db_timestamp():
+    """Data e hora atuais no formato (UTC) do CURRENT_TIMESTAMP do SQLite."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _update_import_job(conn, job_id, **fields):
+    """Atualiza as colunas `fields` de um job da fila."""
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    with database.write_transaction(conn) as cursor:
+        cursor.execute(f"UPDATE import_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+def _run_import_job(db_path, job_id):
+    """Processa um job da fila na thread do executor, com sua própria conexão do pool."""
+    conn = database.get_pool(db_path).acquire()
+    try:
+        # Reserva o job na mesma transação que o lê: um job enfileirado duas vezes roda uma vez só.
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(
+                "UPDATE import_jobs SET status = 'processando', started_at = ? WHERE id = ? AND status = 'pendente'",
+                (_db_timestamp(), job_id)
+            )
+            if cursor.rowcount == 0:
+                return
+            user_name, file_name, file_data = cursor.execute(
+                "SELECT user_name, file_name, file_data FROM import_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+        def report_progress(rows_read, total_rows, inserted):
+            _update_import_job(conn, job_id, rows_read=rows_read, total_rows=total_rows, inserted=inserted)
+
+        try:
+            result = import_file(conn, user_name, file_name, file_data, on_progress=report_progress)
+        except Exception as e:
+            message = str(e) if isinstance(e, ValueError) else f"Ocorreu um erro inesperado ao processar o arquivo: {e}"
+            _update_import_job(
+                conn, job_id, status='erro', message=message, file_data=None,
+                finished_at=_db_timestamp()
+            )
+            return
+
+        invalid_rows = result['invalid_rows']
+        _update_import_job(
+            conn, job_id,
+            status='concluido',
+            total_rows=result['total_rows'],
+            rows_read=result['rows_read'],
+            inserted=result['inserted'],
+            duplicates=result['duplicates'],
+            invalid=result['invalid'],
+            rule_counts=json.dumps(result['rule_counts'], ensure_ascii=False),
+            chunk_errors="\n".join(result['chunk_errors']) or None,
+            # Em um job concluído, 'message' lista as abas ignoradas por falta de colunas.
+            message="\n".join(result['skipped_sheets']) or None,
+            error_report=to_excel(invalid_rows) if invalid_rows is not None else None,
+            file_data=None,
+            finished_at=_db_timestamp(),
+        )
+    finally:
+        conn.close()
+
+@st.cache_resource(show_spinner=False)
+def _get_import_executor(db_path):
+    """
+    Cria uma única vez por processo o executor da fila de importações e reenfileira os jobs
+    que um reinício do servidor interrompeu. Reprocessar um job é
+    seguro: as linhas que ele já tinha gravado são ignoradas como duplicadas.
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="importacao")
+    conn = database.get_pool(db_path).acquire()
+    try:
+        with database.write_transaction(conn) as cursor:
+            cursor.execute("UPDATE import_jobs SET status = 'pendente' WHERE status = 'processando'")
+        pending = [row[0] for row in conn.execute("SELECT id FROM import_jobs WHERE status = 'pendente' ORDER BY id")]
+    finally:
+        conn.close()
+    for job_id in pending:
+        executor.submit(_run_import_job, db_path, job_id)
+    return executor
+
+def start_import_worker(conn):
+    """Garante que a fila de importações do banco de `conn` esteja rodando e retorna o executor."""
+    return _get_import_executor(conn.pool.db_path)
+
+def submit_import_job(conn, user_name, uploaded_file):
+    """
+    Coloca um arquivo (Excel, CSV ou Parquet) na fila de importações e retorna o ID do job.
+    O arquivo é gravado no banco e processado em segundo plano (ver _run_import_job).
+    """
+    try:
+        with database.write_transaction(conn) as cursor:
+            cursor.execute(
+                "INSERT INTO import_jobs (file_name, user_name, file_data) VALUES (?, ?, ?)",
+                (uploaded_file.name, user_name, uploaded_file.getvalue())
+            )
+            job_id = cursor.lastrowid
+        start_import_worker(conn).submit(_run_import_job, conn.pool.db_path, job_id)
+        return job_id
+    except Error as e:
+        st.error(f"Falha ao enviar a planilha para a fila de importação: {e}")
+        return None
+
+def get_import_jobs(conn, limit=20):
+    """Busca os jobs mais recentes da fila de importações (sem os arquivos e relatórios)."""
+    try:
+        query = """
+        SELECT id, file_name, user_name, status, total_rows, rows_read, inserted, duplicates, invalid,
+               rule_counts, chunk_errors, message, created_at, finished_at, error_report IS NOT NULL AS has_report
+        FROM import_jobs ORDER BY id DESC LIMIT ?
+        """
+        df = pd.read_sql_query(query, conn, params=(limit,))
+        # Textos ausentes como None (e não NaN), para que possam ser testados com `if`.
+        for col in ['rule_counts', 'chunk_errors', 'message']:
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+        return df
+    except (Error, pd.errors.DatabaseError) as e:
+        st.error(f"Falha ao buscar a fila de importações: {e}")
+        return pd.DataFrame()
+
+def get_import_job_report(conn, job_id):
+    """Retorna o relatório de erros (arquivo Excel) de um job, ou None se não houver."""
+    row = conn.execute("SELECT error_report FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+    return row[0] if row else None
+
+def _import_job_report_download(conn, job_id):
+    """
+    Função para `data` do st.download_button: o relatório só é lido do banco no clique.
+    Roda fora da reexecução da página, por isso usa uma conexão de leitura própria do pool.
+    """
+    db_path = conn.pool.db_path
+
+    def load_report():
+        report_conn = database.get_pool(db_path).acquire()
+        try:
+            return get_import_job_report(report_conn, job_id)
+        finally:
+            report_conn.close()
+    return load_report
+
+def _show_import_job_result(conn, job):
+    """Exibe o resumo de um job concluído: registros adicionados, duplicados e linhas com erro."""
+    if job['inserted']:
+        st.success(f"✅ Importação concluída! {job['inserted']} registros adicionados com sucesso.")
+    elif not job['chunk_errors'] and not job['duplicates']:
+        st.error("❌ Nenhum registro válido encontrado na planilha para importação.")
+
+    if job['duplicates']:
+        st.info(
+            f"ℹ️ {job['duplicates']} linhas já constavam no banco (mesma data, filial, produto, destino, "
+            f"quantidade, preço e NFe) e foram ignoradas. Linhas iguais repetidas dentro da planilha "
+            f"são todas importadas; apenas as que já tinham sido gravadas antes são ignoradas."
+        )
+
+    if job['message']:
+        st.warning("⚠️ Algumas abas foram ignoradas por não terem as colunas do modelo:\n\n" + "\n".join(f"- {sheet}" for sheet in job['message'].splitlines()))
+
+    if job['chunk_errors']:
+        st.error("❌ Alguns blocos da planilha não puderam ser gravados:\n\n" + "\n".join(f"- {error}" for error in job['chunk_errors'].splitlines()))
+
+    # Feedback Detalhado sobre Erros
+    if job['invalid']:
+        st.warning(f"⚠️ {job['invalid']} linhas foram ignoradas por conterem dados inválidos ou incompletos.")
+        # Resumo por motivo: uma linha pode ter mais de um motivo.
+        rule_counts = json.loads(job['rule_counts'] or "{}")
+        st.dataframe(
+            pd.DataFrame(list(rule_counts.items()), columns=['Motivo', 'Linhas']).sort_values('Linhas', ascending=False),
+            use_container_width=True, hide_index=True
+        )
+        if job['has_report']:
+            if st.toggle("Ver detalhes das linhas com erro", key=f"import_job_details_{job['id']}"):
+                report = get_import_job_report(conn, int(job['id']))
+                df_invalid = pd.read_excel(io.BytesIO(report), dtype=str)
+                if job['invalid'] > len(df_invalid):
+                    st.caption(f"Exibindo as primeiras {len(df_invalid):,} de {job['invalid']:,} linhas com erro.")
+                st.dataframe(df_invalid, use_container_width=True, hide_index=True)
+            st.download_button(
+                label="📥 Baixar Relatório de Erros",
+                data=_import_job_report_download(conn, int(job['id'])),
+                file_name=f"relatorio_erros_importacao_{job['id']}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",
+                key=f"import_job_report_{job['id']}"
+            )
+
+def _render_import_jobs(conn, jobs):
+    """Lista as importações recentes com a situação e o progresso de cada uma."""
+    if jobs.empty:
+        st.caption("Nenhuma importação enviada ainda.")
+        return
+
+    for job in jobs.to_dict('records'):
+        status = IMPORT_JOB_STATUS.get(job['status'], job['status'])
+        created_at = pd.to_datetime(job['created_at']).strftime('%d/%m/%Y %H:%M')
+        title = f"{status} · {job['file_name']} · {created_at} · {job['user_name']}"
+        active = job['status'] in IMPORT_JOB_ACTIVE_STATUSES
+        with st.expander(title, expanded=active):
+            if job['status'] == 'pendente':
+                st.caption("Aguardando as importações anteriores terminarem.")
+            elif job['status'] == 'processando':
+                fraction = min(job['rows_read'] / job['total_rows'], 1.0) if job['total_rows'] else 0.0
+                st.progress(fraction, text=f"{job['rows_read']:,} linhas processadas, {job['inserted']:,} registros importados...")
+            elif job['status'] == 'erro':
+                st.error(f"❌ {job['message']}")
+            else:
+                _show_import_job_result(conn, job)
+
+@st.fragment(run_every=IMPORT_JOBS_REFRESH_SECONDS)
+def _display_active_import_jobs(conn):
+    """
+    Fragmento atualizado a cada IMPORT_JOBS_REFRESH_SECONDS enquanto há jobs na fila.
+    Quando o último termina, reexecuta a página, que passa a usar a lista estática.
+    """
+    jobs = get_import_jobs(conn)
+    _render_import_jobs(conn, jobs)
+    if not jobs['status'].isin(IMPORT_JOB_ACTIVE_STATUSES).any():
+        st.rerun()
+
+@st.fragment
+def _display_finished_import_jobs(conn, jobs):
+    """Lista sem atualização periódica: nenhum job na fila, nada muda até um novo envio."""
+    _render_import_jobs(conn, jobs)
+
+def display_import_jobs(conn):
+    """
+    Lista as importações recentes. Só há atualização periódica enquanto algum job está
+    na fila ou sendo processado; com a fila vazia a lista é desenhada uma única vez.
+    """
+    jobs = get_import_jobs(conn)
+    if not jobs.empty and jobs['status'].isin(IMPORT_JOB_ACTIVE_STATUSES).any():
+        _display_active_import_jobs(conn)
+    else:
+        _display_finished_import_jobs(conn, jobs)